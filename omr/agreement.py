@@ -0,0 +1,230 @@
+"""
+Incremental statistics of the agreement of the annotators on the control
+blobs
+"""
+import numpy as np
+
+
+def alpha_from_counts(counts):
+    """
+    Krippendorff's alpha for nominal data from a (units x values) matrix
+    containing, for each unit, how many times each value was given. Returns
+    nan if it is undefined (e.g. only one value was ever used).
+    """
+    counts = np.asarray(counts, dtype=np.float64)
+    m = counts.sum(axis=1)
+    counts = counts[m > 1]
+    m = m[m > 1]
+    if counts.shape[0] == 0:
+        return float('nan')
+    coincidences = np.einsum('uc,uk->ck', counts / (m - 1)[:, None], counts)
+    coincidences -= np.diag((counts / (m - 1)[:, None]).sum(axis=0))
+    return _alpha(coincidences)
+
+
+def _alpha(coincidences):
+    n_c = coincidences.sum(axis=1)
+    n = n_c.sum()
+    disagreement = n**2 - (n_c**2).sum()
+    if n <= 1 or disagreement <= 0:
+        return float('nan')
+    observed = coincidences.sum() - np.trace(coincidences)
+    return float(1 - (n - 1) * observed / disagreement)
+
+
+class AgreementTracker:
+    """
+    Keeps the agreement statistics of the annotators up to date with O(1)
+    work for each new label of a control blob (O(v^2) for Krippendorff's
+    alpha, with v the number of possible values).
+
+    For each annotator:
+    * `self_agreement`: the fraction of pairs of labels given by the
+      annotator to the same blob that are equal
+    * `inter_agreement`: the probability that a label of the annotator is
+      equal to a label given to the same blob by the other annotators
+    * the rating, i.e. the mean of the two, which is recomputed only when the
+      annotator has labelled all the control blobs once more, from the
+      second time on
+
+    Over all the annotations, `alpha()` is Krippendorff's alpha for nominal
+    data, where each label is a separate observation of its blob.
+    """
+
+    def __init__(self, n_units, n_values=32):
+        self.n_units = n_units
+        self.n_values = n_values
+        # annotator -> (units x values) label counts
+        self.counts = {}
+        self.pooled = np.zeros((n_units, n_values), dtype=np.int64)
+        self._coincidences = np.zeros((n_values, n_values))
+        # annotator -> [equal pairs, pairs]
+        self._pairs = {}
+        # annotator -> histogram of the number of labels of each unit
+        self._repeats = {}
+        # annotator -> minimum number of labels of a unit
+        self.min_repeats = {}
+        self._ratings = {}
+
+    @classmethod
+    def from_annotator_data(cls, annotator_data, n_units):
+        """
+        Builds the tracker from the content of the annotator json, in one
+        vectorized pass
+        """
+        values = [
+            v for lists in annotator_data.values() for i in lists for v in i
+        ]
+        tracker = cls(n_units, max([31] + values) + 1)
+        for annotator, lists in annotator_data.items():
+            tracker.add_annotator(annotator)
+            units = [u for u, i in enumerate(lists) for _ in i]
+            labels = [v for i in lists for v in i]
+            counts = tracker.counts[annotator]
+            np.add.at(counts, (units, labels), 1)
+            tracker.pooled += counts
+            # the same pairs that `add` would have counted one at a time
+            n = counts.sum(axis=1)
+            tracker._pairs[annotator] = [
+                int((counts * (counts - 1)).sum() // 2),
+                int((n * (n - 1)).sum() // 2)
+            ]
+            repeats, freq = np.unique(n, return_counts=True)
+            tracker._repeats[annotator] = dict(
+                zip(repeats.tolist(), freq.tolist()))
+            tracker.min_repeats[annotator] = int(n.min())
+
+        m = tracker.pooled.sum(axis=1)
+        w = np.where(m > 1, 1 / np.maximum(m - 1, 1), 0)[:, None]
+        tracker._coincidences = np.einsum('uc,uk->ck', tracker.pooled * w,
+                                          tracker.pooled) - np.diag(
+                                              (tracker.pooled * w).sum(axis=0))
+        for annotator in annotator_data:
+            if tracker.min_repeats[annotator] > 1:
+                tracker._ratings[annotator] = (
+                    tracker.self_agreement(annotator) +
+                    tracker.inter_agreement(annotator)) / 2
+        return tracker
+
+    def __grow(self, value):
+        n_values = max(value + 1, 2 * self.n_values)
+        pad = n_values - self.n_values
+        for annotator in self.counts:
+            self.counts[annotator] = np.pad(self.counts[annotator],
+                                            ((0, 0), (0, pad)))
+        self.pooled = np.pad(self.pooled, ((0, 0), (0, pad)))
+        self._coincidences = np.pad(self._coincidences, ((0, pad), (0, pad)))
+        self.n_values = n_values
+
+    def add_annotator(self, annotator):
+        if annotator in self.counts:
+            return
+        self.counts[annotator] = np.zeros((self.n_units, self.n_values),
+                                          dtype=np.int64)
+        self._pairs[annotator] = [0, 0]
+        self._repeats[annotator] = {0: self.n_units}
+        self.min_repeats[annotator] = 0
+
+    def __unit_coincidences(self, unit_counts):
+        m = unit_counts.sum()
+        if m <= 1:
+            return 0
+        return (np.outer(unit_counts, unit_counts) -
+                np.diag(unit_counts)) / (m - 1)
+
+    def add(self, annotator, unit, value):
+        """
+        Adds the label `value` given by `annotator` to the control blob at
+        position `unit`
+        """
+        self.add_annotator(annotator)
+        if value >= self.n_values:
+            self.__grow(value)
+        counts = self.counts[annotator]
+
+        # pairs of equal labels of this annotator
+        pairs = self._pairs[annotator]
+        pairs[0] += int(counts[unit, value])
+        pairs[1] += int(counts[unit].sum())
+
+        # coincidences of this unit
+        self._coincidences -= self.__unit_coincidences(self.pooled[unit])
+        self.pooled[unit, value] += 1
+        self._coincidences += self.__unit_coincidences(self.pooled[unit])
+
+        # number of labels of each unit
+        r = int(counts[unit].sum())
+        counts[unit, value] += 1
+        hist = self._repeats[annotator]
+        hist[r] -= 1
+        hist[r + 1] = hist.get(r + 1, 0) + 1
+        if r == self.min_repeats[annotator] and hist[r] == 0:
+            del hist[r]
+            self.min_repeats[annotator] += 1
+            if self.min_repeats[annotator] > 1:
+                self._ratings[annotator] = (
+                    self.self_agreement(annotator) +
+                    self.inter_agreement(annotator)) / 2
+
+    def self_agreement(self, annotator):
+        equal, total = self._pairs[annotator]
+        if total == 0:
+            return None
+        return equal / total
+
+    def inter_agreement(self, annotator):
+        """
+        O(k) with k the number of control blobs
+        """
+        counts = self.counts[annotator]
+        others = self.pooled - counts
+        n_others = others.sum(axis=1)
+        n_self = counts.sum(axis=1)
+        mask = (n_others > 0) & (n_self > 0)
+        if not np.any(mask):
+            # nobody to compare with
+            return 1.0
+        p_self = counts[mask] / n_self[mask, None]
+        p_others = others[mask] / n_others[mask, None]
+        return float((p_self * p_others).sum(axis=1).mean())
+
+    def rating(self, annotator):
+        """
+        The last rating computed for `annotator`, or None
+        """
+        return self._ratings.get(annotator)
+
+    def alpha(self):
+        """
+        Krippendorff's alpha of all the annotations
+        """
+        return _alpha(self._coincidences)
+
+    def self_alpha(self, annotator):
+        """
+        Krippendorff's alpha of the repeated annotations of `annotator`
+        """
+        return alpha_from_counts(self.counts[annotator])
+
+    def summary(self):
+        """
+        A dict with the statistics of all the annotators, with None in place
+        of undefined values
+        """
+        def _float(x):
+            return None if x is None or np.isnan(x) else float(x)
+
+        return {
+            "alpha": _float(self.alpha()),
+            "annotators": {
+                a: {
+                    "self_agreement": _float(self.self_agreement(a)),
+                    "inter_agreement": _float(self.inter_agreement(a)),
+                    "self_alpha": _float(self.self_alpha(a)),
+                    "rating": _float(self.rating(a)),
+                    "repeats": self.min_repeats[a],
+                    "labels": int(self.counts[a].sum())
+                }
+                for a in self.counts
+            }
+        }
@@ -0,0 +1,548 @@
+"""
+The state shared by all the annotators: the control/normal split, the
+annotation index and the leases of the normal blobs currently being annotated
+"""
+import os
+import json
+import heapq
+import logging
+import threading
+import time
+from collections import deque
+from enum import Enum
+
+import numpy as np
+
+from . import metrics
+from .agreement import AgreementTracker
+from .annotation_index import AnnotationIndex
+from .manifest import Manifest, load_selections, save_selections
+from .ordering import order
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Status(Enum):
+    NORMAL = 0
+    ENDED = 2
+
+
+def read_json_field(fname, annotation_field):
+    data = json.load(open(fname, "r"))
+    metrics.JSON_READS.inc(("field", ))
+    if annotation_field in data:
+        LOGGER.debug(
+            f"Accessed {fname} for field {annotation_field} and found it")
+        return data[annotation_field]
+    else:
+        LOGGER.debug(
+            f"Accessed {fname} for field {annotation_field} and not found it")
+        return None
+
+
+class BlobAllocator:
+    """
+    Hands out normal blobs to annotation sessions.
+
+    Each blob is leased to one session for `lease_timeout` seconds; leased
+    blobs are not given to other sessions and, if the lease expires before
+    the annotation is saved, the blob is leased again to the next session
+    asking for one. All methods are thread-safe.
+
+    It also saves the annotations: the control ones are kept in memory in
+    `annotator_data` (the content of the annotator json) and both are written
+    to disk directly or, if a `Journal` is given, through it.
+    `annotator_lock` must be held while using `annotator_data` and
+    `agreement`, an `AgreementTracker` updated at each control annotation.
+
+    If `duplicates` is given (a callable returning the near-duplicates of a
+    blob json, see `omr.phash.NearDuplicates`), when a normal blob is
+    annotated its free near-duplicates are annotated with the same value
+    (`duplicates_mode = "propagate"`, marked by a `propagated_from` field) or
+    moved to the end of the queue (`"deprioritise"`).
+    """
+
+    def __init__(self,
+                 blob_jsons,
+                 annotation_field,
+                 control_length=100,
+                 control_json_fn='__control.json',
+                 index_fn='__annotated.npy',
+                 ordering="shuffle",
+                 run_length=8,
+                 lease_timeout=600,
+                 annotator_json_fn='__annotator.json',
+                 journal=None,
+                 duplicates=None,
+                 duplicates_mode="deprioritise",
+                 rng=None):
+        self.rng = np.random.default_rng(1993) if rng is None else rng
+        # annotations left in the journal by the previous run must be in the
+        # jsons before reading them
+        self.journal = journal
+        if journal is not None:
+            journal.recover()
+        assert control_length or control_json_fn, "Please, provide control_length or control_json_fn and normal_json_fn"
+        self.control_jsons, self.normal_jsons = self.__split(
+            blob_jsons, control_length, control_json_fn, ordering, run_length)
+
+        self.annotation_field = annotation_field
+        self.control_length = control_length
+
+        # annotation state of the normal blobs, built once and then re-used
+        self.index = AnnotationIndex(
+            self.normal_jsons, annotation_field,
+            lambda fn: read_json_field(fn, annotation_field) is not None,
+            index_fn)
+
+        self.current_normal_idx = 0
+        self.status = Status.NORMAL
+        self.lease_timeout = lease_timeout
+        # position -> (session, expiration time)
+        self.leases = {}
+        # (expiration time, position), may contain renewed or released leases
+        self._expirations = []
+        # free blobs behind `current_normal_idx` found by the `Reconciler`
+        self._gaps = deque()
+        self._gap_set = set()
+        # near-duplicates of annotated blobs, served after all the others
+        self.duplicates = duplicates
+        self.duplicates_mode = duplicates_mode
+        self._deferred = deque()
+        self._deferred_set = set()
+        self.lock = threading.RLock()
+        self.annotator_lock = threading.RLock()
+
+        self.annotator_json_fn = annotator_json_fn
+        if os.path.exists(annotator_json_fn):
+            self.annotator_data = json.load(open(annotator_json_fn))
+        else:
+            self.annotator_data = {}
+        self.agreement = AgreementTracker.from_annotator_data(
+            self.annotator_data, len(self.control_jsons))
+        if journal is not None:
+            journal.start()
+
+    def __split(self, blob_jsons, control_length, control_json_fn, ordering,
+                run_length):
+        """
+        The control and normal blobs, as sequences of json paths with a
+        `position` method.
+
+        The split is kept in `control_json_fn`. If `blob_jsons` is an
+        `omr.manifest.Manifest`, it is also kept as manifest indices in a
+        `.npz` file next to it, read instead of the json at the next starts
+        as long as the manifest, the json and the ordering don't change.
+        """
+        # the ordering only affects the normal set
+        ordering_key = [ordering, run_length if ordering != "shuffle" else None]
+        manifest = blob_jsons if isinstance(blob_jsons, Manifest) else None
+        split_fn = os.path.splitext(control_json_fn)[0] + '.npz'
+        if manifest is not None and os.path.exists(control_json_fn):
+            split = load_selections(split_fn, manifest,
+                                    [ordering_key, _stat(control_json_fn)])
+            if split is not None:
+                return split['control'], split['normal']
+
+        if os.path.exists(control_json_fn):
+            _data = json.load(open(control_json_fn))
+            control_jsons = _data['control']
+            normal_jsons = _data['normal']
+            if _data.get('ordering', ["shuffle", None]) != ordering_key:
+                LOGGER.info(f"re-ordering normal blobs: {ordering_key}")
+                normal_jsons = order(normal_jsons, ordering, run_length,
+                                     self.rng).tolist()
+                _dump_split(control_json_fn, control_jsons, normal_jsons,
+                            ordering_key)
+        else:
+            # shuffling blobs; `blob_jsons` is only read here, so it can be a
+            # lazy iterable such as an `omr.manifest.Manifest`
+            full_json_list = np.asarray([str(i) for i in blob_jsons])
+            self.rng.shuffle(full_json_list)  # in-place...
+            control_jsons = full_json_list[:control_length].tolist()
+            normal_jsons = full_json_list[control_length:]
+            if ordering != "shuffle":
+                normal_jsons = order(normal_jsons, ordering, run_length,
+                                     self.rng)
+            normal_jsons = normal_jsons.tolist()
+            _dump_split(control_json_fn, control_jsons, normal_jsons,
+                        ordering_key)
+
+        if manifest is not None:
+            split = save_selections(
+                split_fn, manifest, {
+                    'control': control_jsons,
+                    'normal': normal_jsons
+                }, [ordering_key, _stat(control_json_fn)])
+            if split is not None:
+                return split['control'], split['normal']
+        return _Paths(control_jsons), _Paths(normal_jsons)
+
+    def control_position(self, blob_json):
+        """
+        The position of `blob_json` in the control group, or None if it's
+        not a control blob
+        """
+        return self.control_jsons.position(blob_json)
+
+    def random(self):
+        """
+        A random number in [0, 1), safe to be called from any thread
+        """
+        with self.lock:
+            return self.rng.random()
+
+    def is_free(self, pos):
+        """
+        True if the blob at `pos` is not annotated according to its json
+        file; the index is updated if it was outdated.
+        """
+        if read_json_field(self.normal_jsons[pos],
+                           self.annotation_field) is None:
+            return True
+        self.index.mark(pos)
+        return False
+
+    def __pop_expired(self, now):
+        """
+        The position of a blob whose lease has expired, or None
+        """
+        while self._expirations and self._expirations[0][0] <= now:
+            expiration, pos = heapq.heappop(self._expirations)
+            lease = self.leases.get(pos)
+            if lease is None or lease[1] != expiration:
+                # completed or renewed
+                continue
+            del self.leases[pos]
+            if not self.index.is_annotated(pos) and self.is_free(pos):
+                LOGGER.info(f"lease expired, re-issuing blob {pos}")
+                return pos
+        return None
+
+    def __pop_gap(self):
+        """
+        The position of a free blob found by the `Reconciler`, or None
+        """
+        while self._gaps:
+            pos = self._gaps.popleft()
+            self._gap_set.discard(pos)
+            if pos not in self.leases and not self.index.is_annotated(
+                    pos) and self.is_free(pos):
+                LOGGER.info(f"re-issuing skipped blob {pos}")
+                return pos
+        return None
+
+    def __pop_deferred(self):
+        """
+        The position of a free blob that was deprioritised, or None
+        """
+        while self._deferred:
+            pos = self._deferred.popleft()
+            self._deferred_set.discard(pos)
+            if pos not in self.leases and not self.index.is_annotated(
+                    pos) and self.is_free(pos):
+                LOGGER.info(f"issuing deprioritised blob {pos}")
+                return pos
+        return None
+
+    def __advance(self):
+        """
+        Moves `current_normal_idx` to the next free blob and returns its
+        position; raises `StopIteration` if there are no free blobs.
+        Deprioritised blobs are skipped and returned only at the end.
+        """
+        pos = self.index.next_unannotated(self.current_normal_idx)
+        while pos is not None:
+            # the index could be outdated if the file was edited from outside,
+            # so the blob is checked before serving it
+            if (pos not in self.leases and pos not in self._deferred_set
+                    and self.is_free(pos)):
+                break
+            pos = self.index.next_unannotated(pos + 1)
+        if pos is None:
+            pos = self.__pop_deferred()
+            if pos is not None:
+                return pos
+            self.status = Status.ENDED
+            raise StopIteration
+        # update `current_normal_idx`
+        self.status = Status.NORMAL
+        self.current_normal_idx = pos + 1
+        LOGGER.info(
+            f"current_normal_idx: {self.current_normal_idx}/{len(self.normal_jsons)}"
+        )
+        return pos
+
+    def lease(self, session):
+        """
+        Leases the next normal blob to `session` and returns its json path.
+        Blobs with expired leases are re-issued first, then blobs found by the
+        `Reconciler`.
+        """
+        with self.lock:
+            now = time.monotonic()
+            pos = self.__pop_expired(now)
+            if pos is None:
+                pos = self.__pop_gap()
+            if pos is None:
+                pos = self.__advance()
+            self.leases[pos] = (session, now + self.lease_timeout)
+            heapq.heappush(self._expirations, (now + self.lease_timeout, pos))
+            LOGGER.debug(f"leased blob {pos} to {session}")
+            return self.normal_jsons[pos]
+
+    def renew(self, blob_json, session):
+        """
+        Extends the lease of `session` on `blob_json`. Returns False if the
+        lease has been lost, e.g. because it expired and was given to another
+        session.
+        """
+        pos = self.index.position(blob_json)
+        with self.lock:
+            lease = self.leases.get(pos)
+            if lease is None or lease[0] != session:
+                return False
+            expiration = time.monotonic() + self.lease_timeout
+            self.leases[pos] = (session, expiration)
+            heapq.heappush(self._expirations, (expiration, pos))
+            return True
+
+    def complete(self, blob_json):
+        """
+        Marks `blob_json` as annotated and drops its lease
+        """
+        pos = self.index.position(blob_json)
+        if pos is None:
+            return
+        with self.lock:
+            self.index.mark(pos)
+            self.leases.pop(pos, None)
+
+    def add_annotator(self, annotator):
+        """
+        Adds `annotator` to the annotator json, if needed
+        """
+        with self.annotator_lock:
+            if annotator not in self.annotator_data:
+                self.annotator_data[annotator] = [
+                    [] for _ in range(self.control_length)
+                ]
+                self.agreement.add_annotator(annotator)
+                self.__write_control(None, annotator, None, None)
+
+    def save_control(self, blob_json, annotator, annotation_value):
+        """
+        Adds an annotation of a control blob
+        """
+        control_idx = self.control_position(blob_json)
+        with self.annotator_lock:
+            self.add_annotator(annotator)
+            self.annotator_data[annotator][control_idx].append(
+                annotation_value)
+            self.agreement.add(annotator, control_idx, annotation_value)
+            seq = self.__write_control(str(blob_json), annotator, control_idx,
+                                       annotation_value)
+        # waiting out of the lock, so that concurrent saves share the fsync
+        if seq is not None:
+            self.journal.wait(seq)
+
+    def __write_control(self, blob_json, annotator, control_idx,
+                        annotation_value):
+        """
+        Writes the annotator json or appends the annotation to the journal,
+        returning the sequence number of the record (None without journal)
+        """
+        if self.journal is None:
+            json.dump(self.annotator_data, open(self.annotator_json_fn, "w"))
+            return None
+        return self.journal.append({
+            "blob": blob_json,
+            "annotator": annotator,
+            "field": self.annotation_field,
+            "value": annotation_value,
+            "control": True,
+            "control_idx": control_idx
+        })
+
+    def save_normal(self, blob_json, annotator, annotation_value):
+        """
+        Saves the annotation of a normal blob and marks it as annotated; its
+        near-duplicates are then handled according to `duplicates_mode`.
+
+        With a journal, the blob is marked only once the record has been
+        fsynced: the index is written through to disk, so marking it earlier
+        could leave a blob marked as annotated without any annotation after a
+        crash.
+        """
+        seq = self.__write_normal(blob_json, annotator, annotation_value)
+        if seq is not None:
+            self.journal.wait(seq)
+        self.complete(blob_json)
+        if self.duplicates is not None:
+            self.__near_duplicates(blob_json, annotator, annotation_value)
+
+    def __write_normal(self,
+                       blob_json,
+                       annotator,
+                       annotation_value,
+                       propagated_from=None):
+        """
+        Writes the blob json or appends the annotation to the journal,
+        returning the sequence number of the record (None without journal)
+        """
+        if self.journal is None:
+            json_data = json.load(open(blob_json, "r"))
+            json_data[self.annotation_field] = annotation_value
+            json_data['annotator'] = annotator
+            if propagated_from is not None:
+                json_data['propagated_from'] = propagated_from
+            json.dump(json_data, open(blob_json, "w"))
+            return None
+        else:
+            record = {
+                "blob": str(blob_json),
+                "annotator": annotator,
+                "field": self.annotation_field,
+                "value": annotation_value,
+                "control": False,
+                "control_idx": None
+            }
+            if propagated_from is not None:
+                record["propagated_from"] = propagated_from
+            return self.journal.append(record)
+
+    def __near_duplicates(self, blob_json, annotator, annotation_value):
+        """
+        Propagates the annotation of `blob_json` to its free near-duplicates
+        or deprioritises them; control blobs are never touched
+        """
+        positions = []
+        with self.lock:
+            for other in self.duplicates(blob_json):
+                pos = self.index.position(other)
+                if (pos is not None and pos not in self.leases
+                        and not self.index.is_annotated(pos)):
+                    positions.append(pos)
+                    if self.duplicates_mode == "propagate":
+                        # not leased to anyone until marked below; the lease
+                        # has no expiration
+                        self.leases[pos] = (None, None)
+                    elif pos not in self._deferred_set:
+                        self._deferred.append(pos)
+                        self._deferred_set.add(pos)
+        if self.duplicates_mode != "propagate":
+            return
+        seq = None
+        for pos in positions:
+            seq = self.__write_normal(self.normal_jsons[pos], annotator,
+                                      annotation_value, str(blob_json))
+        if seq is not None:
+            self.journal.wait(seq)
+        for pos in positions:
+            self.complete(self.normal_jsons[pos])
+        if positions:
+            LOGGER.info(f"annotation of {blob_json} propagated to "
+                        f"{len(positions)} near-duplicates")
+
+    def reconcile(self, pos, since=None):
+        """
+        Checks the blob at `pos` against its json file, which is only read if
+        it was modified after `since` (a timestamp) or if `since` is None.
+        The index is corrected if the file was edited from outside and free
+        blobs behind `current_normal_idx` that are not leased are queued
+        again.
+
+        Blobs with annotations still in the journal, not yet folded into
+        their json, are skipped. The json is read under `lock`, so that an
+        annotation can't be journaled and marked in the meantime.
+        """
+        fname = self.normal_jsons[pos]
+        read = since is None or os.stat(fname).st_mtime >= since
+        with self.lock:
+            annotated = self.index.is_annotated(pos)
+            if read:
+                if self.journal is not None and self.journal.is_pending(
+                        fname):
+                    return
+                annotated = read_json_field(
+                    fname, self.annotation_field) is not None
+            if annotated != self.index.is_annotated(pos):
+                LOGGER.info(f"blob {pos} edited from outside: {fname}")
+                self.index.mark(pos, annotated)
+            if (not annotated and pos < self.current_normal_idx
+                    and pos not in self.leases and pos not in self._gap_set):
+                self._gaps.append(pos)
+                self._gap_set.add(pos)
+                if self.status == Status.ENDED:
+                    self.status = Status.NORMAL
+
+
+class _Paths(list):
+    """
+    A list of blob json paths with the `position` lookup of
+    `omr.manifest.Selection`
+    """
+
+    def position(self, path):
+        if not hasattr(self, '_positions'):
+            self._positions = {
+                os.path.normpath(str(p)): i
+                for i, p in enumerate(self)
+            }
+        return self._positions.get(os.path.normpath(str(path)))
+
+
+def _stat(fname):
+    st = os.stat(fname)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _dump_split(control_json_fn, control_jsons, normal_jsons, ordering_key):
+    json.dump(
+        {
+            'control': control_jsons,
+            'normal': normal_jsons,
+            'ordering': ordering_key
+        }, open(control_json_fn, "w"))
+
+
+class Reconciler(threading.Thread):
+    """
+    A background thread that sweeps all the normal blobs with
+    `BlobAllocator.reconcile`, `batch` blobs at a time with a `pause` in
+    between, and starts a new sweep every `interval` seconds. Only files
+    modified after the previous sweep are read; in the first sweep, files
+    modified after the last update of the index.
+
+    This finds blobs that were skipped or edited from outside without
+    blocking the requests.
+    """
+
+    def __init__(self, allocator, batch=256, pause=0.5, interval=600):
+        super().__init__(name='reconciler', daemon=True)
+        self.allocator = allocator
+        self.batch = batch
+        self.pause = pause
+        self.interval = interval
+        self._last_sweep = os.stat(allocator.index.index_fn).st_mtime
+        self._stop_event = threading.Event()
+
+    def sweep(self):
+        start = time.time()
+        n = len(self.allocator.normal_jsons)
+        for lo in range(0, n, self.batch):
+            for pos in range(lo, min(n, lo + self.batch)):
+                self.allocator.reconcile(pos, self._last_sweep)
+            if self._stop_event.wait(self.pause):
+                return
+        self._last_sweep = start
+        LOGGER.info(
+            f"reconciler: {len(self.allocator._gaps)} skipped blobs queued")
+
+    def run(self):
+        while not self._stop_event.is_set():
+            self.sweep()
+            self._stop_event.wait(self.interval)
+
+    def stop(self):
+        self._stop_event.set()
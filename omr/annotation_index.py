@@ -0,0 +1,119 @@
+"""
+A compact index of the annotation state of each blob, so that looking for the
+next blob to annotate doesn't need to open any json file.
+"""
+import hashlib
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+# number of flags inspected at each step while looking for a free blob
+SEARCH_CHUNK = 4096
+
+
+def fingerprint(keys, annotation_field):
+    """
+    A short hash identifying an ordered list of blobs and the annotation
+    field; lists with their own `fingerprint` (an `omr.manifest.Selection`)
+    are not read
+    """
+    h = hashlib.sha1(annotation_field.encode())
+    if hasattr(keys, 'fingerprint'):
+        h.update(keys.fingerprint().encode())
+        return h.hexdigest()
+    for k in keys:
+        h.update(b'\0')
+        h.update(str(k).encode())
+    return h.hexdigest()
+
+
+class AnnotationIndex:
+    """
+    One byte per blob, stored in a memory-mapped `.npy` file: 1 means that the
+    blob at the same position in `keys` has already been annotated.
+
+    The index is built once by calling `is_annotated` on each key and is then
+    re-used at each restart, as long as the list of keys and the annotation
+    field don't change (a sidecar `.json` keeps their fingerprint).
+    """
+
+    def __init__(self,
+                 keys,
+                 annotation_field,
+                 is_annotated,
+                 index_fn='__annotated.npy'):
+        self.keys = keys
+        self.index_fn = Path(index_fn)
+        self.meta_fn = self.index_fn.with_suffix('.json')
+        self._positions = None
+
+        fp = fingerprint(keys, annotation_field)
+        if self.__is_valid(fp):
+            self.flags = np.load(self.index_fn, mmap_mode='r+')
+        else:
+            self.flags = np.lib.format.open_memmap(self.index_fn,
+                                                   mode='w+',
+                                                   dtype=np.uint8,
+                                                   shape=(len(keys), ))
+            for i, k in enumerate(keys):
+                self.flags[i] = bool(is_annotated(k))
+            self.flags.flush()
+            json.dump({
+                'fingerprint': fp,
+                'length': len(keys)
+            }, open(self.meta_fn, "w"))
+
+    def __is_valid(self, fp):
+        if not self.index_fn.exists() or not self.meta_fn.exists():
+            return False
+        meta = json.load(open(self.meta_fn))
+        return meta.get('fingerprint') == fp and meta.get('length') == len(
+            self.keys)
+
+    def __len__(self):
+        return self.flags.shape[0]
+
+    @property
+    def n_annotated(self):
+        return int(np.count_nonzero(self.flags))
+
+    def position(self, key):
+        """
+        The position of `key` in the index or None if it's not indexed
+        """
+        if hasattr(self.keys, 'position'):
+            return self.keys.position(key)
+        if self._positions is None:
+            self._positions = {
+                os.path.normpath(str(k)): i
+                for i, k in enumerate(self.keys)
+            }
+        return self._positions.get(os.path.normpath(str(key)))
+
+    def is_annotated(self, pos):
+        return bool(self.flags[pos])
+
+    def mark(self, pos, value=True):
+        """
+        Set the flag at `pos` and writes it through to disk
+        """
+        self.flags[pos] = value
+        self.flags.flush()
+
+    def next_unannotated(self, start=0):
+        """
+        The first position >= `start` that is not annotated, or None.
+
+        The search proceeds by chunks, so that when the cursor follows the
+        annotations each call only inspects a few flags.
+        """
+        n = len(self)
+        while start < n:
+            chunk = self.flags[start:start + SEARCH_CHUNK]
+            free = np.flatnonzero(chunk == 0)
+            if free.size > 0:
+                return start + int(free[0])
+            start += chunk.shape[0]
+        return None
@@ -0,0 +1,390 @@
+"""
+Small benchmarks for the data-entry and preprocessing hot paths. Each
+function prints a table and can be run with `pdm <name>`.
+"""
+import json
+import tempfile
+import time
+from pathlib import Path
+
+from .synthetic import synthetic_page
+
+
+def _write_blob_jsons(root, n, annotated, annotation_field):
+    """
+    Writes `n` fake blob jsons in `root`, the first `annotated` ones already
+    annotated
+    """
+    files = []
+    for i in range(n):
+        fname = root / f"page{i // 50:05d}_nostaff" / f"page{i // 50:05d}_nostaff_blob{i % 50:03d}.json"
+        fname.parent.mkdir(exist_ok=True)
+        data = {"x0": 0, "y0": 0, "x1": 10, "y1": 10, "id": i % 50}
+        if i < annotated:
+            data[annotation_field] = 0
+        json.dump(data, open(fname, "w"))
+        files.append(str(fname))
+    return files
+
+
+def bench_annotation_index(sizes=(1000, 5000, 20000, 50000),
+                           annotated_ratio=0.95,
+                           repeats=5):
+    """
+    Latency of picking the next blob to annotate after a restart, when
+    `annotated_ratio` of the archive is already annotated: the old scan of the
+    json files compared with the `AnnotationIndex` lookup.
+    """
+    from .annotation_index import AnnotationIndex
+    from .allocator import read_json_field
+
+    field = "annotation"
+
+    def is_annotated(fn):
+        return read_json_field(fn, field) is not None
+
+    print(f"{'blobs':>8} {'scan [ms]':>12} {'index build [s]':>16} "
+          f"{'index open [ms]':>16} {'index next [ms]':>16}")
+    for n in sizes:
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            files = _write_blob_jsons(tmp, n, int(n * annotated_ratio), field)
+
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                for fn in files:
+                    if not is_annotated(fn):
+                        break
+            scan = (time.perf_counter() - t0) / repeats
+
+            index_fn = tmp / '__annotated.npy'
+            t0 = time.perf_counter()
+            AnnotationIndex(files, field, is_annotated, index_fn)
+            build = time.perf_counter() - t0
+
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                # a restart: the index is re-opened from disk
+                index = AnnotationIndex(files, field, is_annotated, index_fn)
+            reopen = (time.perf_counter() - t0) / repeats
+
+            t0 = time.perf_counter()
+            for _ in range(repeats):
+                pos = index.next_unannotated(0)
+                is_annotated(files[pos])
+            lookup = (time.perf_counter() - t0) / repeats
+            del index
+
+        print(f"{n:>8} {scan * 1e3:>12.2f} {build:>16.2f} "
+              f"{reopen * 1e3:>16.2f} {lookup * 1e3:>16.3f}")
+
+
+def bench_ordering(n_pages=2000,
+                   blobs_per_page=60,
+                   control_length=500,
+                   control_freq=5,
+                   run_lengths=(4, 8, 16),
+                   cache_pages=(1, 4, 16),
+                   n_annotations=1000,
+                   trials=5,
+                   seed=1993):
+    """
+    Simulates the annotation queue on a synthetic archive and reports the
+    expected number of page decodes per `n_annotations` annotations with a
+    `PageCache` holding `cache_pages` pages, for the random ordering and for
+    the page-locality ordering with different run lengths.
+    """
+    import numpy as np
+
+    from .ordering import order
+    from .page_cache import PageCache
+
+    rng = np.random.default_rng(seed)
+    blobs = [
+        f"page{p:05d}/blob{b:03d}.json" for p in range(n_pages)
+        for b in range(max(1, rng.poisson(blobs_per_page)))
+    ]
+
+    orderings = [("shuffle", None)] + [("page", r) for r in run_lengths]
+    print(f"{'ordering':>12}" +
+          "".join(f" {f'cache={c}':>10}" for c in cache_pages))
+    for ordering, run_length in orderings:
+        decodes = np.zeros(len(cache_pages))
+        for _ in range(trials):
+            # same split as ImageManager: the control set is taken before
+            # ordering the normal set
+            full = order(blobs, "shuffle", None, rng)
+            control = full[:control_length]
+            normal = full[control_length:]
+            if ordering != "shuffle":
+                normal = order(normal, ordering, run_length, rng)
+
+            queue = []
+            normal_idx = control_idx = 0
+            while len(queue) < n_annotations:
+                if rng.random() < 1 / control_freq:
+                    queue.append(control[control_idx % len(control)])
+                    control_idx += 1
+                else:
+                    queue.append(normal[normal_idx])
+                    normal_idx += 1
+
+            for i, c in enumerate(cache_pages):
+                cache = PageCache(c, loader=lambda p: np.zeros(1, np.uint8))
+                for b in queue:
+                    cache.get(b.split("/")[0])
+                decodes[i] += cache.misses
+        decodes /= trials
+        name = ordering if run_length is None else f"{ordering}/{run_length}"
+        print(f"{name:>12}" + "".join(f" {d:>10.1f}" for d in decodes))
+
+
+def _bench_pages(toml_config, n_pages, seed):
+    """
+    `n_pages` random pages from `input_dir` in `toml_config`, or synthetic
+    pages if there are none; returns the images and a description
+    """
+    import numpy as np
+    import toml
+    from skimage import io
+
+    rng = np.random.default_rng(seed)
+    pages = []
+    try:
+        in_path = Path(toml.load(open(toml_config))['preprocessing']['input_dir'])
+        pages = sorted(in_path.glob('**/*_nostaff.jpg'))
+    except (FileNotFoundError, KeyError):
+        pass
+    if pages:
+        pages = rng.choice(pages, min(n_pages, len(pages)), replace=False)
+        return [io.imread(p) for p in pages], f"{len(pages)} pages"
+    return [synthetic_page(rng)[0] for _ in range(n_pages)
+            ], f"{n_pages} synthetic pages"
+
+
+def _match(ref, boxes, iou=0.5):
+    """
+    Recall and precision of `boxes` with respect to `ref` (boxes with
+    IoU >= `iou` match) and mean IoU of the matched references
+    """
+    import numpy as np
+
+    from .detection import box_iou
+
+    if len(ref) == 0 or len(boxes) == 0:
+        return float(len(ref) == 0), float(len(boxes) == 0), float('nan')
+    m = box_iou(ref, boxes)
+    best_ref = m.max(axis=1)
+    best_box = m.max(axis=0)
+    matched = best_ref >= iou
+    return (matched.mean(), (best_box >= iou).mean(),
+            best_ref[matched].mean() if matched.any() else float('nan'))
+
+
+def bench_find_blobs(toml_config='config.toml',
+                     n_pages=5,
+                     downscales=(2, 3, 4),
+                     seed=1993):
+    """
+    Speed, peak memory and accuracy of the `dog_pyramid` detector compared
+    with `blob_dog` on the full page, whose boxes are the reference: recall
+    and precision of the boxes (IoU >= 0.5) and mean IoU of the matched
+    ones.
+    """
+    import tracemalloc
+
+    import numpy as np
+
+    from .preprocess import detect_boxes
+
+    images, desc = _bench_pages(toml_config, n_pages, seed)
+    print(f"{desc}, {np.mean([i.size for i in images]) / 1e6:.1f} Mpx on "
+          "average")
+    print(f"{'detector':>22} {'s/page':>8} {'peak MiB':>9} {'blobs':>7} "
+          f"{'recall':>7} {'precis.':>7} {'IoU':>6}")
+
+    configs = [("dog", {})]
+    for d in downscales:
+        configs += [("dog_pyramid", dict(downscale=d, refine=False)),
+                    ("dog_pyramid", dict(downscale=d, refine=True))]
+    reference = None
+    for method, options in configs:
+        boxes, elapsed, peak = [], 0, 0
+        for image in images:
+            tracemalloc.start()
+            t0 = time.perf_counter()
+            boxes.append(detect_boxes(image, method, **options))
+            elapsed += time.perf_counter() - t0
+            peak = max(peak, tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+        if reference is None:
+            reference = boxes
+        scores = np.nanmean(
+            [_match(r, b) for r, b in zip(reference, boxes)], axis=0)
+        name = method + "".join(f"/{k[0]}={v}" for k, v in options.items())
+        print(f"{name:>22} {elapsed / len(images):>8.2f} "
+              f"{peak / 2**20:>9.0f} {sum(map(len, boxes)) / len(images):>7.0f}"
+              f" {scores[0]:>7.3f} {scores[1]:>7.3f} {scores[2]:>6.3f}")
+
+
+def _annotated_pages(toml_config, n_pages, seed):
+    """
+    `n_pages` random pages with annotated blobs from `input_dir` in
+    `toml_config` and the boxes of their annotated blobs, or synthetic pages
+    with the boxes of their symbols if there are none
+    """
+    import numpy as np
+    import toml
+    from skimage import io
+
+    rng = np.random.default_rng(seed)
+    pages = []
+    try:
+        conf = toml.load(open(toml_config))
+        in_path = Path(conf['preprocessing']['input_dir'])
+        field = conf['data_entry']['annotation_field']
+        page_jsons = sorted(in_path.glob('**/*_nostaff.json'))
+    except (FileNotFoundError, KeyError):
+        page_jsons = []
+    for i in rng.permutation(len(page_jsons)):
+        page = json.load(open(page_jsons[i]))
+        boxes = []
+        for blob_json in page["blobs"]:
+            b = json.load(open(blob_json))
+            if b.get(field) is not None:
+                boxes.append((b["x0"], b["y0"], b["x1"], b["y1"]))
+        if boxes:
+            pages.append((io.imread(page["nostaff_path"]), boxes))
+        if len(pages) == n_pages:
+            break
+    if pages:
+        return pages, f"{len(pages)} pages, annotated blobs"
+    return [synthetic_page(rng) for _ in range(n_pages)
+            ], f"{n_pages} synthetic pages, drawn symbols"
+
+
+def bench_detectors(toml_config='config.toml',
+                    n_pages=5,
+                    detectors=("dog", "dog_pyramid", "cc"),
+                    seed=1993):
+    """
+    Runtime of the detectors and how many annotated blobs they recover: an
+    annotated box is recovered if a detected box has IoU >= 0.5 with it
+    (`recall`) or covers at least half of it (`covered`). `boxes` is the
+    mean number of detected boxes per page.
+    """
+    import numpy as np
+    import toml
+
+    from .detection import box_iou
+    from .preprocess import detect_boxes
+
+    try:
+        conf = toml.load(open(toml_config))['preprocessing']
+    except FileNotFoundError:
+        conf = {}
+    pages, desc = _annotated_pages(toml_config, n_pages, seed)
+    print(f"{desc}: {sum(len(b) for _, b in pages)} boxes")
+    print(f"{'detector':>12} {'s/page':>8} {'boxes':>7} {'recall':>7} "
+          f"{'covered':>8}")
+    for method in detectors:
+        elapsed, n_boxes, recalled, covered, total = 0, 0, 0, 0, 0
+        for image, ref in pages:
+            t0 = time.perf_counter()
+            boxes = detect_boxes(image, method, **conf.get(method, {}))
+            elapsed += time.perf_counter() - t0
+            n_boxes += len(boxes)
+            total += len(ref)
+            if not boxes:
+                continue
+            recalled += (box_iou(ref, boxes).max(axis=1) >= 0.5).sum()
+            # intersection over the area of the annotated box
+            ref = np.asarray(ref, dtype=np.float64)
+            boxes = np.asarray(boxes, dtype=np.float64)
+            lo = np.maximum(ref[:, None, :2], boxes[None, :, :2])
+            hi = np.minimum(ref[:, None, 2:], boxes[None, :, 2:])
+            inter = np.prod(np.clip(hi - lo, 0, None), axis=2)
+            area = np.prod(ref[:, 2:] - ref[:, :2], axis=1)
+            covered += (inter.max(axis=1) >= 0.5 * area).sum()
+        print(f"{method:>12} {elapsed / len(pages):>8.2f} "
+              f"{n_boxes / len(pages):>7.0f} {recalled / total:>7.3f} "
+              f"{covered / total:>8.3f}")
+
+
+def bench_tiled_detection(shape=(8000, 6000),
+                          tile_sizes=(1024, 2048),
+                          detectors=("dog_pyramid", "dog"),
+                          workers=None,
+                          seed=1993):
+    """
+    Latency of the detection on one large synthetic page (e.g. a fold-out)
+    whose left half is an empty margin, on the whole page and split in tiles
+    detected by a pool of `workers` processes (default: one per core), and
+    agreement of the tiled boxes with the whole-page ones (IoU >= 0.5)
+    """
+    import os
+    from concurrent.futures import ProcessPoolExecutor
+
+    import numpy as np
+
+    from .detection import box_iou, ink_integral, tiles
+    from .preprocess import detect_boxes
+
+    rng = np.random.default_rng(seed)
+    page, _ = synthetic_page(rng, shape, n_symbols=shape[0] * shape[1] //
+                              100000)
+    page[:, :shape[1] // 2] = 255
+    workers = workers or os.cpu_count()
+    print(f"{shape[0]}x{shape[1]} page, {workers} processes")
+    print(f"{'detector':>12} {'tile':>6} {'tiles':>6} {'skipped':>8} "
+          f"{'s':>8} {'agreement':>10}")
+    with ProcessPoolExecutor(workers) as executor:
+        for method in detectors:
+            t0 = time.perf_counter()
+            whole = detect_boxes(page, method)
+            print(f"{method:>12} {'-':>6} {1:>6} {0:>8} "
+                  f"{time.perf_counter() - t0:>8.2f} {1:>10.3f}")
+            for tile_size in tile_sizes:
+                margin = 4 * 50
+                ii = ink_integral(page)
+                all_tiles = tiles(page.shape, tile_size, margin)
+                skipped = sum(ii[r1, c1] - ii[r0, c1] - ii[r1, c0] +
+                              ii[r0, c0] < 1
+                              for _, (r0, c0, r1, c1) in all_tiles)
+                t0 = time.perf_counter()
+                tiled = detect_boxes(page,
+                                     method,
+                                     tile_size=tile_size,
+                                     executor=executor)
+                elapsed = time.perf_counter() - t0
+                agreement = (box_iou(whole, tiled).max(axis=1) >= 0.5).mean(
+                ) if whole and tiled else float(len(whole) == len(tiled))
+                print(f"{method:>12} {tile_size:>6} {len(all_tiles):>6} "
+                      f"{skipped:>8} {elapsed:>8.2f} {agreement:>10.3f}")
+
+
+def bench_features(n_pages=2, seed=1993):
+    """
+    Throughput in blobs/s of the per-blob reference features and of the
+    batched `FeatureExtractor`, and largest difference between the two
+    """
+    import numpy as np
+
+    from .features import FeatureExtractor, blob_features
+    from .preprocess import find_blobs
+
+    rng = np.random.default_rng(seed)
+    blobs = []
+    for _ in range(n_pages):
+        page, _ = synthetic_page(rng, (2000, 1500), 100)
+        blobs += [b.image for b in find_blobs(page, "cc")]
+
+    t0 = time.perf_counter()
+    ref = np.array([blob_features(b) for b in blobs])
+    t_ref = time.perf_counter() - t0
+    t0 = time.perf_counter()
+    fast = FeatureExtractor()(blobs)
+    t_fast = time.perf_counter() - t0
+    print(f"{len(blobs)} blobs: reference {len(blobs) / t_ref:.1f} blobs/s, "
+          f"FeatureExtractor {len(blobs) / t_fast:.1f} blobs/s, "
+          f"max difference {np.abs(ref - fast).max():.2g}")
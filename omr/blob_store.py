@@ -0,0 +1,176 @@
+"""
+A packed store of the blobs of a page, instead of one png and one json per
+blob
+
+Usage:
+    blob_store.py (<toml_config>)
+
+"""
+import os
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .journal import atomic_json_dump
+
+LOGGER = logging.getLogger(__name__)
+
+CROPS_FN = '__packed.npy'
+INDEX_FN = '__packed_index.npy'
+META_FN = '__packed.json'
+INDEX_DTYPE = np.dtype([('offset', '<i8'), ('h', '<i4'), ('w', '<i4'),
+                        ('id', '<i4'), ('x0', '<i4'), ('y0', '<i4'),
+                        ('x1', '<i4'), ('y1', '<i4')])
+
+
+def write_store(page_dir, crops, records):
+    """
+    Packs the blobs of a page in `page_dir`:
+    * `__packed.npy`: all the crops, flattened and concatenated
+    * `__packed_index.npy`: offset and shape of each crop in the buffer, id
+      and box of each blob
+    * `__packed.json`: the other fields of the blob jsons (path, parent,
+      annotations...) as columns, with None where a blob doesn't have them
+
+    `crops` are 2D arrays of the same dtype and `records` the contents of the
+    blob jsons, in the same order. The metadata is written last, so a store
+    without it is incomplete.
+    """
+    page_dir = Path(page_dir)
+    index = np.zeros(len(crops), dtype=INDEX_DTYPE)
+    offset = 0
+    for i, (crop, r) in enumerate(zip(crops, records)):
+        index[i] = (offset, crop.shape[0], crop.shape[1], r["id"], r["x0"],
+                    r["y0"], r["x1"], r["y1"])
+        offset += crop.size
+    dtype = crops[0].dtype if crops else np.uint16
+    buffer = np.empty(offset, dtype=dtype)
+    for crop, (o, h, w) in zip(crops, index[['offset', 'h', 'w']].tolist()):
+        buffer[o:o + h * w] = crop.ravel()
+
+    columns = {}
+    skip = set(INDEX_DTYPE.names)
+    for r in records:
+        for k in r:
+            if k not in skip:
+                columns.setdefault(k, None)
+    columns = {k: [r.get(k) for r in records] for k in columns}
+
+    for fn, array in ((CROPS_FN, buffer), (INDEX_FN, index)):
+        tmp = page_dir / f"{fn}.tmp.npy"
+        np.save(tmp, array)
+        os.replace(tmp, page_dir / fn)
+    atomic_json_dump({"columns": columns}, page_dir / META_FN)
+
+
+class BlobStore:
+    """
+    Reads the store of a page written by `write_store`. Crops are views of
+    the memory-mapped buffer, so reading one crop reads only its bytes.
+    """
+
+    def __init__(self, page_dir):
+        self.page_dir = Path(page_dir)
+        self.crops = np.load(self.page_dir / CROPS_FN, mmap_mode='r')
+        self.index = np.load(self.page_dir / INDEX_FN)
+        self._columns = None
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    @property
+    def columns(self):
+        """
+        The fields other than the id and the box, as a dict of lists
+        """
+        if self._columns is None:
+            self._columns = json.load(open(self.page_dir /
+                                           META_FN))["columns"]
+        return self._columns
+
+    def crop(self, i):
+        """
+        The image of the `i`-th blob, without copying it
+        """
+        offset, h, w = self.index[['offset', 'h', 'w']][i].tolist()
+        return self.crops[offset:offset + h * w].reshape(h, w)
+
+    def box(self, i):
+        return tuple(self.index[['x0', 'y0', 'x1', 'y1']][i].tolist())
+
+    def record(self, i):
+        """
+        The `i`-th blob as in its json file
+        """
+        r = {
+            k: self.index[k][i].item()
+            for k in ('id', 'x0', 'y0', 'x1', 'y1')
+        }
+        for k, v in self.columns.items():
+            if v[i] is not None:
+                r[k] = v[i]
+        return r
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.record(i), self.crop(i)
+
+
+def is_packed(page_dir):
+    """
+    True if `page_dir` has a store newer than all its blob jsons
+    """
+    page_dir = Path(page_dir)
+    try:
+        packed = os.stat(page_dir / META_FN).st_mtime_ns
+    except FileNotFoundError:
+        return False
+    return all(
+        os.stat(fn).st_mtime_ns <= packed
+        for fn in page_dir.glob('*_blob*.json'))
+
+
+def pack_page(page_dir):
+    """
+    Packs the blob pngs and jsons in `page_dir` (the layout written by
+    `omr.preprocess.process`); returns the number of blobs
+    """
+    from skimage import io
+
+    page_dir = Path(page_dir)
+    jsons = sorted(page_dir.glob('*_blob*.json'))
+    records = [json.load(open(fn)) for fn in jsons]
+    crops = [io.imread(fn.with_suffix('.png')) for fn in jsons]
+    write_store(page_dir, crops, records)
+    return len(records)
+
+
+def convert(blob_dir, n_jobs=10):
+    """
+    Packs all the pages under `blob_dir` whose store is missing or older than
+    their blob jsons (e.g. annotated after packing)
+    """
+    from joblib import Parallel, delayed
+    from tqdm import tqdm
+
+    page_dirs = {fn.parent for fn in Path(blob_dir).glob('**/*_blob*.json')}
+    todo = sorted(d for d in page_dirs if not is_packed(d))
+    LOGGER.info(f"packing {len(todo)}/{len(page_dirs)} pages")
+    n = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(pack_page)(d)
+                                                   for d in tqdm(todo))
+    print(f"{len(todo)} pages packed ({sum(n)} blobs), "
+          f"{len(page_dirs) - len(todo)} already up to date")
+
+
+def main(toml_config: str):
+    import toml
+    conf = toml.load(open(toml_config))
+    convert(conf['preprocessing']['blob_dir'])
+
+
+if __name__ == "__main__":
+
+    import sys
+    main(sys.argv[1])
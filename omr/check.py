@@ -9,10 +9,16 @@ def check_blob_jsons():
 
     config = toml.load(open('./config.toml'))
 
+    from .blob_store import BlobStore, INDEX_DTYPE, is_packed
+
     print("loading files...")
     files = list(
         Path(config['preprocessing']['blob_dir']).glob("**/*_blob*.json"))
 
+    # pages packed after their last annotation are read from the store
+    packed = {d for d in {f.parent for f in files} if is_packed(d)}
+    files = [f for f in files if f.parent not in packed]
+
     def _process(file):
         count = {}
         content = json.load(open(file))
@@ -21,7 +27,18 @@ def check_blob_jsons():
                 count[c] = 1
         return count
 
+    def _process_packed(page_dir):
+        store = BlobStore(page_dir)
+        count = {
+            k: len(store)
+            for k in INDEX_DTYPE.names if k not in ('offset', 'h', 'w')
+        }
+        for c, values in store.columns.items():
+            count[c] = sum(v is not None for v in values)
+        return count
+
     res = Parallel(n_jobs=10)(delayed(_process)(file) for file in tqdm(files))
+    res += [_process_packed(d) for d in tqdm(packed)]
 
     count = {}
     for d in res:
@@ -33,7 +50,7 @@ def check_blob_jsons():
 
     print("Number of files annotated for each field")
     pprint(count)
-    print(f"Total number of files: {len(files)}")
+    print(f"Total number of files: {count.get('id', 0)}")
 
 
 def plot_normal_indices():
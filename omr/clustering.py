@@ -0,0 +1,259 @@
+"""
+Clustering of the blobs of the whole archive, from the cached features (see
+`omr.features`), with algorithms that see a batch of blobs at a time
+
+Usage:
+    clustering.py (<toml_config>)
+
+"""
+import json
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .journal import atomic_json_dump
+
+LOGGER = logging.getLogger(__name__)
+
+CLUSTERS_FN = 'clusters.npy'
+REPRESENTATIVES_FN = 'representatives.json'
+CLUSTERS_DTYPE = np.dtype([('cluster', '<i4'), ('distance', '<f4')])
+
+
+def page_features(manifest):
+    """
+    For each page of `manifest` (an `omr.manifest.Manifest`), yields the
+    indices of its blobs in the manifest and their features, read from the
+    cache of the page; blobs without cached features are left out.
+    """
+    from .features import CACHE_FN
+
+    order = np.argsort(manifest.blobs['dir'], kind='stable')
+    dirs = manifest.blobs['dir'][order]
+    starts = np.flatnonzero(np.r_[True, dirs[1:] != dirs[:-1]])
+    for idx in np.split(order, starts[1:]):
+        if idx.size == 0:
+            continue
+        fname = Path(manifest.dir_paths[manifest.blobs['dir'][idx[0]]],
+                     CACHE_FN)
+        if not fname.exists():
+            continue
+        table = np.load(fname)
+        cache = {
+            b: i
+            for i, b in enumerate(table[['x0', 'y0', 'x1', 'y1']].tolist())
+        }
+        rows = [
+            cache.get(b)
+            for b in manifest.blobs[['x0', 'y0', 'x1', 'y1']][idx].tolist()
+        ]
+        found = np.array([r is not None for r in rows], dtype=bool)
+        if not found.any():
+            continue
+        yield idx[found], table['features'][[r for r in rows
+                                             if r is not None]]
+
+
+def _batches(pages, batch_size):
+    """
+    Groups the `(indices, features)` of `pages` in batches of about
+    `batch_size` blobs
+    """
+    idx, data, n = [], [], 0
+    for i, x in pages:
+        idx.append(i)
+        data.append(x)
+        n += i.size
+        if n >= batch_size:
+            yield np.concatenate(idx), np.concatenate(data)
+            idx, data, n = [], [], 0
+    if n:
+        yield np.concatenate(idx), np.concatenate(data)
+
+
+def fit(manifest,
+        n_clusters=1000,
+        n_components=10,
+        batch_size=4096,
+        epochs=3,
+        random_state=1992):
+    """
+    Clusters all the blobs of `manifest` with the same steps as
+    `omr.preprocess.cluster_blobs` (standardization, PCA, clustering), each
+    fitted one batch of `batch_size` blobs at a time: `StandardScaler` and
+    `IncrementalPCA` on the features streamed from the page caches, then
+    `MiniBatchKMeans` on the projected blobs, which are kept in memory
+    (`n_components` floats per blob), for `epochs` shuffled passes.
+
+    Memory does not depend on the number of pages but only on the number of
+    blobs, linearly, and time is linear in both.
+
+    Returns a table aligned with `manifest.blobs` with the cluster of each
+    blob (-1 for blobs without features) and its distance from the center of
+    its cluster.
+    """
+    from sklearn.cluster import MiniBatchKMeans
+    from sklearn.decomposition import IncrementalPCA
+    from sklearn.preprocessing import StandardScaler
+
+    scaler = StandardScaler()
+    for _, x in page_features(manifest):
+        scaler.partial_fit(x)
+    if not hasattr(scaler, 'mean_'):
+        raise RuntimeError("no cached features, run `pdm features` first")
+
+    pca = IncrementalPCA(n_components=n_components)
+    rest = None
+    for _, x in _batches(page_features(manifest), batch_size):
+        # every batch must have at least `n_components` blobs
+        if rest is not None:
+            x = np.concatenate([rest, x])
+        if x.shape[0] < n_components:
+            rest = x
+            continue
+        rest = None
+        pca.partial_fit(scaler.transform(x))
+
+    idx, data = [], []
+    for i, x in _batches(page_features(manifest), batch_size):
+        idx.append(i)
+        data.append(pca.transform(scaler.transform(x)).astype(np.float32))
+    idx, data = np.concatenate(idx), np.concatenate(data)
+    LOGGER.info(f"clustering: {idx.size}/{len(manifest)} blobs with features")
+
+    n_clusters = min(n_clusters, idx.size)
+    kmeans = MiniBatchKMeans(n_clusters=n_clusters,
+                             batch_size=batch_size,
+                             random_state=random_state,
+                             n_init=1)
+    rng = np.random.default_rng(random_state)
+    for _ in range(epochs):
+        perm = rng.permutation(idx.size)
+        for start in range(0, idx.size, batch_size):
+            batch = data[perm[start:start + batch_size]]
+            # the first batch initializes the centers
+            if batch.shape[0] >= n_clusters or hasattr(
+                    kmeans, 'cluster_centers_'):
+                kmeans.partial_fit(batch)
+    if not hasattr(kmeans, 'cluster_centers_'):
+        kmeans.partial_fit(data)
+
+    out = np.empty(len(manifest), dtype=CLUSTERS_DTYPE)
+    out['cluster'] = -1
+    out['distance'] = np.nan
+    for start in range(0, idx.size, batch_size):
+        batch = data[start:start + batch_size]
+        dist = kmeans.transform(batch)
+        best = np.argmin(dist, axis=1)
+        out['cluster'][idx[start:start + batch_size]] = best
+        out['distance'][idx[start:start +
+                            batch_size]] = dist[np.arange(best.size), best]
+    return out
+
+
+def representatives(clusters):
+    """
+    The index of the blob closest to the center of each cluster, as a dict
+    from cluster to index in the manifest
+    """
+    valid = np.flatnonzero(clusters['cluster'] >= 0)
+    order = valid[np.lexsort(
+        (clusters['distance'][valid], clusters['cluster'][valid]))]
+    first = np.r_[True, np.diff(clusters['cluster'][order]) != 0]
+    return dict(zip(clusters['cluster'][order[first]].tolist(),
+                    order[first].tolist()))
+
+
+def write_representatives(manifest, clusters, fname):
+    """
+    Writes in `fname` the clusters from the largest, each with its size and
+    the json of its representative (see `representatives`), so that a
+    cluster can be annotated by looking at one blob. Returns the list.
+    """
+    sizes = np.bincount(clusters['cluster'][clusters['cluster'] >= 0])
+    out = [{
+        "cluster": c,
+        "size": int(sizes[c]),
+        "blob": manifest.path(i)
+    } for c, i in representatives(clusters).items()]
+    out.sort(key=lambda r: -r["size"])
+    atomic_json_dump(out, fname)
+    return out
+
+
+def write_clusters(manifest, clusters, field="archive_cluster", n_jobs=10):
+    """
+    Writes the cluster of each blob in `field` of its json; jsons whose
+    cluster didn't change are not rewritten. Returns the number of jsons
+    written.
+
+    Each json is read, modified and replaced without any coordination with
+    the data-entry server, whose annotations saved in the meantime would be
+    lost: the server must be stopped.
+    """
+    from joblib import Parallel, delayed
+
+    def write(fname, cluster):
+        data = json.load(open(fname))
+        if data.get(field) == cluster:
+            return 0
+        data[field] = cluster
+        atomic_json_dump(data, fname)
+        return 1
+
+    jobs = (delayed(write)(fname, c)
+            for fname, c in zip(manifest, clusters['cluster'].tolist())
+            if c >= 0)
+    return sum(Parallel(n_jobs=n_jobs, prefer='threads')(jobs))
+
+
+def cluster_archive(blob_dir,
+                    n_clusters=1000,
+                    n_components=10,
+                    batch_size=4096,
+                    epochs=3,
+                    field="archive_cluster"):
+    """
+    Clusters all the blobs under `blob_dir`, saves the clusters in
+    `__manifest/clusters.npy` (aligned with the manifest) and their
+    representatives in `__manifest/representatives.json`, and writes them in
+    the blob jsons (the data-entry server must be stopped, see
+    `write_clusters`)
+    """
+    import time
+
+    from .manifest import MANIFEST_DIR, _save, load
+
+    manifest = load(blob_dir)
+    t0 = time.perf_counter()
+    clusters = fit(manifest, n_clusters, n_components, batch_size, epochs)
+    elapsed = time.perf_counter() - t0
+    _save(Path(blob_dir) / MANIFEST_DIR / CLUSTERS_FN, clusters)
+    reps = write_representatives(
+        manifest, clusters,
+        Path(blob_dir) / MANIFEST_DIR / REPRESENTATIVES_FN)
+    n_written = write_clusters(manifest, clusters, field)
+    found = clusters['cluster'][clusters['cluster'] >= 0]
+    print(f"{found.size} blobs in {np.unique(found).size} clusters, "
+          f"{elapsed:.1f} s, {n_written} jsons updated")
+    print("largest clusters and their representatives:")
+    for r in reps[:10]:
+        print(f"{r['cluster']:>6} {r['size']:>8} {r['blob']}")
+
+
+def main(toml_config: str):
+    import toml
+    conf = toml.load(open(toml_config))
+    c = conf.get('clustering', {})
+    cluster_archive(conf['preprocessing']['blob_dir'],
+                    n_clusters=c.get('n_clusters', 1000),
+                    n_components=c.get('n_components', 10),
+                    batch_size=c.get('batch_size', 4096),
+                    epochs=c.get('epochs', 3))
+
+
+if __name__ == "__main__":
+
+    import sys
+    main(sys.argv[1])
@@ -0,0 +1,406 @@
+"""
+Export of the annotated blobs as the binary (relevant/irrelevant) and the
+multiclass datasets used to train the models, in the layout of
+`Create_Dataset.ipynb`, reading the blob jsons only once and, at the next
+exports, only those annotated since then
+
+Usage:
+    dataset.py (<toml_config>)
+
+"""
+import os
+import json
+import errno
+import shutil
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from .journal import atomic_json_dump
+
+LOGGER = logging.getLogger(__name__)
+
+CLASSES_RELEVANT = [5, 6, 7, 8, 9, 10, 11, 12, 14, 16]
+CLASSES_IRRELEVANT = [0, 1, 2, 3, 4, 15, 17]
+CLASSES = CLASSES_RELEVANT + CLASSES_IRRELEVANT
+CLASS_NAMES = {
+    5: "Pause (full or almost)",
+    6: "Single note (with at least the head)",
+    7: "Multiple Notes (with at least the head)",
+    8: "Single chord (with at least heads)",
+    9: "Multiple chords (with at least heads)",
+    10: "Accidental(s) (whole or nearly so)",
+    11: "Key(s) (whole(s) or nearly)",
+    12: "Embellishment(s) (whole(s) or nearly)",
+    14: "More categories (with at least one musical sign)",
+    16: "Other (with at least one musical sign)",
+    0: "Page border",
+    1: "Erasure",
+    2: "Blurr",
+    3: "Printed Text",
+    4: "Manuscript Text",
+    15: "More categories (no musical signs)",
+    17: "Other (without musical markings)"
+}
+# classes that are always merged with each other, with the merged name
+MERGED_PAIRS = {
+    (7, 9): "Multiple notes or chords",
+    (2, 15): "Blurr or multiple categories (no music signs)"
+}
+REMAINING = "Remaining"
+BINARY_NAMES = ["relevant", "irrelevant"]
+BINARY_DIR = Path('binary_dataset') / 'data'
+MULTICLASS_DIR = Path('multiclass_dataset') / 'data'
+
+# for each blob of the last export (their paths, relative to the blob
+# directory, are in `__export_paths.npy`): modification time of the json
+# when it was last read, its label (-1 if not annotated) and where the blob
+# is in the datasets (-1 if it isn't)
+STATE_FN = '__export.npy'
+STATE_DTYPE = np.dtype([('mtime', '<i8'), ('label', '<i2'), ('binary', 'i1'),
+                        ('multiclass', '<i2')])
+PATHS_FN = '__export_paths.npy'
+META_FN = '__export.json'
+# `ioctl` of Linux that shares the bytes of two files (btrfs, xfs...)
+FICLONE = 0x40049409
+
+
+def _label(value, fname):
+    if value is None:
+        return -1
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        LOGGER.warning(f"dataset: {fname} has a non-integer label {value!r}")
+        return -1
+
+
+def _read_label(fname, field):
+    return _label(json.load(open(fname)).get(field), fname)
+
+
+def _packed_labels(page_dir, field):
+    """
+    The modification time of the `omr.blob_store` store of `page_dir` and the
+    labels of its blobs by json name, or None if the page isn't packed
+    """
+    from .blob_store import META_FN
+
+    fname = os.path.join(page_dir, META_FN)
+    try:
+        mtime = os.stat(fname).st_mtime_ns
+        columns = json.load(open(fname))["columns"]
+    except FileNotFoundError:
+        return None
+    values = columns.get(field, [None] * len(columns["path"]))
+    return mtime, {
+        os.path.basename(png)[:-len('.png')] + '.json': v
+        for png, v in zip(columns["path"], values)
+    }
+
+
+def _scan(paths, state, field):
+    """
+    The modification time and the label of the blob jsons in `paths`,
+    reading only the jsons modified since `state` was recorded. Blobs of
+    packed pages whose json is not newer than the store are read from the
+    store, once per page.
+    """
+    out = np.array(state)
+    n_read = 0
+    stores = {}
+    for i, p in enumerate(paths):
+        mtime = os.stat(p).st_mtime_ns
+        if mtime != out['mtime'][i]:
+            out['mtime'][i] = mtime
+            page_dir, name = os.path.split(p)
+            if page_dir not in stores:
+                stores[page_dir] = _packed_labels(page_dir, field)
+            packed = stores[page_dir]
+            if packed is not None and mtime <= packed[0] and name in packed[1]:
+                out['label'][i] = _label(packed[1][name], p)
+            else:
+                out['label'][i] = _read_label(p, field)
+                n_read += 1
+    return out[['mtime', 'label']], n_read
+
+
+def scan(paths, state, field, chunk_size=1024, n_jobs=10):
+    """
+    Reads the labels of all the blob jsons in `paths`, in parallel, skipping
+    those not modified since `state` (see `STATE_DTYPE`) was recorded.
+    Returns the new modification times and labels and the number of jsons
+    read.
+    """
+    from joblib import Parallel, delayed
+
+    starts = range(0, len(paths), chunk_size)
+    res = Parallel(n_jobs=n_jobs, prefer='threads')(
+        delayed(_scan)(paths[s:s + chunk_size], state[s:s + chunk_size],
+                       field) for s in starts)
+    if not res:
+        return np.empty(0, dtype=STATE_DTYPE[['mtime', 'label']]), 0
+    return np.concatenate([r for r, _ in res]), sum(n for _, n in res)
+
+
+def class_counts(labels):
+    """
+    The number of blobs of each class in `CLASSES`
+    """
+    return {c: int(np.count_nonzero(labels == c)) for c in CLASSES}
+
+
+def merged_classes(counts, ratio=0.75):
+    """
+    The classes merged in the `"Remaining"` class of the multiclass dataset:
+    those with less than `ratio` times the median number of blobs, where the
+    classes of `MERGED_PAIRS` count as the sum of the two, so that both or
+    none of them are merged
+    """
+    m = np.median([counts[c] for c in CLASSES])
+    pooled = dict(counts)
+    for a, b in MERGED_PAIRS:
+        pooled[a] = pooled[b] = counts[a] + counts[b]
+    return [c for c in CLASSES if pooled[c] < ratio * m]
+
+
+def multiclass_name(label, merged):
+    """
+    The class of the multiclass dataset of the blobs annotated with `label`
+    """
+    if label in merged:
+        return REMAINING
+    for pair, name in MERGED_PAIRS.items():
+        if label in pair:
+            return name
+    return CLASS_NAMES[label]
+
+
+def link(src, dst, mode="hardlink"):
+    """
+    Makes `dst` a copy of `src`:
+    * `"hardlink"`: another name of the same file (a copy across file
+      systems)
+    * `"reflink"`: a file sharing the bytes of `src` until one of the two is
+      modified, where the file system supports it (a copy elsewhere)
+    * `"symlink"`: a relative symbolic link
+    * `"copy"`: a copy
+    """
+    src, dst = Path(src), Path(dst)
+    tmp = dst.with_name(f".{dst.name}.tmp")
+    tmp.unlink(missing_ok=True)
+    if mode == "hardlink":
+        try:
+            os.link(src, tmp)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+            shutil.copyfile(src, tmp)
+    elif mode == "reflink":
+        with open(src, 'rb') as fs, open(tmp, 'wb') as fd:
+            try:
+                import fcntl
+                fcntl.ioctl(fd.fileno(), FICLONE, fs.fileno())
+            except (ImportError, OSError):
+                shutil.copyfileobj(fs, fd)
+    elif mode == "symlink":
+        os.symlink(os.path.relpath(src, dst.parent), tmp)
+    elif mode == "copy":
+        shutil.copyfile(src, tmp)
+    else:
+        raise ValueError(f"unknown link mode {mode!r}")
+    os.replace(tmp, dst)
+
+
+def _lookup(labels, table):
+    out = np.full(labels.shape, -1, dtype=np.int16)
+    ok = (labels >= 0) & (labels < len(table))
+    out[ok] = table[labels[ok]]
+    return out
+
+
+def export(blob_dir,
+           output_dir="./data",
+           field="annotazione1",
+           mode="hardlink",
+           merge_ratio=0.75,
+           n_jobs=10):
+    """
+    Exports the blobs under `blob_dir` annotated in `field` to the binary
+    and multiclass datasets in `output_dir` (see `link` for `mode`).
+
+    The state of the export is kept in `output_dir/__export.npy`, with the
+    paths of its blobs in `output_dir/__export_paths.npy`: at the next
+    export only the jsons modified since then are read and only the blobs
+    whose class changed (new annotations, or classes merged differently) or
+    that were added to or removed from the archive are linked again. Blobs
+    whose png is missing are left out and tried again at the next export.
+    If the options change, the datasets are exported again from scratch.
+    """
+    from joblib import Parallel, delayed
+
+    from .manifest import _save, load
+
+    blob_dir, output_dir = Path(blob_dir), Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    manifest = load(blob_dir, n_jobs)
+    paths = list(manifest)
+    prefix = len(str(manifest.root)) + 1
+    rel_paths = np.array([p[prefix:].encode() for p in paths])
+
+    state_fn, meta_fn = output_dir / STATE_FN, output_dir / META_FN
+    paths_fn = output_dir / PATHS_FN
+    meta = json.load(open(meta_fn)) if meta_fn.exists() else None
+    old = np.zeros(len(paths), dtype=STATE_DTYPE)
+    old['label'] = old['binary'] = old['multiclass'] = -1
+    gone = np.empty(0, dtype=STATE_DTYPE)
+    gone_pngs = []
+    if meta is not None and (meta.get('field'), meta.get('mode')) == (field,
+                                                                      mode):
+        # the previous state, realigned with the current manifest by path
+        state, state_paths = np.load(state_fn), np.load(paths_fn)
+        positions = {p: i for i, p in enumerate(state_paths.tolist())}
+        found = np.array([positions.pop(p, -1) for p in rel_paths.tolist()],
+                         dtype=np.int64)
+        old[found >= 0] = state[found[found >= 0]]
+        rest = np.fromiter(positions.values(), dtype=np.int64)
+        gone = state[rest]
+        gone_pngs = [
+            os.path.basename(p.decode())[:-len('.json')]
+            for p in state_paths[rest].tolist()
+        ]
+        old_names = meta['multiclass']
+    else:
+        if meta is not None:
+            LOGGER.info("dataset: the options changed, exporting from scratch")
+            for d in (BINARY_DIR, MULTICLASS_DIR):
+                shutil.rmtree(output_dir / d, ignore_errors=True)
+        old_names = []
+
+    scanned, n_read = scan(paths, old, field, n_jobs=n_jobs)
+    labels = scanned['label']
+    counts = class_counts(labels)
+    merged = merged_classes(counts, merge_ratio)
+    names = list(dict.fromkeys(multiclass_name(c, merged) for c in CLASSES))
+
+    binary_table = np.full(max(CLASSES) + 1, -1, dtype=np.int16)
+    binary_table[CLASSES_RELEVANT] = 0
+    binary_table[CLASSES_IRRELEVANT] = 1
+    multiclass_table = np.full(max(CLASSES) + 1, -1, dtype=np.int16)
+    for c in CLASSES:
+        multiclass_table[c] = names.index(multiclass_name(c, merged))
+    new = np.empty(len(paths), dtype=STATE_DTYPE)
+    new['mtime'], new['label'] = scanned['mtime'], labels
+    new['binary'] = _lookup(labels, binary_table)
+    new['multiclass'] = _lookup(labels, multiclass_table)
+
+    n_unknown = int(np.count_nonzero((labels >= 0) & (new['binary'] < 0)))
+    # the datasets are flat: only the first blob with a given png name
+    pngs = [os.path.basename(p)[:-len('.json')] for p in paths]
+    exported = np.flatnonzero(new['binary'] >= 0)
+    _, first = np.unique(np.array(pngs, dtype=object)[exported].astype(str),
+                         return_index=True)
+    duplicates = np.setdiff1d(exported, exported[first])
+    new['binary'][duplicates] = new['multiclass'][duplicates] = -1
+
+    # where the blobs were, with the classes of the new export
+    old_table = np.array([names.index(n) if n in names else -2
+                          for n in old_names] + [-1],
+                         dtype=np.int16)
+    old_multiclass = old_table[old['multiclass']]
+    changed = np.flatnonzero((new['binary'] != old['binary'])
+                             | (new['multiclass'] != old_multiclass))
+
+    for n in BINARY_NAMES:
+        (output_dir / BINARY_DIR / n).mkdir(parents=True, exist_ok=True)
+    for n in names:
+        (output_dir / MULTICLASS_DIR / n).mkdir(parents=True, exist_ok=True)
+
+    def remove(record, png):
+        png = f"{png}.png"
+        (output_dir / BINARY_DIR / BINARY_NAMES[record['binary']] /
+         png).unlink(missing_ok=True)
+        (output_dir / MULTICLASS_DIR / old_names[record['multiclass']] /
+         png).unlink(missing_ok=True)
+
+    def add(i):
+        png = f"{pngs[i]}.png"
+        src = paths[i][:-len('.json')] + '.png'
+        dst = [
+            output_dir / BINARY_DIR / BINARY_NAMES[new['binary'][i]] / png,
+            output_dir / MULTICLASS_DIR / names[new['multiclass'][i]] / png
+        ]
+        try:
+            for d in dst:
+                link(src, d, mode)
+        except FileNotFoundError:
+            for d in dst:
+                d.unlink(missing_ok=True)
+            return False
+        return True
+
+    # all the removals first, as a png name can pass from a blob to another
+    parallel = Parallel(n_jobs=n_jobs, prefer='threads')
+    removed = [i for i in changed.tolist() if old['binary'][i] >= 0]
+    parallel(delayed(remove)(old[i], pngs[i]) for i in removed)
+    parallel(
+        delayed(remove)(r, png) for r, png in zip(gone, gone_pngs)
+        if r['binary'] >= 0)
+    added = [i for i in changed.tolist() if new['binary'][i] >= 0]
+    linked = parallel(delayed(add)(i) for i in added)
+    missing = [i for i, ok in zip(added, linked) if not ok]
+    # not in the datasets, so they are linked again at the next export
+    new['binary'][missing] = new['multiclass'][missing] = -1
+    for d in (output_dir / MULTICLASS_DIR).iterdir():
+        if d.name not in names and d.is_dir() and not any(d.iterdir()):
+            d.rmdir()
+
+    _save(state_fn, new)
+    _save(paths_fn, rel_paths)
+    atomic_json_dump(
+        {
+            'field': field,
+            'mode': mode,
+            'multiclass': names,
+            'merged': merged,
+            'counts': {str(c): n for c, n in counts.items()}
+        }, meta_fn)
+
+    print(f"{len(paths)} blobs, {n_read} jsons read, "
+          f"{int(np.count_nonzero(labels >= 0))} annotated, "
+          f"{len(added) - len(missing)} blobs linked, "
+          f"{len(removed) + int(np.count_nonzero(gone['binary'] >= 0))} "
+          "removed")
+    if missing:
+        LOGGER.warning(f"dataset: {len(missing)} blobs without png left out, "
+                       f"e.g. {paths[missing[0]][:-len('.json')]}.png")
+        print(f"{len(missing)} blobs left out, their png is missing")
+    if n_unknown:
+        print(f"{n_unknown} blobs with unknown labels left out")
+    if len(duplicates):
+        print(f"{len(duplicates)} blobs left out, with the same png name as "
+              "another blob")
+    print("Merging classes:", [CLASS_NAMES[c] for c in merged])
+    for k, n in enumerate(BINARY_NAMES):
+        print(f"{n}: {int(np.count_nonzero(new['binary'] == k))}")
+    for k, n in enumerate(names):
+        print(f"{n}: {int(np.count_nonzero(new['multiclass'] == k))}")
+
+
+def main(toml_config: str):
+    import toml
+    conf = toml.load(open(toml_config))
+    d = conf.get('dataset', {})
+    export(conf['preprocessing']['blob_dir'],
+           d.get('output_dir', './data'),
+           conf['data_entry']['annotation_field'],
+           d.get('link', 'hardlink'),
+           d.get('merge_ratio', 0.75),
+           conf['preprocessing'].get('cpu_workers') or 10)
+
+
+if __name__ == "__main__":
+
+    import sys
+    main(sys.argv[1])
@@ -0,0 +1,218 @@
+"""
+Blob detectors usable as the `method` of `omr.preprocess.find_blobs`. They
+all take the image and `min_sigma`, `max_sigma` and `threshold` and return an
+array with one `(row, col, sigma)` row per blob, as `skimage.feature.blob_dog`
+does, or with one bounding box `(x0, y0, x1, y1)` per blob (rows first, end
+excluded).
+"""
+import numpy as np
+from scipy import ndimage
+from skimage import feature, transform, util
+
+
+def blob_dog_pyramid(image,
+                     min_sigma=10,
+                     max_sigma=50,
+                     threshold=0.1,
+                     downscale=4,
+                     refine=True,
+                     sigma_ratio=1.6):
+    """
+    `blob_dog` on the image downscaled by `downscale`, whose scale space is
+    `downscale`^2 times smaller: blobs with sigma >= 10 px are still visible
+    after a 2-4x decimation.
+
+    If `refine` is True, each candidate is then searched again at full
+    resolution, in a window around it and only at the scales next to its own,
+    to recover the precise position and size; candidates not found again are
+    kept as they are.
+    """
+    image = util.img_as_float(image)
+    small = transform.downscale_local_mean(image, (downscale, downscale))
+    blobs = feature.blob_dog(small,
+                             min_sigma=min_sigma / downscale,
+                             max_sigma=max_sigma / downscale,
+                             threshold=threshold,
+                             sigma_ratio=sigma_ratio)
+    # centers of the pooled pixels
+    blobs = blobs * downscale + [(downscale - 1) / 2, (downscale - 1) / 2, 0]
+    if not refine:
+        return blobs
+
+    out = np.empty_like(blobs)
+    for i, (r, c, s) in enumerate(blobs):
+        out[i] = _refine(image, r, c, s, min_sigma, max_sigma, threshold,
+                         sigma_ratio, downscale)
+    return out
+
+
+def _refine(image, r, c, s, min_sigma, max_sigma, threshold, sigma_ratio,
+            downscale):
+    # the gaussian of the largest scale must fit in the window
+    half = int(3 * min(max_sigma, s * sigma_ratio)) + downscale
+    r0, c0 = max(0, int(r) - half), max(0, int(c) - half)
+    window = image[r0:int(r) + half + 1, c0:int(c) + half + 1]
+    found = feature.blob_dog(window,
+                             min_sigma=max(min_sigma, s / sigma_ratio),
+                             max_sigma=min(max_sigma, s * sigma_ratio),
+                             threshold=threshold,
+                             sigma_ratio=sigma_ratio)
+    if found.shape[0] == 0:
+        return r, c, s
+    found[:, 0] += r0
+    found[:, 1] += c0
+    dist = np.hypot(found[:, 0] - r, found[:, 1] - c)
+    best = np.argmin(dist)
+    if dist[best] > max(s, downscale):
+        return r, c, s
+    return found[best]
+
+
+def connected_components(image,
+                         min_sigma=10,
+                         max_sigma=50,
+                         threshold=0.1,
+                         ink_threshold=128,
+                         merge_distance=8):
+    """
+    The bounding boxes of the groups of ink pixels (darker than
+    `ink_threshold`), in time linear in the number of pixels: pixels closer
+    than `merge_distance` are grouped, so that the parts of a symbol
+    separated by the staff removal end up in the same box, and groups whose
+    boxes are smaller than `min_sigma` on both sides are dropped as noise.
+
+    Boxes are tight around the ink, instead of the squares around the circles
+    found by `blob_dog`. `max_sigma` and `threshold` are not used.
+    """
+    if image.dtype != np.uint8:
+        image = util.img_as_ubyte(image)
+    ink = image < ink_threshold
+    if merge_distance > 0:
+        # dilation with a square, with a separable box filter
+        near = ndimage.uniform_filter(ink.astype(np.float32),
+                                      2 * merge_distance + 1) > 1e-6
+    else:
+        near = ink
+    labels, _ = ndimage.label(near)
+    # boxes of the ink only, not of the dilated groups
+    labels[~ink] = 0
+    boxes = np.array([(sl[0].start, sl[1].start, sl[0].stop, sl[1].stop)
+                      for sl in ndimage.find_objects(labels)
+                      if sl is not None],
+                     dtype=np.int64).reshape(-1, 4)
+    size = np.maximum(boxes[:, 2] - boxes[:, 0], boxes[:, 3] - boxes[:, 1])
+    return boxes[size >= min_sigma]
+
+
+DETECTORS = {
+    "dog": feature.blob_dog,
+    "dog_pyramid": blob_dog_pyramid,
+    "cc": connected_components
+}
+
+
+def ink_integral(image, ink_threshold=128):
+    """
+    The integral image of the ink pixels (darker than `ink_threshold`), with
+    a leading row and column of zeros: the ink in `image[r0:r1, c0:c1]` is
+    `ii[r1, c1] - ii[r0, c1] - ii[r1, c0] + ii[r0, c0]`
+    """
+    if image.dtype != np.uint8:
+        image = util.img_as_ubyte(image)
+    ii = np.zeros((image.shape[0] + 1, image.shape[1] + 1), dtype=np.int32)
+    np.cumsum(image < ink_threshold, axis=0, dtype=np.int32, out=ii[1:, 1:])
+    np.cumsum(ii[1:, 1:], axis=1, out=ii[1:, 1:])
+    return ii
+
+
+def tiles(shape, tile_size, margin):
+    """
+    The tiles covering an image of `shape`: each tile is a `tile_size` core,
+    `(r0, c0, r1, c1)`, plus `margin` pixels on each side, clipped to the
+    image
+    """
+    out = []
+    for r0 in range(0, shape[0], tile_size):
+        for c0 in range(0, shape[1], tile_size):
+            r1, c1 = min(shape[0], r0 + tile_size), min(shape[1],
+                                                         c0 + tile_size)
+            out.append(((r0, c0, r1, c1),
+                        (max(0, r0 - margin), max(0, c0 - margin),
+                         min(shape[0], r1 + margin), min(shape[1],
+                                                         c1 + margin))))
+    return out
+
+
+def _detect_tile(method, window, offset, core, options):
+    if isinstance(method, str):
+        method = DETECTORS[method]
+    found = np.asarray(method(window, **options), dtype=np.float64)
+    if found.shape[0] == 0:
+        return found
+    found[:, 0] += offset[0]
+    found[:, 1] += offset[1]
+    if found.shape[1] == 4:
+        found[:, 2] += offset[0]
+        found[:, 3] += offset[1]
+        center = (found[:, :2] + found[:, 2:]) / 2
+    else:
+        center = found[:, :2]
+    # a blob found in the margin of two tiles belongs to the tile whose core
+    # contains its center
+    own = ((center[:, 0] >= core[0]) & (center[:, 0] < core[2]) &
+           (center[:, 1] >= core[1]) & (center[:, 1] < core[3]))
+    return found[own]
+
+
+def detect_tiled(image,
+                 method,
+                 tile_size=2048,
+                 executor=None,
+                 min_ink=1,
+                 **options):
+    """
+    Runs `method` (a callable or a name in `DETECTORS`) on overlapping tiles
+    of `image`, in `executor` if given, and returns all the blobs found in
+    the same format as `method`.
+
+    Tiles overlap by `4 * max_sigma`, the support of the largest gaussian,
+    so that blobs close to the seams are found as on the whole image; each
+    blob is kept only by the tile whose core contains its center. Tiles
+    (with their margin) with fewer than `min_ink` ink pixels (darker than
+    the `ink_threshold` option, or 128) are skipped, with an integral image.
+    """
+    margin = int(np.ceil(4 * options.get('max_sigma', 50)))
+    ii = None
+    if min_ink > 0:
+        ii = ink_integral(image, options.get('ink_threshold', 128))
+    jobs = []
+    for core, (r0, c0, r1, c1) in tiles(image.shape, tile_size, margin):
+        if ii is not None and (ii[r1, c1] - ii[r0, c1] - ii[r1, c0] +
+                               ii[r0, c0]) < min_ink:
+            continue
+        args = (method, image[r0:r1, c0:c1], (r0, c0), core, options)
+        if executor is None:
+            jobs.append(_detect_tile(*args))
+        else:
+            jobs.append(executor.submit(_detect_tile, *args))
+    found = [j if executor is None else j.result() for j in jobs]
+    found = [f for f in found if f.shape[0]]
+    if not found:
+        return np.empty((0, 3))
+    return np.concatenate(found)
+
+
+def box_iou(a, b):
+    """
+    The intersection over union of each pair of boxes `(x0, y0, x1, y1)` in
+    `a` and `b`, as a `len(a) x len(b)` matrix
+    """
+    a = np.asarray(a, dtype=np.float64).reshape(-1, 4)
+    b = np.asarray(b, dtype=np.float64).reshape(-1, 4)
+    lo = np.maximum(a[:, None, :2], b[None, :, :2])
+    hi = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(hi - lo, 0, None), axis=2)
+    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
+    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0)
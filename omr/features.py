@@ -0,0 +1,303 @@
+"""
+The feature vectors of the blobs used for clustering, computed in batches and
+cached next to the blobs
+
+Usage:
+    features.py (<toml_config>)
+
+"""
+import os
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+from scipy import fft, ndimage
+from skimage import draw, exposure, feature, transform, util
+
+LOGGER = logging.getLogger(__name__)
+
+lbp_radius = 3
+lbp_n_points = 8 * lbp_radius
+RADII = (3, 6, 12, 24, 48)
+N_FEATURES = 41
+# bump it when the features change, so that the caches are rebuilt
+FEATURES_VERSION = 1
+CACHE_FN = f'__features_v{FEATURES_VERSION}.npy'
+CACHE_DTYPE = np.dtype([('x0', '<i4'), ('y0', '<i4'), ('x1', '<i4'),
+                        ('y1', '<i4'), ('features', '<f8', (N_FEATURES, ))])
+
+
+def blob_features(blob):
+    """
+    The features of one blob: Hough peaks of circles and lines, histograms
+    of LBP variance and of intensity and size. This is the reference
+    implementation, `FeatureExtractor` computes the same values faster.
+    """
+    # circular Hough peaks
+    hspaces = transform.hough_circle(blob, RADII)
+    peaks, _, _, _ = transform.hough_circle_peaks(hspaces,
+                                                  RADII,
+                                                  threshold=0,
+                                                  num_peaks=2)
+    cpeaks = np.zeros(10)
+    cpeaks[:peaks.shape[0]] = peaks
+    # line Hough peaks
+    hspaces, angles, dist = transform.hough_line(blob)
+    peaks, _, _ = transform.hough_line_peaks(hspaces,
+                                             angles,
+                                             dist,
+                                             threshold=0,
+                                             num_peaks=10)
+    lpeaks = np.zeros(10)
+    lpeaks[:peaks.shape[0]] = peaks
+    # lbp histogram
+    lbp_hist, _ = exposure.histogram(feature.local_binary_pattern(
+        blob, lbp_n_points, lbp_radius, method='var'),
+                                     nbins=10,
+                                     source_range='dtype')
+    # histogram
+    hist, _ = exposure.histogram(util.img_as_float(blob),
+                                 nbins=10,
+                                 source_range='dtype')
+    return np.concatenate([lbp_hist, hist, lpeaks, cpeaks, [blob.size]])
+
+
+def prominent_peak_values(image,
+                          min_xdistance=1,
+                          min_ydistance=1,
+                          threshold=0,
+                          num_peaks=np.inf):
+    """
+    The values of the peaks found by `skimage`'s `hough_*_peaks` (i.e.
+    `skimage.feature.peak._prominent_peaks`), in decreasing order, with
+    vectorized region statistics and stopping as soon as the remaining peaks
+    can't be among the `num_peaks` highest ones
+    """
+    rows, cols = image.shape
+    img_max = ndimage.maximum_filter1d(image,
+                                       size=2 * min_ydistance + 1,
+                                       axis=0,
+                                       mode='constant',
+                                       cval=0)
+    img_max = ndimage.maximum_filter1d(img_max,
+                                       size=2 * min_xdistance + 1,
+                                       axis=1,
+                                       mode='constant',
+                                       cval=0)
+    candidates = (image == img_max) & (image > threshold)
+    labels, n = ndimage.label(candidates, structure=np.ones((3, 3)))
+    if n == 0:
+        return np.empty(0)
+    # statistics of the regions, from their pixels only
+    ys, xs = np.nonzero(candidates)
+    lab = labels[ys, xs] - 1
+    intensity = np.full(n, -np.inf)
+    np.maximum.at(intensity, lab, img_max[ys, xs])
+    count = np.bincount(lab, minlength=n)
+    centroids = np.rint(
+        np.stack([
+            np.bincount(lab, ys, minlength=n) / count,
+            np.bincount(lab, xs, minlength=n) / count
+        ],
+                 axis=1)).astype(int)
+    img_max = img_max.copy()
+    ycoords_ext, xcoords_ext = np.mgrid[-min_ydistance:min_ydistance + 1,
+                                        -min_xdistance:min_xdistance + 1]
+    peaks = []
+    # same order as sorting the regions by intensity and reversing them
+    for i in np.argsort(intensity, kind='stable')[::-1]:
+        if len(peaks) >= num_peaks and intensity[i] < np.sort(
+                peaks)[-num_peaks]:
+            break
+        y, x = centroids[i]
+        accum = img_max[y, x]
+        if accum <= threshold:
+            continue
+        ycoords_nh = y + ycoords_ext
+        xcoords_nh = x + xcoords_ext
+        ycoords_in = (ycoords_nh > 0) & (ycoords_nh < rows)
+        ycoords_nh = ycoords_nh[ycoords_in]
+        xcoords_nh = xcoords_nh[ycoords_in]
+        # angles wrap around
+        low = xcoords_nh < 0
+        ycoords_nh[low] = rows - ycoords_nh[low]
+        xcoords_nh[low] += cols
+        high = xcoords_nh >= cols
+        ycoords_nh[high] = rows - ycoords_nh[high]
+        xcoords_nh[high] -= cols
+        img_max[ycoords_nh, xcoords_nh] = 0
+        peaks.append(accum)
+    peaks = np.sort(np.asarray(peaks, dtype=np.float64))[::-1]
+    return peaks[:num_peaks] if num_peaks != np.inf else peaks
+
+
+class FeatureExtractor:
+    """
+    Computes `blob_features` for many blobs: the circular Hough transforms
+    at all the radii share one FFT of the blob, the circle kernels and their
+    FFTs are computed once for all the blobs of the same size and the peaks
+    are found with `prominent_peak_values`.
+    """
+
+    def __init__(self, radii=RADII):
+        self.radii = radii
+        size = 2 * max(radii) + 1
+        self.kernels = np.zeros((len(radii), size, size))
+        # FFT of the kernels for each FFT shape
+        self._kernels_fft = {}
+        self.n_points = np.zeros(len(radii))
+        for i, r in enumerate(radii):
+            rr, cc = draw.circle_perimeter(max(radii), max(radii), r)
+            np.add.at(self.kernels[i], (rr, cc), 1)
+            self.n_points[i] = rr.size
+
+    def circle_peaks(self, blob):
+        R = max(self.radii)
+        h, w = blob.shape
+        shape = fft.next_fast_len(h + 2 * R), fft.next_fast_len(w + 2 * R)
+        mask = fft.rfft2((blob != 0).astype(np.float64), shape)
+        kernels = self._kernels_fft.get(shape)
+        if kernels is None:
+            kernels = self._kernels_fft[shape] = fft.rfft2(
+                self.kernels, shape)
+        # votes of each pixel for the centers at each radius
+        votes = fft.irfft2(mask[None] * kernels, shape)[:, R:R + h, R:R + w]
+        hspaces = np.rint(votes) / self.n_points[:, None, None]
+        peaks = np.concatenate(
+            [prominent_peak_values(hs, num_peaks=2) for hs in hspaces])
+        out = np.zeros(10)
+        peaks = np.sort(peaks)[::-1]
+        out[:peaks.shape[0]] = peaks
+        return out
+
+    def line_peaks(self, blob):
+        hspace, _, _ = transform.hough_line(blob)
+        peaks = prominent_peak_values(hspace,
+                                      min_xdistance=min(10, hspace.shape[1]),
+                                      min_ydistance=9,
+                                      threshold=0,
+                                      num_peaks=10)
+        out = np.zeros(10)
+        out[:peaks.shape[0]] = peaks
+        return out
+
+    def features(self, blob):
+        lbp_hist, _ = exposure.histogram(feature.local_binary_pattern(
+            blob, lbp_n_points, lbp_radius, method='var'),
+                                         nbins=10,
+                                         source_range='dtype')
+        hist, _ = exposure.histogram(util.img_as_float(blob),
+                                     nbins=10,
+                                     source_range='dtype')
+        return np.concatenate([
+            lbp_hist, hist,
+            self.line_peaks(blob),
+            self.circle_peaks(blob), [blob.size]
+        ])
+
+    def __call__(self, blobs):
+        """
+        The `len(blobs) x N_FEATURES` matrix of the features of the blob
+        images in `blobs`
+        """
+        out = np.zeros((len(blobs), N_FEATURES))
+        for i, blob in enumerate(blobs):
+            out[i] = self.features(blob)
+        return out
+
+
+def cached_features(page_dir, boxes, crops, extractor=None):
+    """
+    The features of the blobs of a page, whose `boxes` and images (`crops`)
+    are given, read from `page_dir/__features_v*.npy` if they were already
+    computed and computed (and added to the cache) otherwise. Returns the
+    features and the number of blobs computed.
+    """
+    page_dir = Path(page_dir)
+    fname = page_dir / CACHE_FN
+    cache = {}
+    if fname.exists():
+        for row in np.load(fname):
+            cache[tuple(row[['x0', 'y0', 'x1', 'y1']].tolist())] = row[
+                'features']
+    boxes = [tuple(int(v) for v in b) for b in boxes]
+    missing = {b: c for b, c in zip(boxes, crops) if b not in cache}
+    if missing:
+        extractor = extractor or FeatureExtractor()
+        cache.update(zip(missing, extractor(list(missing.values()))))
+        table = np.zeros(len(cache), dtype=CACHE_DTYPE)
+        for i, (b, f) in enumerate(cache.items()):
+            table[i] = b + (f, )
+        page_dir.mkdir(parents=True, exist_ok=True)
+        tmp = page_dir / f"{CACHE_FN}.tmp.npy"
+        np.save(tmp, table)
+        os.replace(tmp, fname)
+    features = np.array([cache[b] for b in boxes]).reshape(-1, N_FEATURES)
+    return features, len(missing)
+
+
+def load_features(blob_dir):
+    """
+    All the cached features under `blob_dir`, as a dict from page directory
+    to the table of its blobs (boxes and features)
+    """
+    return {
+        str(fn.parent): np.load(fn)
+        for fn in Path(blob_dir).glob(f'**/{CACHE_FN}')
+    }
+
+
+def _page_features(page_dir, nostaff_path, boxes):
+    from skimage import io
+    image = io.imread(nostaff_path)
+    crops = [image[x0:x1, y0:y1] for x0, y0, x1, y1 in boxes]
+    _, n = cached_features(page_dir, boxes, crops)
+    return len(boxes), n
+
+
+def extract(input_dir, blob_dir, n_jobs=None):
+    """
+    Computes and caches the features of all the blobs in the manifest of
+    `blob_dir`, in parallel over the pages, and prints the throughput
+    """
+    from joblib import Parallel, delayed
+    from tqdm import tqdm
+
+    from .manifest import load
+
+    input_dir, blob_dir = Path(input_dir), Path(blob_dir)
+    manifest = load(blob_dir)
+    boxes = {}
+    fields = ['dir', 'x0', 'y0', 'x1', 'y1']
+    for d, *box in manifest.blobs[fields].tolist():
+        boxes.setdefault(d, []).append(box)
+    jobs = []
+    for d, page_boxes in boxes.items():
+        page_dir = Path(manifest.dir_paths[d])
+        # `process` writes the blobs of `input_dir/x.jpg` in `blob_dir/x`
+        nostaff_path = input_dir / page_dir.relative_to(blob_dir).with_suffix(
+            '.jpg')
+        jobs.append(delayed(_page_features)(page_dir, nostaff_path,
+                                            page_boxes))
+
+    t0 = time.perf_counter()
+    res = Parallel(n_jobs=n_jobs or os.cpu_count())(tqdm(jobs))
+    elapsed = time.perf_counter() - t0
+    n_blobs = sum(n for n, _ in res)
+    n_computed = sum(n for _, n in res)
+    print(f"{n_blobs} blobs in {len(jobs)} pages, {n_computed} computed, "
+          f"{n_blobs - n_computed} cached, {elapsed:.1f} s: "
+          f"{n_computed / elapsed:.1f} blobs/s computed")
+
+
+def main(toml_config: str):
+    import toml
+    conf = toml.load(open(toml_config))['preprocessing']
+    extract(conf['input_dir'], conf['blob_dir'], conf.get('cpu_workers'))
+
+
+if __name__ == "__main__":
+
+    import sys
+    main(sys.argv[1])
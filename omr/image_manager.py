@@ -1,28 +1,25 @@
 import os
 import json
 from pathlib import Path
-import uuid
+import hashlib
 import logging
-from enum import Enum
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-from scipy.stats import spearmanr
-from skimage import io
+
+from . import metrics
+from .allocator import BlobAllocator
+from .page_cache import PAGE_CACHE
+from .render import (encode_jpeg, crop_blob, page_preview, page_tile,
+                     n_tiles)
 
 RNG = np.random.default_rng(1993)
 
 LOGGER = logging.getLogger(__name__)
 
 
-class Status(Enum):
-    NORMAL = 0
-    CHECK_FROM_0 = 1
-    ENDED = 2
-
-
-STATUS = Status.NORMAL
-
-
 def setup_logger(logger):
     logger.setLevel(logging.INFO)
 
@@ -40,33 +37,8 @@ def setup_logger(logger):
     logger.addHandler(iohandler)
 
 
-setup_logger(LOGGER)
-
-
-def read_json_field(fname, annotation_field):
-    data = json.load(open(fname, "r"))
-    if annotation_field in data:
-        LOGGER.debug(
-            f"Accessed {fname} for field {annotation_field} and found it")
-        return data[annotation_field]
-    else:
-        LOGGER.debug(
-            f"Accessed {fname} for field {annotation_field} and not found it")
-        return None
-
-
-def draw_rectangle(image, x0, y0, x1, y1, color=(255, 0, 0)):
-    xmax = image.shape[0] - 1
-    ymax = image.shape[1] - 1
-    x0 = max(0, x0)
-    y0 = max(0, y0)
-    x1 = min(xmax, x1)
-    y1 = min(ymax, y1)
-    image[x0:x1, y0, :] = color
-    image[x0:x1, y1, :] = color
-    image[x0, y0:y1, :] = color
-    image[x1, y0:y1, :] = color
-    return image
+# all the loggers of the package write to server.log
+setup_logger(logging.getLogger("omr"))
 
 
 class EndedHistoryException(RuntimeError):
@@ -84,6 +56,21 @@ class AskException(RuntimeError):
     pass
 
 
+def blob_uid(blob_json):
+    """
+    A short id for a blob json, stable across restarts, used in urls and etags
+    """
+    return hashlib.sha1(os.path.normpath(
+        str(blob_json)).encode()).hexdigest()[:16]
+
+
+def page_uid(page_path):
+    """
+    A short id for a page, shared by all its blobs, used in urls and etags
+    """
+    return blob_uid(page_path)
+
+
 class ImageManager:
     """
     An iterator that provides the next image that must be annotated
@@ -97,67 +84,94 @@ class ImageManager:
                  control_freq=200,
                  annotator_json_fn='__annotator.json',
                  control_json_fn='__control.json',
-                 static_dir='./static',
-                 enlarge=50):
-
-        assert control_length or control_json_fn, "Please, provide control_length or control_json_fn and normal_json_fn"
-        # shuffling blobs
-        full_json_list = np.asarray([str(i) for i in blob_jsons])
-        RNG.shuffle(full_json_list)  # in-place...
-
-        # splitting control set
-        if os.path.exists(control_json_fn):
-            _data = json.load(open(control_json_fn))
-            self.control_jsons = _data['control']
-            self.normal_jsons = _data['normal']
-        else:
-            self.control_jsons = full_json_list[:control_length]
-            self.normal_jsons = full_json_list[control_length:]
-            json.dump(
-                {
-                    'control': self.control_jsons.tolist(),
-                    'normal': self.normal_jsons.tolist()
-                }, open(control_json_fn, "w"))
+                 index_fn='__annotated.npy',
+                 enlarge=50,
+                 prefetch=0,
+                 prefetch_workers=2,
+                 preview_size=1600,
+                 tile_size=1024,
+                 jpeg_quality=85,
+                 image_cache=64,
+                 page_cache=None,
+                 ordering="shuffle",
+                 run_length=8,
+                 allocator=None,
+                 executor=None):
+
+        if allocator is None:
+            allocator = BlobAllocator(blob_jsons,
+                                      annotation_field,
+                                      control_length=control_length,
+                                      control_json_fn=control_json_fn,
+                                      index_fn=index_fn,
+                                      annotator_json_fn=annotator_json_fn,
+                                      ordering=ordering,
+                                      run_length=run_length,
+                                      rng=RNG)
+        # shared with the other sessions
+        self.allocator = allocator
+        self.control_jsons = allocator.control_jsons
+        self.normal_jsons = allocator.normal_jsons
+        self.index = allocator.index
+        self._lock = threading.RLock()
 
         # initializing fields
-        self.current_normal_idx = 0
         self.current_control_idx = -1
         self.annotation_field = annotation_field
         self.control_freq = control_freq
-        self.static_dir = Path(static_dir)
-        self.static_dir.mkdir(exist_ok=True, parents=True)
         self.control_length = control_length
         self.history = []
 
         # initializing annotator_json
-        self.annotator_json_fn = annotator_json_fn
         self.annotator = annotator
         self._annotator_rating = []
         self._new_annotator_rating = False
-        if os.path.exists(annotator_json_fn):
-            self.__init_annotator(annotator)
-        else:
-            annotator_json = {annotator: [[] for _ in range(control_length)]}
-            json.dump(annotator_json, open(annotator_json_fn, "w"))
+        with self.allocator.annotator_lock:
+            self.allocator.add_annotator(annotator)
+            self.update_rating()
 
         self.is_control = False
         self.enlarge = enlarge
 
-    def __init_annotator(self, annotator):
-        annotator_json = json.load(open(self.annotator_json_fn))
-        if annotator not in annotator_json:
-            annotator_json[annotator] = [[]
-                                         for _ in range(self.control_length)]
-        json.dump(annotator_json, open(self.annotator_json_fn, "w"))
-        self.update_rating(annotator_json, self.annotator)
+        # the images are encoded in memory and kept for the last
+        # `image_cache` served blobs. Pages are encoded once for all their
+        # blobs, whose rectangle is drawn by the browser, and kept for the
+        # last `image_cache` pages. `_uids` and `_page_uids` record every
+        # blob and page served in the session (like `history`), so that
+        # evicted images can be rendered again and the ids are never
+        # rejected
+        self.preview_size = preview_size
+        self.tile_size = tile_size
+        self.jpeg_quality = jpeg_quality
+        self.image_cache = image_cache
+        self._images = OrderedDict()
+        self._pages = OrderedDict()
+        self._images_lock = threading.Lock()
+        self._uids = {}
+        self._page_uids = {}
+        self._page_shapes = {}
+        # decoded pages, shared with the other managers and threads
+        self.page_cache = PAGE_CACHE if page_cache is None else page_cache
+
+        # the next `prefetch` blobs are picked in advance and their images are
+        # rendered by a pool of `prefetch_workers` threads
+        self.prefetch = prefetch
+        self._queue = deque()
+        if prefetch > 0 and executor is None:
+            executor = ThreadPoolExecutor(max_workers=prefetch_workers,
+                                          thread_name_prefix='prefetch')
+        self._executor = executor if prefetch > 0 else None
+
+    @property
+    def current_normal_idx(self):
+        return self.allocator.current_normal_idx
 
     def __get_next_json(self):
         """
-        Get the next json from normal or control group and adds its info to the history
+        Get the next json from normal or control group
         """
-        global STATUS, LOGGER
         # checking if we should provide a control json
-        if RNG.random() < 1 / self.control_freq:
+        if self.allocator.random() < 1 / self.control_freq:
             is_control = True
             # pick next control blob
             # update `current_control_idx`
@@ -168,43 +182,38 @@ class ImageManager:
             blob_json = self.control_jsons[self.current_control_idx]
         else:
             is_control = False
-            # looking for the first json not annotated
-            # if the server is checking from 0 raise AskException
-            if STATUS == Status.CHECK_FROM_0:
-                LOGGER.info(
-                    "Asked a new image, while checking from 0, request denied!"
-                )
-                raise AskException("Checking from 0!")
-            # here and there, recompute `current_normal_idx` to annotate jsons
-            # that may have been skipped
-            FOUND = False
-            if RNG.random() < 0.0001 and STATUS == Status.NORMAL:
-                LOGGER.info("resetting current_normal_idx to 0")
-                STATUS = Status.CHECK_FROM_0
-                self.current_normal_idx = 0
-            for idx, json_fname in enumerate(
-                    self.normal_jsons[self.current_normal_idx:]):
-                LOGGER.debug(
-                    f"Trying to read field {self.annotation_field} from file {idx}: {json_fname}"
-                )
-                if read_json_field(json_fname, self.annotation_field) is None:
-                    FOUND = True
-                    blob_json = json_fname
-                    # update `current_normal_idx`
-                    STATUS = Status.NORMAL
-                    self.current_normal_idx += idx + 1
-                    LOGGER.info(
-                        f"current_normal_idx: {self.current_normal_idx}/{len(self.normal_jsons)}"
-                    )
-                    LOGGER.debug(f"current_normal_json: {blob_json}")
-                    break
-            if not FOUND:
-                STATUS = Status.ENDED
-                raise StopIteration
-        # add arguments to the history
-        self.history.append((blob_json, is_control))
+            # looking for the first json not annotated and not leased to
+            # other sessions
+            blob_json = self.allocator.lease(self.annotator)
+            LOGGER.debug(f"current_normal_json: {blob_json}")
         return blob_json, is_control
 
+    def __fill_queue(self):
+        """
+        Picks blobs with `__get_next_json` until `prefetch` of them (at least
+        one) are waiting in the queue, and submits their rendering to the
+        pool. The order of the queue is the order in which blobs were picked,
+        so the control group is sampled exactly as without prefetching.
+
+        If no blob can be picked and the queue is empty, the exception raised
+        by `__get_next_json` is propagated.
+        """
+        while len(self._queue) < max(1, self.prefetch):
+            try:
+                with metrics.NEXT_JSON_SECONDS.time():
+                    blob_json, is_control = self.__get_next_json()
+            except (StopIteration, AskException):
+                if len(self._queue) == 0:
+                    raise
+                break
+            if self._executor is None:
+                future = None
+            else:
+                future = self._executor.submit(self.__serve_image, blob_json,
+                                               is_control)
+            self._queue.append((blob_json, is_control, future))
+        metrics.PREFETCH_QUEUE.set(len(self._queue), (self.annotator, ))
+
     def __serve_image(self, blob_json, is_control):
         """
         does everything to serve an image
@@ -212,53 +221,115 @@ class ImageManager:
         Returns:
         * annotation_json : the json path that should be annotated
         * is_control : if this json is one from control group
-        * the unique id used to generate the served images (use it in
-          `get_filenames` to get the path that should be servedunique_id
+        * the unique id of the blob (use it in `get_image` and `get_box` to
+          get the encoded blob, the id of its page and its rectangle)
         * the list of directories that compose the original image (use it to
           retrieve author name and opera)
         """
-
-        # copy the image in a place visible to the server
-        # if we want to show the original image, we should put it here
+        with metrics.SERVE_IMAGE_SECONDS.time():
+            unique_id = blob_uid(blob_json)
+            with self._images_lock:
+                self._uids[unique_id] = blob_json
+            entry = self.__render(unique_id)
+            return blob_json, is_control, unique_id, list(
+                entry["original_image_path"].parts)
+
+    def __render(self, unique_id):
+        """
+        Returns the cached data of `unique_id`, encoding the blob with its
+        surroundings if needed, and makes sure that the preview of its page
+        is encoded as well
+        """
+        with self._images_lock:
+            if unique_id in self._images:
+                self._images.move_to_end(unique_id)
+                metrics.IMAGE_CACHE.inc(("blob", "hit"))
+                return self._images[unique_id]
+        metrics.IMAGE_CACHE.inc(("blob", "miss"))
+
+        with metrics.RENDER_SECONDS.time(("decode", )):
+            b, original_image_path, original_image = self.__load(unique_id)
+        page_id = page_uid(original_image_path)
+        with metrics.RENDER_SECONDS.time(("blob", )):
+            blob = encode_jpeg(crop_blob(original_image, b, self.enlarge),
+                               self.jpeg_quality)
+        entry = {
+            "original_image_path": original_image_path,
+            "shape": original_image.shape,
+            "box": {k: b[k] for k in ("x0", "y0", "x1", "y1")},
+            "page_id": page_id,
+            "blob": blob
+        }
+        self.__render_page(page_id, original_image_path, original_image)
+
+        with self._images_lock:
+            self._page_shapes[page_id] = original_image.shape
+            self._images[unique_id] = entry
+            while len(self._images) > self.image_cache:
+                self._images.popitem(last=False)
+        return entry
+
+    def __render_page(self, page_id, path, image=None):
+        """
+        Returns the downscaled preview of a page, encoding it only if it is
+        not cached
+        """
+        with self._images_lock:
+            self._page_uids[page_id] = path
+            if page_id in self._pages:
+                self._pages.move_to_end(page_id)
+                metrics.IMAGE_CACHE.inc(("page", "hit"))
+                return self._pages[page_id]
+        metrics.IMAGE_CACHE.inc(("page", "miss"))
+        if image is None:
+            with metrics.RENDER_SECONDS.time(("decode", )):
+                image = self.page_cache.get(path)
+        with metrics.RENDER_SECONDS.time(("page", )):
+            preview = encode_jpeg(page_preview(image, self.preview_size),
+                                  self.jpeg_quality)
+        with self._images_lock:
+            self._pages[page_id] = preview
+            while len(self._pages) > self.image_cache:
+                self._pages.popitem(last=False)
+        return preview
+
+    def __load(self, unique_id):
+        """
+        Loads the json of a blob and the page it comes from
+        """
+        with self._images_lock:
+            blob_json = self._uids[unique_id]
         b = json.load(open(blob_json))
-
+        metrics.JSON_READS.inc(("render", ))
         # original_image_path = Path(
         #     str(Path(b["path"]).parent).replace('_nostaff', '') + '.jpg')
         original_image_path = Path(b["parent"].replace('_nostaff', ''))
-
-        # sectioning the blob
-        original_image = io.imread(original_image_path)
-        # section = original_image[b["x0"]:b["x1"], b["y0"]:b["y1"]]
-        x_max = original_image.shape[0]
-        y_max = original_image.shape[1]
-        e = self.enlarge
-        x0 = max(0, b["x0"] - e)
-        x1 = min(x_max, b["x1"] + e)
-        y0 = max(0, b["y0"] - e)
-        y1 = min(y_max, b["y1"] + e)
-        big_section = original_image[x0:x1, y0:y1]
-        big_section = draw_rectangle(big_section.copy(), b["x0"] - x0,
-                                     b["y0"] - y0, b["x1"] - x1 or x_max,
-                                     b["y1"] - y1 or y_max)
-        # drawing a rectangle in the original image
-        partiture = draw_rectangle(original_image.copy(), b["x0"], b["y0"],
-                                   b["x1"], b["y1"])
-
-        unique_id = str(uuid.uuid4())
-        big_blob_jpg, partiture_jpg = self.get_filenames(unique_id)
-
-        # io.imsave(blob_jpg, section)
-        io.imsave(big_blob_jpg, big_section)
-        io.imsave(partiture_jpg, partiture)
-
-        return blob_json, is_control, unique_id, list(
-            original_image_path.parts)
+        original_image = self.page_cache.get(original_image_path)
+        return b, original_image_path, original_image
 
     def __next__(self):
         """
-        Returns `self.__serve_image(*self.__get_next_json())`
+        Takes the first blob from the prefetching queue, adds it to the history
+        and returns the output of `__serve_image` for it
         """
-        return self.__serve_image(*self.__get_next_json())
+        while True:
+            self.__fill_queue()
+            blob_json, is_control, future = self._queue.popleft()
+            # blobs waiting in the queue for too long may have been leased to
+            # other sessions
+            if is_control or self.allocator.renew(blob_json, self.annotator):
+                break
+            LOGGER.info(f"lease lost, skipping {blob_json}")
+        # add arguments to the history
+        self.history.append((blob_json, is_control))
+        if future is None:
+            return self.__serve_image(blob_json, is_control)
+        # start rendering the next ones before waiting for this one
+        try:
+            self.__fill_queue()
+        except (StopIteration, AskException):
+            pass
+        return future.result()
 
     def __back__(self, idx):
         """
@@ -276,39 +347,135 @@ class ImageManager:
         A proxy method for `__next__` and `__back__`. If `idx` is `None`,
         `__next__` is called, otherwise it calls `__back__`
         """
-        if idx is None:
-            return self.__next__()
-        else:
-            return self.__back__(idx)
+        kind = "next" if idx is None else "history"
+        with self._lock, metrics.ASK_SECONDS.time((kind, )):
+            if idx is None:
+                return self.__next__()
+            else:
+                return self.__back__(idx)
+
+    def ask_batch(self, n):
+        """
+        Serves up to `n` blobs at once, as `__next__` does for one: normal
+        blobs are leased and control blobs are mixed in with the same
+        frequency. Fewer blobs are returned when no more can be picked; if
+        none can, the exception of `__next__` is raised.
+        """
+        out = []
+        with self._lock:
+            for _ in range(n):
+                try:
+                    with metrics.ASK_SECONDS.time(("batch", )):
+                        out.append(self.__next__())
+                except (StopIteration, AskException):
+                    if not out:
+                        raise
+                    break
+        return out
+
+    def save_batch(self, annotations):
+        """
+        Saves a batch of annotations, each a tuple `(json_fn, is_control,
+        annotation_value, unique_id)` as the arguments of `save_annotation`;
+        the rating is updated after each control blob, as for single
+        annotations
+        """
+        with self._lock:
+            for json_fn, is_control, annotation_value, unique_id in annotations:
+                self.save_annotation(json_fn, is_control, annotation_value,
+                                     unique_id)
+
+    def is_served(self, unique_id):
+        """
+        True if `unique_id` is the id of a blob that was served
+        """
+        with self._images_lock:
+            return unique_id in self._uids
+
+    def is_served_page(self, page_id):
+        """
+        True if `page_id` is the id of the page of a blob that was served
+        """
+        with self._images_lock:
+            return page_id in self._page_uids
+
+    def get_image(self, unique_id):
+        """
+        The JPEG bytes of the blob with its surroundings, for a blob that was
+        served. Raises `KeyError` for unknown ids.
+        """
+        return self.__render(unique_id)["blob"]
+
+    def get_box(self, unique_id):
+        """
+        The id of the page of a blob that was served, the shape of the page
+        and the rectangle of the blob (a dict with `x0`, `y0`, `x1`, `y1`)
+        """
+        entry = self.__render(unique_id)
+        return entry["page_id"], entry["shape"], entry["box"]
+
+    def get_page(self, page_id):
+        """
+        The JPEG bytes of the downscaled page, the same for all its blobs.
+        Raises `KeyError` for unknown ids.
+        """
+        with self._images_lock:
+            path = self._page_uids[page_id]
+        return self.__render_page(page_id, path)
+
+    def get_tiles_shape(self, unique_id):
+        """
+        The number of rows and columns of the full-resolution tiles of the page
+        """
+        return n_tiles(self.__render(unique_id)["shape"], self.tile_size)
+
+    def get_page_tiles_shape(self, page_id):
+        """
+        The number of rows and columns of the full-resolution tiles of a page
+        that was served, or None for unknown ids
+        """
+        with self._images_lock:
+            shape = self._page_shapes.get(page_id)
+        return None if shape is None else n_tiles(shape, self.tile_size)
 
-    def get_filenames(self, unique_id):
-        big_blob_jpg = self.static_dir / (unique_id + "_big_blob.jpg")
-        partiture_jpg = self.static_dir / (unique_id + "_partiture.jpg")
-        return big_blob_jpg, partiture_jpg
+    def get_tile(self, page_id, row, col):
+        """
+        The JPEG bytes of a full-resolution tile of the page, used for
+        zooming; the same for all the blobs of the page
+        """
+        with self._images_lock:
+            path = self._page_uids[page_id]
+        image = self.page_cache.get(path)
+        return encode_jpeg(page_tile(image, row, col, self.tile_size),
+                           self.jpeg_quality)
 
     def cleaning(self, unique_id):
-        for f in self.get_filenames(unique_id):
-            f.unlink(missing_ok=True)
+        """
+        Frees the memory used by the images of `unique_id`
+        """
+        with self._images_lock:
+            self._images.pop(unique_id, None)
 
     def save_annotation(self, json_fn, is_control, annotation_value,
                         unique_id):
-        if is_control:
-            # this was a control blob
-            annotator_json = json.load(open(self.annotator_json_fn))
-            if self.annotator not in annotator_json:
-                self.__init_annotator(self.annotator)
-                annotator_json = json.load(open(self.annotator_json_fn))
-            annotator_json[self.annotator][self.current_control_idx].append(
-                annotation_value)
-            self.update_rating(annotator_json, self.annotator)
-            json.dump(annotator_json, open(self.annotator_json_fn, "w"))
-        else:
-            json_data = json.load(open(json_fn, "r"))
-            json_data[self.annotation_field] = annotation_value
-            json_data['annotator'] = self.annotator
-            json.dump(json_data, open(json_fn, "w"))
+        control = "true" if is_control else "false"
+        with self._lock, metrics.SAVE_ANNOTATION_SECONDS.time((control, )):
+            if is_control:
+                # this was a control blob
+                self.__save_control(json_fn, annotation_value)
+            else:
+                self.allocator.save_normal(json_fn, self.annotator,
+                                           annotation_value)
+
+            self.cleaning(unique_id)
+        metrics.ANNOTATIONS.inc((self.annotator, control))
 
-        self.cleaning(unique_id)
+    def __save_control(self, json_fn, annotation_value):
+        # other sessions use the same data
+        with self.allocator.annotator_lock:
+            self.allocator.save_control(json_fn, self.annotator,
+                                        annotation_value)
+            self.update_rating()
 
     @property
     def new_annotator_rating(self):
@@ -346,44 +513,13 @@ class ImageManager:
                 f"annotator rating not changed: {x}, previous was {self.annotator_rating}"
             )
 
-    def update_rating(self, data, annotator):
+    def update_rating(self):
         """
         Update the rating computed for this annotator in respect to itself and
-        to other annotators
-
-        MUST BE REVISED!
-        """
-        if annotator not in data:
-            return
-        # computing self-correlation
-        L = min(len(i) for i in data[annotator])
-        if L > 1:
-            self_data = [i[:L] for i in data[annotator]]
-            r, _ = spearmanr(self_data, self_data, axis=0)
-            if np.any(np.isnan(r)):
-                self_r = 1.0
-            else:
-                self_r = r[np.tril_indices(r.shape[0])].mean()
-        else:
-            return
-
-        annotator_indices = {}
-        inter_data = []
-        idx = 0
-        for ann, vals in data.items():
-            L = min(len(i) for i in data[ann])
-            if L <= 0:
-                continue
-            # average annotation for each blob
-            annotator_data = np.mean([i[:L] for i in data[ann]], axis=1)
-            inter_data.append(annotator_data)
-            annotator_indices[ann] = slice(idx, L)
-            idx += L
-
-        # how much this annotator average is different from the average
-        # annotator
-        inter_r, _ = spearmanr(np.mean(self_data, axis=1),
-                               np.mean(inter_data, axis=0))
-        if np.any(np.isnan(inter_r)):
-            inter_r = 1.0
-        self.annotator_rating = f"{round((self_r + inter_r) / 2 * 100)}%"
+        to other annotators, using the value last computed by the
+        `AgreementTracker` (see `omr.agreement`)
+        """
+        with metrics.UPDATE_RATING_SECONDS.time():
+            rating = self.allocator.agreement.rating(self.annotator)
+        if rating is not None:
+            self.annotator_rating = f"{round(rating * 100)}%"
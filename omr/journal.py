@@ -0,0 +1,280 @@
+"""
+An append-only journal of the annotations, folded back into the blob jsons
+and into the annotator json in background
+"""
+import os
+import json
+import logging
+import threading
+import time
+from collections import Counter, OrderedDict
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+
+def atomic_json_dump(obj, fname):
+    """
+    Writes `obj` to a temporary file and then moves it to `fname`, so that
+    `fname` is never left half-written
+    """
+    tmp = f"{fname}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, fname)
+
+
+def read_records(fname):
+    """
+    The records in a journal file; a truncated last line is ignored
+    """
+    out = []
+    with open(fname) as f:
+        for line in f:
+            try:
+                out.append(json.loads(line))
+            except json.JSONDecodeError:
+                LOGGER.warning(f"skipping a truncated record in {fname}")
+    return out
+
+
+class Journal:
+    """
+    Annotations are appended to `fname` as one json record per line and a
+    background thread writes and fsyncs them every `fsync_interval` seconds
+    (group commit), so that saving an annotation doesn't wait for the disk.
+
+    Every `compact_interval` seconds, the same thread moves the journal to a
+    segment file, folds the segment into the blob jsons and into
+    `annotator_json_fn` and deletes it. All the files are replaced
+    atomically; the control annotations of a segment are applied to the
+    annotator json in one step, marked by renaming the segment to
+    `.applied`, so a crash never applies them twice. Records that can't be
+    applied (e.g. the json of the blob is missing or corrupted) are moved to
+    a `.rejected` file and the others are folded anyway.
+
+    Records have the following fields:
+    * `blob`: the json path of the blob, None when registering an annotator
+    * `annotator`
+    * `field`: the annotation field
+    * `value`: the annotation value
+    * `control`: True for blobs in the control group
+    * `control_idx`: the position of the blob in the control group
+    * `time`: the timestamp of the annotation
+    * `propagated_from` (optional): the blob whose annotation was copied to
+      this one, a near-duplicate
+    """
+
+    def __init__(self,
+                 annotator_json_fn,
+                 control_length,
+                 fname='__journal.jsonl',
+                 fsync_interval=0.05,
+                 compact_interval=60):
+        self.fname = Path(fname)
+        self.annotator_json_fn = annotator_json_fn
+        self.control_length = control_length
+        self.fsync_interval = fsync_interval
+        self.compact_interval = compact_interval
+        self._lock = threading.Lock()
+        self._synced = threading.Condition(self._lock)
+        self._buffer = []
+        self._n_synced = 0
+        self._n_appended = 0
+        # number of records of each normal blob not yet folded into its json
+        self._pending = Counter()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+
+    def recover(self):
+        """
+        Folds the journal and the segments left by a previous run into the
+        jsons; call it before loading them
+        """
+        if self.fname.exists() and self.fname.stat().st_size > 0:
+            self.fname.rename(self.__segment_name())
+        for seg in self.__segments():
+            self.__fold(seg)
+
+    def start(self):
+        """
+        Opens the journal and starts the background thread
+        """
+        self._file = open(self.fname, "a")
+        self._thread = threading.Thread(target=self.__run,
+                                        name='journal',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.__sync()
+        self._file.close()
+
+    def append(self, record, wait=False):
+        """
+        Adds `record` to the journal and returns its sequence number. If
+        `wait` is True, returns only after the record has been fsynced, so
+        that concurrent saves share the same fsync.
+        """
+        record.setdefault("time", time.time())
+        line = json.dumps(record) + "\n"
+        with self._lock:
+            self._buffer.append(line)
+            self._n_appended += 1
+            n = self._n_appended
+            if record["blob"] is not None and not record["control"]:
+                self._pending[os.path.normpath(record["blob"])] += 1
+        if wait:
+            self.wait(n)
+        return n
+
+    def is_pending(self, blob):
+        """
+        True if the journal has annotations of the normal blob `blob` that
+        are not yet in its json
+        """
+        with self._lock:
+            return self._pending[os.path.normpath(str(blob))] > 0
+
+    def wait(self, n):
+        """
+        Returns when the record with sequence number `n` has been fsynced
+        """
+        with self._lock:
+            while self._n_synced < n:
+                self._synced.wait()
+
+    def __sync(self):
+        with self._lock:
+            if not self._buffer:
+                return
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._n_synced += len(self._buffer)
+            self._buffer = []
+            self._synced.notify_all()
+
+    def __run(self):
+        last_compaction = time.monotonic()
+        while not self._stop.wait(self.fsync_interval):
+            # an error must not stop the thread, or nothing would be fsynced
+            # anymore; the buffer is written again at the next round
+            try:
+                self.__sync()
+                if time.monotonic() - last_compaction > self.compact_interval:
+                    last_compaction = time.monotonic()
+                    self.compact()
+            except Exception:
+                LOGGER.exception("journal: error in the background thread")
+
+    def compact(self):
+        """
+        Moves the current journal to a segment and folds it into the jsons
+        """
+        with self._lock:
+            if self._buffer:
+                self._file.write("".join(self._buffer))
+                self._n_synced += len(self._buffer)
+                self._buffer = []
+                self._synced.notify_all()
+            if self._file.tell() == 0:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            seg = self.__segment_name()
+            self.fname.rename(seg)
+            self._file = open(self.fname, "a")
+        self.__fold(seg)
+
+    def __segment_name(self):
+        return self.fname.with_name(f"{self.fname.name}.{time.time_ns()}.seg")
+
+    def __reject(self, records, error):
+        """
+        Moves `records`, which couldn't be folded, to the `.rejected` file
+        next to the journal
+        """
+        LOGGER.error(f"journal: {len(records)} records rejected: {error!r}")
+        with open(self.fname.with_name(f"{self.fname.name}.rejected"),
+                  "a") as f:
+            for r in records:
+                f.write(json.dumps(dict(r, error=repr(error))) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def __segments(self):
+        return sorted(
+            list(self.fname.parent.glob(f"{self.fname.name}.*.seg")) +
+            list(self.fname.parent.glob(f"{self.fname.name}.*.applied")))
+
+    def __fold(self, seg):
+        """
+        Applies the records of a segment file and deletes it
+        """
+        seg = Path(seg)
+        tmp = f"{self.annotator_json_fn}.tmp"
+        if seg.suffix == ".applied":
+            # crashed while replacing the annotator json
+            if os.path.exists(tmp):
+                os.replace(tmp, self.annotator_json_fn)
+            seg.unlink()
+            return
+
+        records = read_records(seg)
+
+        # normal blobs: the last annotation of each blob wins; writing them
+        # again is harmless
+        blobs = OrderedDict()
+        for r in records:
+            if r["blob"] is not None and not r["control"]:
+                blobs[r["blob"]] = r
+        for blob, r in blobs.items():
+            try:
+                data = json.load(open(blob))
+                data[r["field"]] = r["value"]
+                data['annotator'] = r["annotator"]
+                if r.get("propagated_from") is not None:
+                    data['propagated_from'] = r["propagated_from"]
+                atomic_json_dump(data, blob)
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.__reject([r], e)
+        # records of a previous run were never counted and are ignored
+        with self._lock:
+            self._pending -= Counter(
+                os.path.normpath(r["blob"]) for r in records
+                if r["blob"] is not None and not r["control"])
+
+        # control blobs: appended to the lists in the annotator json
+        control = [r for r in records if r["control"]]
+        if control:
+            if os.path.exists(self.annotator_json_fn):
+                annotator_json = json.load(open(self.annotator_json_fn))
+            else:
+                annotator_json = {}
+            for r in control:
+                try:
+                    lists = annotator_json.setdefault(
+                        r["annotator"],
+                        [[] for _ in range(self.control_length)])
+                    if r["blob"] is not None:
+                        lists[r["control_idx"]].append(r["value"])
+                except (KeyError, IndexError, TypeError) as e:
+                    self.__reject([r], e)
+            with open(tmp, "w") as f:
+                json.dump(annotator_json, f)
+                f.flush()
+                os.fsync(f.fileno())
+            applied = seg.with_suffix(".applied")
+            seg.rename(applied)
+            os.replace(tmp, self.annotator_json_fn)
+            applied.unlink()
+        else:
+            seg.unlink()
+        LOGGER.info(f"journal: folded {len(records)} records from {seg.name}")
@@ -0,0 +1,327 @@
+"""
+A load test of the data-entry server: builds a synthetic archive in a
+temporary directory, starts the server on it and simulates many annotators
+using it at the same time
+
+Usage:
+    loadtest.py [-n <annotators>] [-d <seconds>] [--think <seconds>] ...
+
+"""
+import os
+import re
+import sys
+import json
+import time
+import socket
+import tempfile
+import threading
+import subprocess
+import http.client
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+
+PROJ_DIR = Path(__file__).resolve().parent.parent
+HIDDEN_RE = re.compile(r'name="(json_fn|is_control|unique_id)" value="([^"]*)"')
+BLOB_RE = re.compile(r'<img src="([^"]+/blob\.jpg)"')
+PAGE_RE = re.compile(r'href="([^"]+/page)"')
+# shown when `ImageManager.ask` raises `StopIteration`: no free blobs left
+END_TEXT = "è finito"
+
+
+def build_archive(root,
+                  n_pages=40,
+                  blobs_per_page=50,
+                  shape=(1750, 1250),
+                  seed=1992):
+    """
+    Writes a synthetic archive in `root` with the layout of the
+    preprocessing: `author/opera/page.jpg`, the page without staff
+    (`page_nostaff.jpg`) and the jsons of its blobs in `page_nostaff/`.
+    Returns the number of blobs.
+    """
+    from PIL import Image
+
+    from .synthetic import synthetic_page
+
+    root = Path(root)
+    rng = np.random.default_rng(seed)
+    n = 0
+    for p in range(n_pages):
+        page_dir = root / f"autore{p % 3}" / f"opera{p % 7}"
+        page_dir.mkdir(parents=True, exist_ok=True)
+        page, boxes = synthetic_page(rng, shape, blobs_per_page)
+        original = page_dir / f"pagina{p:04d}.jpg"
+        nostaff = page_dir / f"pagina{p:04d}_nostaff.jpg"
+        Image.fromarray(page).save(original, quality=85)
+        os.link(original, nostaff)
+        blob_dir = page_dir / nostaff.stem
+        blob_dir.mkdir(exist_ok=True)
+        for i, (x0, y0, x1, y1) in enumerate(boxes):
+            stem = f"{nostaff.stem}_blob{i:03d}"
+            json.dump(
+                {
+                    "x0": int(x0),
+                    "y0": int(y0),
+                    "x1": int(x1),
+                    "y1": int(y1),
+                    "path": str(blob_dir / f"{stem}.png"),
+                    "parent": str(nostaff),
+                    "id": i
+                }, open(blob_dir / f"{stem}.json", "w"))
+        n += len(boxes)
+    return n
+
+
+def write_config(root, archive, port, control_length=50, **data_entry):
+    """
+    Writes in `root` the `config.toml` of the repository with the paths of
+    `archive`, the server on `port` and the other `data_entry` options
+    changed
+    """
+    import toml
+
+    conf = toml.load(open(PROJ_DIR / 'config.toml'))
+    conf['preprocessing']['input_dir'] = str(archive)
+    conf['preprocessing']['blob_dir'] = str(archive)
+    conf['data_entry'].update(port=port,
+                              control_length=control_length,
+                              **data_entry)
+    toml.dump(conf, open(Path(root) / 'config.toml', "w"))
+    # the gifs shown with the rating
+    os.symlink(PROJ_DIR / 'static', Path(root) / 'static')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(root, port, timeout=120):
+    """
+    Starts `pdm data_entry` in `root` and waits until it answers
+    """
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(
+                   [str(PROJ_DIR), os.environ.get("PYTHONPATH", "")]))
+    log = open(Path(root) / 'stdout.log', "w")
+    proc = subprocess.Popen(
+        [sys.executable, "-c", "from omr.server import run; run()"],
+        cwd=root,
+        env=env,
+        stdout=log,
+        stderr=subprocess.STDOUT)
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        if proc.poll() is not None:
+            raise RuntimeError(
+                f"the server stopped, see {Path(root) / 'stdout.log'}")
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+            conn.request("GET", "/agreement")
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            time.sleep(0.5)
+    proc.terminate()
+    raise RuntimeError("the server didn't start in time")
+
+
+class Annotator(threading.Thread):
+    """
+    A virtual annotator: asks for a blob, loads its image (and sometimes the
+    page), waits `think` seconds on average and posts a random label, going
+    back in the history with probability `p_history`. Each request is
+    recorded in `results` as `(kind, seconds, error)`, where error is None,
+    the HTTP status or `"ended"` for the page shown when there are no free
+    blobs left, after which the annotator stops.
+    """
+
+    def __init__(self, name, port, labels, field, results, stop, think=2.0,
+                 p_page=0.1, p_history=0.05, seed=0):
+        super().__init__(name=f"annotator-{name}", daemon=True)
+        self.annotator = name
+        self.port = port
+        self.labels = labels
+        self.field = field
+        self.results = results
+        self.stop = stop
+        self.think = think
+        self.p_page = p_page
+        self.p_history = p_history
+        self.rng = np.random.default_rng(seed)
+        self.conn = None
+
+    def request(self, kind, method, url, form=None):
+        sep = "&" if "?" in url else "?"
+        url = f"{url}{sep}annotator={self.annotator}"
+        body, headers = None, {}
+        if form is not None:
+            body = urlencode(form)
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        t0 = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection("127.0.0.1",
+                                                       self.port,
+                                                       timeout=60)
+            self.conn.request(method, url, body, headers)
+            response = self.conn.getresponse()
+            data = response.read()
+            status = response.status
+        except (OSError, http.client.HTTPException):
+            self.conn = None
+            data, status = b"", "connection"
+        elapsed = time.perf_counter() - t0
+        error = None if status == 200 else status
+        text = data.decode(errors="replace") if kind in ("ask", "save",
+                                                          "history") else ""
+        if error is None and END_TEXT in text:
+            error = "ended"
+        self.results.append((kind, elapsed, error))
+        return text
+
+    def wait(self):
+        return self.stop.wait(self.rng.exponential(self.think))
+
+    def run(self):
+        page = self.request("ask", "GET", "/")
+        while not self.stop.is_set():
+            if END_TEXT in page:
+                return
+            fields = dict(HIDDEN_RE.findall(page))
+            if fields.get("unique_id"):
+                for src in BLOB_RE.findall(page):
+                    self.request("blob", "GET", src)
+                if self.rng.random() < self.p_page:
+                    for href in PAGE_RE.findall(page):
+                        self.request("page", "GET", href)
+            if self.wait():
+                return
+            if not fields.get("unique_id"):
+                page = self.request("ask", "GET", "/")
+            elif self.rng.random() < self.p_history:
+                self.request("history", "GET", "/2")
+                page = self.request("ask", "GET", "/")
+            else:
+                fields[self.field] = self.rng.choice(self.labels)
+                page = self.request("save", "POST", "/", fields)
+
+
+def report(results, elapsed, n_annotators):
+    """
+    Prints the latency percentiles, the throughput and the errors of each
+    kind of request
+    """
+    if not results:
+        print(f"{n_annotators} annotators, {elapsed:.0f} s: no requests "
+              "completed")
+        return
+    print(f"{n_annotators} annotators, {elapsed:.0f} s, "
+          f"{len(results)} requests, {len(results) / elapsed:.1f} req/s")
+    print(f"{'request':>8} {'n':>7} {'p50 [ms]':>9} {'p95 [ms]':>9} "
+          f"{'p99 [ms]':>9} {'max [ms]':>9} {'errors':>7} {'ended':>5}")
+    kinds = sorted({k for k, _, _ in results})
+    for kind in kinds + ["all"]:
+        rows = [r for r in results if kind in ("all", r[0])]
+        ms = 1000 * np.array([t for _, t, _ in rows])
+        errors = sum(e is not None and e != "ended" for _, _, e in rows)
+        ended = sum(e == "ended" for _, _, e in rows)
+        p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+        print(f"{kind:>8} {len(rows):>7} {p50:>9.1f} {p95:>9.1f} "
+              f"{p99:>9.1f} {ms.max():>9.1f} {errors:>7} {ended:>5}")
+    # the page after the last annotation says that the archive ended
+    n_saved = sum(1 for k, _, e in results
+                  if k == "save" and e in (None, "ended"))
+    n_errors = sum(1 for _, _, e in results
+                   if e is not None and e != "ended")
+    print(f"{60 * n_saved / elapsed:.1f} annotations/min, error rate "
+          f"{100 * n_errors / len(results):.2f}%")
+
+
+def run(n_annotators=20,
+        duration=60,
+        think=2.0,
+        n_pages=40,
+        blobs_per_page=50,
+        p_page=0.1,
+        p_history=0.05,
+        keep=False,
+        **data_entry):
+    """
+    Builds the archive, starts the server with the options in `data_entry`
+    (overriding `config.toml`), runs `n_annotators` virtual annotators for
+    `duration` seconds and prints the report
+    """
+    import shutil
+
+    import toml
+
+    tmp = tempfile.mkdtemp(prefix="omr-loadtest-")
+    root = Path(tmp)
+    archive = root / "archive"
+    n_blobs = build_archive(archive, n_pages, blobs_per_page)
+    port = free_port()
+    write_config(root, archive, port, **data_entry)
+    conf = toml.load(open(root / 'config.toml'))['data_entry']
+    print(f"{n_blobs} blobs in {n_pages} pages in {archive}, "
+          f"server on port {port}")
+
+    proc = start_server(root, port)
+    results, stop = [], threading.Event()
+    try:
+        annotators = [
+            Annotator(f"virtual{i:03d}", port, list(conf['annotation_values']),
+                      conf['annotation_field'], results, stop, think, p_page,
+                      p_history, i) for i in range(n_annotators)
+        ]
+        t0 = time.perf_counter()
+        for a in annotators:
+            a.start()
+        stop.wait(duration)
+        stop.set()
+        for a in annotators:
+            a.join(timeout=60)
+        elapsed = time.perf_counter() - t0
+    finally:
+        proc.terminate()
+        proc.wait()
+    report(results, elapsed, n_annotators)
+    if keep:
+        print(f"archive and server logs kept in {tmp}")
+    else:
+        shutil.rmtree(tmp)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", "--annotators", type=int, default=20)
+    parser.add_argument("-d", "--duration", type=float, default=60,
+                        help="seconds")
+    parser.add_argument("--think", type=float, default=2.0,
+                        help="mean seconds between two requests of an "
+                        "annotator")
+    parser.add_argument("--pages", type=int, default=40)
+    parser.add_argument("--blobs-per-page", type=int, default=50)
+    parser.add_argument("--p-page", type=float, default=0.1,
+                        help="probability of opening the page of a blob")
+    parser.add_argument("--p-history", type=float, default=0.05,
+                        help="probability of going back in the history")
+    parser.add_argument("--prefetch", type=int, default=None)
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the archive and the logs of the server")
+    args = parser.parse_args()
+    data_entry = {}
+    if args.prefetch is not None:
+        data_entry['prefetch'] = args.prefetch
+    run(args.annotators, args.duration, args.think, args.pages,
+        args.blobs_per_page, args.p_page, args.p_history, args.keep,
+        **data_entry)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,347 @@
+"""
+A compact binary list of all the blobs produced by the preprocessing, so
+that the server doesn't need to walk the whole archive at startup
+
+Usage:
+    manifest.py (<toml_config>)
+
+"""
+import os
+import re
+import json
+import hashlib
+import logging
+from pathlib import Path
+
+import numpy as np
+from joblib import Parallel, delayed
+
+LOGGER = logging.getLogger(__name__)
+
+MANIFEST_DIR = '__manifest'
+BLOB_RE = re.compile(r"^(?P<page>.*)_blob(?P<num>[0-9]+)\.json$")
+BLOB_DTYPE = np.dtype([('dir', '<i4'), ('num', '<i4'), ('x0', '<i4'),
+                       ('y0', '<i4'), ('x1', '<i4'), ('y1', '<i4')])
+
+
+def blob_name(dirname, num):
+    """
+    The name of the json of blob `num` in the directory `dirname`, as written
+    by `omr.preprocess.process`
+    """
+    return f"{dirname}_blob{num:03d}.json"
+
+
+class Manifest:
+    """
+    The blobs under `root`, as two memory-mapped tables:
+    * `dirs`: path (relative to `root`) and modification time of every
+      directory
+    * `blobs`: for each blob, the index of its directory in `dirs` (i.e. its
+      page), its number and its bounding box
+
+    Iterating over it yields the paths of the blob jsons, in the same order
+    as `blobs`. `hash` identifies the list of blobs: it changes only when
+    the manifest is rebuilt with different blobs.
+    """
+
+    def __init__(self, root, dirs, blobs, hash=None):
+        self.root = Path(root)
+        self.dirs = dirs
+        self.blobs = blobs
+        self.hash = _hash(dirs, blobs) if hash is None else hash
+        self._dir_paths = None
+        self._dir_index = None
+
+    def __len__(self):
+        return self.blobs.shape[0]
+
+    @property
+    def dir_paths(self):
+        if self._dir_paths is None:
+            self._dir_paths = [
+                str(self.root / p.decode()) for p in self.dirs['path']
+            ]
+        return self._dir_paths
+
+    def path(self, i):
+        """
+        The path of the json of the `i`-th blob
+        """
+        d = self.dir_paths[self.blobs['dir'][i]]
+        return os.path.join(d,
+                            blob_name(os.path.basename(d),
+                                      self.blobs['num'][i]))
+
+    def find(self, path):
+        """
+        The index of the blob whose json is `path`, or None
+        """
+        d, name = os.path.split(os.path.normpath(str(path)))
+        m = BLOB_RE.match(name)
+        if m is None:
+            return None
+        if self._dir_index is None:
+            self._dir_index = {
+                os.path.normpath(p): i
+                for i, p in enumerate(self.dir_paths)
+            }
+        i = self._dir_index.get(d)
+        if i is None:
+            return None
+        # blobs are sorted by directory
+        lo, hi = np.searchsorted(self.blobs['dir'], [i, i + 1])
+        hit = np.flatnonzero(self.blobs['num'][lo:hi] == int(m.group('num')))
+        return int(lo + hit[0]) if hit.size else None
+
+    def __iter__(self):
+        dir_paths = self.dir_paths
+        for d, num in zip(self.blobs['dir'].tolist(),
+                          self.blobs['num'].tolist()):
+            yield os.path.join(dir_paths[d],
+                               blob_name(os.path.basename(dir_paths[d]), num))
+
+    def blob_names(self):
+        """
+        A dict from directory index to the set of blob json names in it
+        """
+        out = {}
+        for d, num in zip(self.blobs['dir'].tolist(),
+                          self.blobs['num'].tolist()):
+            out.setdefault(d, set()).add(
+                blob_name(os.path.basename(self.dir_paths[d]), num))
+        return out
+
+    def refresh(self):
+        """
+        Checks the modification time of all the directories. Directories
+        modified since the manifest was written are listed again: if their
+        sub-directories and blob jsons are the same, only their time is
+        updated (e.g. a json was rewritten), otherwise the manifest is stale.
+
+        Returns True if the manifest is still valid.
+        """
+        changed = []
+        for i, d in enumerate(self.dir_paths):
+            try:
+                mtime = os.stat(d).st_mtime_ns
+            except FileNotFoundError:
+                return False
+            if mtime != self.dirs['mtime'][i]:
+                changed.append((i, mtime))
+        if not changed:
+            return True
+
+        children = {}
+        for d in self.dir_paths[1:]:
+            children.setdefault(os.path.dirname(d), set()).add(d)
+        names = self.blob_names()
+        dirs = np.array(self.dirs)
+        for i, mtime in changed:
+            subdirs, blobs = _list_dir(self.dir_paths[i])
+            if set(subdirs) != children.get(self.dir_paths[i], set()) or set(
+                    blobs) != names.get(i, set()):
+                return False
+            dirs['mtime'][i] = mtime
+        LOGGER.info(f"manifest: {len(changed)} directories touched")
+        _save(self.root / MANIFEST_DIR / 'dirs.npy', dirs)
+        self.dirs = dirs
+        return True
+
+
+class Selection:
+    """
+    The paths of the blob jsons at `indices` in `manifest`, in that order, as
+    a read-only sequence. `position` is the inverse lookup and `fingerprint`
+    identifies the selection without reading its paths.
+    """
+
+    def __init__(self, manifest, indices):
+        self.manifest = manifest
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self._positions = None
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    def __getitem__(self, i):
+        return self.manifest.path(self.indices[i])
+
+    def __iter__(self):
+        for i in self.indices.tolist():
+            yield self.manifest.path(i)
+
+    def position(self, path):
+        """
+        The position of the blob json `path` in the selection, or None
+        """
+        if self._positions is None:
+            positions = np.full(len(self.manifest), -1, dtype=np.int32)
+            positions[self.indices] = np.arange(len(self), dtype=np.int32)
+            self._positions = positions
+        i = self.manifest.find(path)
+        if i is None or self._positions[i] < 0:
+            return None
+        return int(self._positions[i])
+
+    def fingerprint(self):
+        h = hashlib.sha1(self.manifest.hash.encode())
+        h.update(self.indices.tobytes())
+        return h.hexdigest()
+
+
+def save_selections(fname, manifest, selections, meta):
+    """
+    Saves the lists of blob json paths in `selections` (a dict) as indices of
+    `manifest` in `fname`, a `.npz` file, with the hash of the manifest and
+    `meta`, a json-serializable object. Returns them as `Selection`s, or None
+    if some paths are not in the manifest.
+    """
+    index = {os.path.normpath(p): i for i, p in enumerate(manifest)}
+    arrays = {}
+    for name, paths in selections.items():
+        indices = [index.get(os.path.normpath(str(p))) for p in paths]
+        if None in indices:
+            LOGGER.warning(f"manifest: {indices.count(None)} blobs of "
+                           f"{name} are not in the manifest")
+            return None
+        arrays[name] = np.array(indices, dtype=np.int32)
+    fname = Path(fname)
+    tmp = fname.with_suffix('.tmp.npz')
+    np.savez(tmp,
+             __meta=np.array(json.dumps([manifest.hash, meta])),
+             **arrays)
+    os.replace(tmp, fname)
+    return {k: Selection(manifest, v) for k, v in arrays.items()}
+
+
+def load_selections(fname, manifest, meta):
+    """
+    The `Selection`s saved in `fname` by `save_selections`, or None if the
+    file is missing or was saved with another manifest or another `meta`
+    """
+    if not os.path.exists(fname):
+        return None
+    with np.load(fname) as data:
+        if json.loads(str(data['__meta'])) != [manifest.hash, meta]:
+            return None
+        return {
+            k: Selection(manifest, data[k])
+            for k in data.files if k != '__meta'
+        }
+
+
+def _hash(dirs, blobs):
+    h = hashlib.sha1(np.ascontiguousarray(dirs['path']).tobytes())
+    h.update(np.ascontiguousarray(blobs).tobytes())
+    return h.hexdigest()
+
+
+def _list_dir(path):
+    """
+    The sub-directories (full paths) and the blob json names in `path`
+    """
+    subdirs, blobs = [], []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name != MANIFEST_DIR:
+                    subdirs.append(entry.path)
+            elif BLOB_RE.match(entry.name):
+                blobs.append(entry.name)
+    return subdirs, blobs
+
+
+def _save(fname, array):
+    tmp = fname.with_suffix('.tmp.npy')
+    np.save(tmp, array)
+    os.replace(tmp, fname)
+
+
+def _read_box(fname):
+    b = json.load(open(fname))
+    return b["x0"], b["y0"], b["x1"], b["y1"]
+
+
+def build(root, n_jobs=10):
+    """
+    Walks `root`, reads the bounding box of every blob and writes the
+    manifest in `root/__manifest`
+    """
+    root = Path(root)
+    (root / MANIFEST_DIR).mkdir(exist_ok=True)
+
+    dirs, files, rows = [], [], []
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        # the time is taken before listing, so that changes made while
+        # listing make the manifest stale
+        mtime = os.stat(d).st_mtime_ns
+        subdirs, blobs = _list_dir(d)
+        idx = len(dirs)
+        dirs.append((os.path.relpath(d, root).encode(), mtime))
+        stack.extend(sorted(subdirs, reverse=True))
+        dirname = os.path.basename(d)
+        for name in sorted(blobs):
+            m = BLOB_RE.match(name)
+            num = int(m.group('num'))
+            if m.group('page') != dirname or blob_name(dirname, num) != name:
+                LOGGER.warning(
+                    f"manifest: skipping {name}, not named as its directory")
+                continue
+            files.append(os.path.join(d, name))
+            rows.append((idx, num))
+
+    boxes = Parallel(n_jobs=n_jobs, prefer='threads')(delayed(_read_box)(f)
+                                                       for f in files)
+
+    dirs_arr = np.array(dirs,
+                        dtype=[('path', f'S{max(len(p) for p, _ in dirs)}'),
+                               ('mtime', '<i8')])
+    blobs_arr = np.empty(len(rows), dtype=BLOB_DTYPE)
+    if rows:
+        blobs_arr['dir'], blobs_arr['num'] = np.array(rows).T
+        blobs_arr['x0'], blobs_arr['y0'], blobs_arr['x1'], blobs_arr[
+            'y1'] = np.array(boxes).T
+    manifest = Manifest(root, dirs_arr, blobs_arr)
+    _save(root / MANIFEST_DIR / 'blobs.npy', blobs_arr)
+    _save(root / MANIFEST_DIR / 'dirs.npy', dirs_arr)
+    json.dump({'hash': manifest.hash},
+              open(root / MANIFEST_DIR / 'manifest.json', "w"))
+    LOGGER.info(f"manifest: {len(rows)} blobs in {len(dirs)} directories")
+    return manifest
+
+
+def load(root, n_jobs=10):
+    """
+    Memory-maps the manifest of `root`, building it if it doesn't exist or
+    if it is stale
+    """
+    root = Path(root)
+    blobs_fn = root / MANIFEST_DIR / 'blobs.npy'
+    dirs_fn = root / MANIFEST_DIR / 'dirs.npy'
+    meta_fn = root / MANIFEST_DIR / 'manifest.json'
+    if blobs_fn.exists() and dirs_fn.exists():
+        # the hash is computed only for manifests written before it was kept
+        hash = json.load(open(meta_fn))['hash'] if meta_fn.exists() else None
+        manifest = Manifest(root, np.load(dirs_fn),
+                            np.load(blobs_fn, mmap_mode='r'), hash)
+        if hash is None:
+            json.dump({'hash': manifest.hash}, open(meta_fn, "w"))
+        if manifest.refresh():
+            return manifest
+        LOGGER.info("manifest: stale, rebuilding it")
+    return build(root, n_jobs)
+
+
+def main(toml_config: str):
+    import toml
+    conf = toml.load(open(toml_config))
+    build(conf['preprocessing']['blob_dir'])
+
+
+if __name__ == "__main__":
+
+    import sys
+    main(sys.argv[1])
@@ -0,0 +1,177 @@
+"""
+Counters, gauges and latency histograms of the data-entry server, exposed in
+the Prometheus text format by `/metrics`
+"""
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+
+# seconds, from a dictionary lookup to the decoding of a large page
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+REGISTRY = []
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{_escape(v)}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r'\"').replace(
+        "\n", r"\n")
+
+
+class Metric:
+    """
+    A metric with a value for each combination of the values of its
+    `labelnames`; updates take a lock, so they are thread-safe, and cost a
+    few microseconds.
+
+    If `fn` is given, the values are instead read at each scrape from
+    `fn()`, which returns the value or a dict from tuples of label values to
+    values, e.g. to expose the statistics kept by other objects.
+    """
+    kind = "untyped"
+
+    def __init__(self, name, help, labelnames=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.fn = fn
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def samples(self):
+        """
+        The `(name, labels, value)` of the samples of the metric
+        """
+        if self.fn is not None:
+            value = self.fn()
+            with self._lock:
+                self._values = value if isinstance(value, dict) else {
+                    (): value
+                }
+        with self._lock:
+            values = list(self._values.items())
+        return [(self.name, _labels(self.labelnames, k), v)
+                for k, v in values]
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"
+        ]
+        lines += [f"{n}{l} {v}" for n, l, v in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, labels=()):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram(Metric):
+    """
+    The distribution of durations in seconds, in `buckets`
+    """
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            h = self._values.get(labels)
+            if h is None:
+                # counts of each bucket and of +Inf, sum
+                h = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            h[0][i] += 1
+            h[1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        """
+        Observes the duration of the `with` block
+        """
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(k, list(c), s) for k, (c, s) in self._values.items()]
+        out = []
+        names = self.labelnames + ("le", )
+        for k, counts, total in values:
+            cumulative = 0
+            for le, c in zip(self.buckets + ("+Inf", ), counts):
+                cumulative += c
+                out.append(
+                    (f"{self.name}_bucket", _labels(names, k + (le, )),
+                     cumulative))
+            out.append((f"{self.name}_sum", _labels(self.labelnames, k),
+                        total))
+            out.append((f"{self.name}_count", _labels(self.labelnames, k),
+                        cumulative))
+        return out
+
+
+def render():
+    """
+    All the metrics in the Prometheus text format
+    """
+    return "\n".join(m.render() for m in REGISTRY) + "\n"
+
+
+ASK_SECONDS = Histogram("omr_ask_seconds",
+                        "Time to serve a blob with ImageManager.ask",
+                        ["kind"])
+NEXT_JSON_SECONDS = Histogram(
+    "omr_next_json_seconds",
+    "Time to pick the next blob (ImageManager.__get_next_json)")
+SERVE_IMAGE_SECONDS = Histogram(
+    "omr_serve_image_seconds",
+    "Time to prepare a blob (ImageManager.__serve_image)")
+RENDER_SECONDS = Histogram(
+    "omr_render_seconds",
+    "Time of the steps of the rendering of a blob: reading the json and "
+    "decoding the page, encoding the blob, encoding the page preview",
+    ["step"])
+SAVE_ANNOTATION_SECONDS = Histogram(
+    "omr_save_annotation_seconds",
+    "Time to save an annotation (ImageManager.save_annotation)", ["control"])
+UPDATE_RATING_SECONDS = Histogram(
+    "omr_update_rating_seconds",
+    "Time to update the rating of an annotator (ImageManager.update_rating)")
+JSON_READS = Counter("omr_json_reads_total", "Blob jsons read", ["reason"])
+IMAGE_CACHE = Counter(
+    "omr_image_cache_total",
+    "Lookups of the encoded images of the blobs and of the pages",
+    ["kind", "result"])
+ANNOTATIONS = Counter(
+    "omr_annotations_total",
+    "Annotations saved by each annotator (increase(...[1h]) gives the "
+    "annotations per hour)", ["annotator", "control"])
+PREFETCH_QUEUE = Gauge("omr_prefetch_queue",
+                       "Blobs picked in advance for each annotator",
+                       ["annotator"])
@@ -0,0 +1,57 @@
+"""
+Orderings of the blobs in the annotation queue
+"""
+import os
+from collections import defaultdict
+
+import numpy as np
+
+ORDERINGS = ("shuffle", "page")
+
+
+def page_of(blob_json):
+    """
+    The page a blob belongs to, i.e. the directory containing its json
+    """
+    return os.path.dirname(os.path.normpath(str(blob_json)))
+
+
+def shuffle_order(blob_jsons, rng):
+    """
+    All the blobs in random order
+    """
+    out = np.asarray([str(i) for i in blob_jsons])
+    rng.shuffle(out)  # in-place...
+    return out
+
+
+def locality_order(blob_jsons, run_length, rng):
+    """
+    Blobs in runs of at most `run_length` consecutive blobs from the same
+    page. Blobs are shuffled inside each page and then the runs of all pages
+    are shuffled, so pages are still sampled at random (proportionally to the
+    number of their blobs), but the same page is decoded once per run.
+    """
+    pages = defaultdict(list)
+    for b in blob_jsons:
+        pages[page_of(b)].append(str(b))
+
+    runs = []
+    for blobs in pages.values():
+        blobs = [blobs[i] for i in rng.permutation(len(blobs))]
+        for i in range(0, len(blobs), run_length):
+            runs.append(blobs[i:i + run_length])
+
+    out = [b for i in rng.permutation(len(runs)) for b in runs[i]]
+    return np.asarray(out, dtype=str)
+
+
+def order(blob_jsons, ordering, run_length, rng):
+    """
+    Orders `blob_jsons` according to `ordering`, one of `ORDERINGS`
+    """
+    if ordering == "shuffle":
+        return shuffle_order(blob_jsons, rng)
+    elif ordering == "page":
+        return locality_order(blob_jsons, run_length, rng)
+    raise ValueError(f"Unknown ordering {ordering}, use one of {ORDERINGS}")
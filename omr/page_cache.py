@@ -0,0 +1,124 @@
+"""
+A process-wide cache of decoded score pages, bounded by a memory budget
+"""
+import logging
+import threading
+from collections import OrderedDict
+
+from skimage import io
+
+LOGGER = logging.getLogger(__name__)
+
+
+class PageCache:
+    """
+    A thread-safe LRU cache of decoded pages keyed by path. Pages are evicted
+    from the least recently used when the total size of the cached arrays
+    exceeds `budget` bytes.
+
+    Cached arrays are read-only: copy them before drawing on them.
+
+    If two threads ask for the same page while it is being decoded, only one
+    decodes it and the other waits for the result.
+    """
+
+    def __init__(self, budget, loader=io.imread, log_every=100):
+        self.budget = budget
+        self.loader = loader
+        self.log_every = log_every
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._pages = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def get(self, path):
+        """
+        The decoded page at `path`
+        """
+        key = str(path)
+        while True:
+            with self._lock:
+                if key in self._pages:
+                    self.hits += 1
+                    self._pages.move_to_end(key)
+                    return self._pages[key]
+                event = self._loading.get(key)
+                if event is None:
+                    self.misses += 1
+                    event = self._loading[key] = threading.Event()
+                    break
+            # someone else is decoding this page
+            event.wait()
+            with self._lock:
+                if key in self._pages:
+                    self.hits += 1
+                    self._pages.move_to_end(key)
+                    return self._pages[key]
+            # the page was too big or decoding failed: retry
+
+        try:
+            page = self.loader(key)
+            page.setflags(write=False)
+            self.__put(key, page)
+        finally:
+            with self._lock:
+                del self._loading[key]
+            event.set()
+
+        if self.misses % self.log_every == 0:
+            LOGGER.info(f"page cache: {self.stats()}")
+        return page
+
+    def __put(self, key, page):
+        with self._lock:
+            if page.nbytes > self.budget:
+                return
+            self._pages[key] = page
+            self.nbytes += page.nbytes
+            self.__evict()
+
+    def __evict(self):
+        while self.nbytes > self.budget:
+            _, old = self._pages.popitem(last=False)
+            self.nbytes -= old.nbytes
+            self.evictions += 1
+
+    def set_budget(self, budget):
+        with self._lock:
+            self.budget = budget
+            self.__evict()
+
+    def clear(self):
+        with self._lock:
+            self._pages.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """
+        A dict with hits, misses, evictions, number of pages and bytes used
+        """
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "pages": len(self._pages),
+                "bytes": self.nbytes,
+                "budget": self.budget
+            }
+
+
+# shared by all the requests and by the prefetching threads
+PAGE_CACHE = PageCache(1024 * 2**20)
+
+
+def configure(budget_mb):
+    """
+    Sets the memory budget of `PAGE_CACHE` in MiB
+    """
+    PAGE_CACHE.set_budget(int(budget_mb * 2**20))
@@ -0,0 +1,115 @@
+"""
+The record of the pages already preprocessed, so that the preprocessing can
+be run again on the same archive and only processes new or changed pages
+"""
+import os
+import json
+import hashlib
+import logging
+import threading
+from pathlib import Path
+
+from .journal import read_records
+
+LOGGER = logging.getLogger(__name__)
+
+
+def file_hash(fname, chunk=2**20):
+    h = hashlib.sha1()
+    with open(fname, "rb") as f:
+        for block in iter(lambda: f.read(chunk), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def params_hash(params):
+    """
+    The hash of the preprocessing parameters, a json-serializable dict
+    """
+    return hashlib.sha1(json.dumps(params,
+                                   sort_keys=True).encode()).hexdigest()
+
+
+class PageManifest:
+    """
+    For each page (its path relative to `root`), the hash of its content and
+    of the parameters it was processed with, in `fname` (one json record per
+    line, the last one of a page wins).
+
+    A record is appended only after a page is completely processed, so an
+    interrupted run is resumed from the pages that were not finished. The
+    size and modification time of the page are stored as well and the
+    content is hashed again only if they changed.
+    """
+
+    def __init__(self, root, params, fname):
+        self.root = Path(root)
+        self.params = params_hash(params)
+        self.fname = Path(fname)
+        self._lock = threading.Lock()
+        self.pages = {}
+        if self.fname.exists():
+            for r in read_records(self.fname):
+                self.pages[r["page"]] = r
+
+    def __key(self, page):
+        return os.path.relpath(page, self.root)
+
+    def record(self, page):
+        """
+        The record of `page` as it is now on disk
+        """
+        st = os.stat(page)
+        return {
+            "page": self.__key(page),
+            "hash": file_hash(page),
+            "params": self.params,
+            "size": st.st_size,
+            "mtime": st.st_mtime_ns
+        }
+
+    def is_done(self, page):
+        """
+        True if `page` was processed with the current parameters and didn't
+        change since then
+        """
+        old = self.pages.get(self.__key(page))
+        if old is None or old["params"] != self.params:
+            return False
+        st = os.stat(page)
+        if st.st_size == old["size"] and st.st_mtime_ns == old["mtime"]:
+            return True
+        new = self.record(page)
+        if new["hash"] != old["hash"]:
+            return False
+        # touched but not changed
+        self.done(page, new)
+        return True
+
+    def done(self, page, record=None):
+        """
+        Records that `page` has been processed; thread-safe
+        """
+        if record is None:
+            record = self.record(page)
+        with self._lock:
+            self.pages[record["page"]] = record
+            with open(self.fname, "a") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def compact(self):
+        """
+        Rewrites the file with one record per page
+        """
+        if not self.fname.exists():
+            return
+        self.pages = {r["page"]: r for r in read_records(self.fname)}
+        tmp = self.fname.with_name(self.fname.name + ".tmp")
+        with open(tmp, "w") as f:
+            for r in self.pages.values():
+                f.write(json.dumps(r) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.fname)
+        LOGGER.info(f"page manifest: {len(self.pages)} pages")
+
@@ -0,0 +1,302 @@
+"""
+Perceptual hashes of the blobs and a multi-index of them, to find the blobs
+that look almost the same (clefs, rests, borders of the page...)
+
+Usage:
+    phash.py (<toml_config>)
+
+"""
+import os
+import time
+import logging
+from pathlib import Path
+
+import numpy as np
+from scipy import fft
+from skimage import transform, util
+
+LOGGER = logging.getLogger(__name__)
+
+HASH_SIZE = 8
+HASH_VERSION = 1
+CACHE_FN = f'__phash_v{HASH_VERSION}.npy'
+CACHE_DTYPE = np.dtype([('x0', '<i4'), ('y0', '<i4'), ('x1', '<i4'),
+                        ('y1', '<i4'), ('hash', '<u8')])
+# aligned with the blobs of `__manifest/blobs.npy`
+TABLE_FN = 'phash.npy'
+TABLE_DTYPE = np.dtype([('hash', '<u8'), ('valid', '?')])
+
+_BYTE_BITS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def popcount(x):
+    """
+    The number of bits set in each element of the uint64 array `x`
+    """
+    x = np.asarray(x, dtype=np.uint64)
+    if hasattr(np, 'bitwise_count'):
+        return np.bitwise_count(x)
+    return _BYTE_BITS[x.reshape(-1, 1).view(np.uint8)].sum(
+        axis=1, dtype=np.uint8).reshape(x.shape)
+
+
+def phash(blob):
+    """
+    The 64-bit perceptual hash of a blob image: the sign, with respect to
+    their median, of the 8x8 lowest frequencies of the DCT of the blob
+    resized to 32x32. Blobs that differ by noise, a few pixels of ink or
+    their size have hashes that differ by a few bits.
+    """
+    small = transform.resize(util.img_as_float(blob),
+                             (4 * HASH_SIZE, 4 * HASH_SIZE),
+                             anti_aliasing=True)
+    low = fft.dctn(small, norm='ortho')[:HASH_SIZE, :HASH_SIZE].ravel()
+    # the DC component is only the average intensity
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def cached_hashes(page_dir, boxes, crops):
+    """
+    The hashes of the blobs of a page, whose `boxes` and images (`crops`)
+    are given, read from `page_dir/__phash_v*.npy` if they were already
+    computed and computed (and added to the cache) otherwise. Returns the
+    hashes and the number of blobs computed.
+    """
+    page_dir = Path(page_dir)
+    fname = page_dir / CACHE_FN
+    cache = {}
+    if fname.exists():
+        for row in np.load(fname).tolist():
+            cache[row[:4]] = row[4]
+    boxes = [tuple(int(v) for v in b) for b in boxes]
+    missing = {b: c for b, c in zip(boxes, crops) if b not in cache}
+    if missing:
+        cache.update((b, phash(c)) for b, c in missing.items())
+        table = np.array([b + (h, ) for b, h in cache.items()],
+                         dtype=CACHE_DTYPE)
+        page_dir.mkdir(parents=True, exist_ok=True)
+        tmp = page_dir / f"{CACHE_FN}.tmp.npy"
+        np.save(tmp, table)
+        os.replace(tmp, fname)
+    return np.array([cache[b] for b in boxes], dtype=np.uint64), len(missing)
+
+
+class HashIndex:
+    """
+    Finds the hashes within `max_distance` bits of a query, with multi-index
+    hashing: the 64 bits are split in `max_distance + 1` chunks and two
+    hashes that differ by at most `max_distance` bits have at least one
+    chunk in common, so only the hashes that share a chunk with the query
+    are compared with it. Each chunk is a sorted array searched by bisection.
+
+    Lookups take microseconds, unless many hashes share the same chunks (e.g.
+    the many copies of the same symbol), which are compared all at once.
+    """
+
+    def __init__(self, hashes, max_distance=3):
+        self.hashes = np.asarray(hashes, dtype=np.uint64)
+        self.max_distance = max_distance
+        bounds = np.linspace(0, 64, max_distance + 2).astype(int)
+        self._chunks = []
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            shift, mask = np.uint64(lo), np.uint64((1 << int(hi - lo)) - 1)
+            keys = (self.hashes >> shift) & mask
+            order = np.argsort(keys, kind='stable')
+            self._chunks.append((shift, mask, keys[order], order))
+
+    def __len__(self):
+        return self.hashes.shape[0]
+
+    def query(self, h, max_distance=None):
+        """
+        The indices of the hashes within `max_distance` (at most the one of
+        the index) bits from `h` and their distances
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        h = np.uint64(h)
+        found = []
+        for shift, mask, keys, order in self._chunks:
+            k = (h >> shift) & mask
+            lo = np.searchsorted(keys, k, 'left')
+            hi = np.searchsorted(keys, k, 'right')
+            if hi > lo:
+                found.append(order[lo:hi])
+        if not found:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.uint8)
+        found = np.unique(np.concatenate(found))
+        dist = popcount(self.hashes[found] ^ h)
+        near = dist <= max_distance
+        return found[near], dist[near]
+
+
+class NearDuplicates:
+    """
+    The near-duplicates of the blob jsons in `blob_jsons`, given their hashes
+    in a table aligned with them (see `build_table`); blobs without a hash
+    have no near-duplicates.
+    """
+
+    def __init__(self, blob_jsons, table, max_distance=3):
+        self.paths = [os.path.normpath(str(j)) for j in blob_jsons]
+        valid = np.flatnonzero(table['valid'])
+        self._positions = {self.paths[i]: k for k, i in enumerate(valid)}
+        self._valid = valid
+        self.index = HashIndex(table['hash'][valid], max_distance)
+
+    def __call__(self, blob_json):
+        """
+        The json paths of the near-duplicates of `blob_json`, without it
+        """
+        k = self._positions.get(os.path.normpath(str(blob_json)))
+        if k is None:
+            return []
+        found, _ = self.index.query(self.index.hashes[k])
+        return [self.paths[self._valid[i]] for i in found if i != k]
+
+
+def load_table(blob_dir):
+    """
+    The hashes of the blobs in the manifest of `blob_dir`, or None if they
+    were not computed or the manifest was rebuilt since then
+    """
+    from .manifest import MANIFEST_DIR
+
+    fname = Path(blob_dir) / MANIFEST_DIR / TABLE_FN
+    if not fname.exists():
+        return None
+    if os.stat(fname).st_mtime_ns < os.stat(
+            Path(blob_dir) / MANIFEST_DIR / 'blobs.npy').st_mtime_ns:
+        LOGGER.warning(f"{fname} is outdated, run `pdm phash`")
+        return None
+    return np.load(fname)
+
+
+def build_table(blob_dir):
+    """
+    Collects the cached hashes of the blobs in the manifest of `blob_dir` in
+    `__manifest/phash.npy`, aligned with the manifest, and returns it
+    """
+    from .manifest import MANIFEST_DIR, _save, load
+
+    manifest = load(blob_dir)
+    table = np.zeros(len(manifest), dtype=TABLE_DTYPE)
+    pages = {}
+    fields = ['dir', 'x0', 'y0', 'x1', 'y1']
+    for i, (d, *box) in enumerate(manifest.blobs[fields].tolist()):
+        pages.setdefault(d, []).append((i, tuple(box)))
+    for d, blobs in pages.items():
+        fname = Path(manifest.dir_paths[d]) / CACHE_FN
+        if not fname.exists():
+            continue
+        cache = {row[:4]: row[4] for row in np.load(fname).tolist()}
+        for i, box in blobs:
+            if box in cache:
+                table[i] = (cache[box], True)
+    _save(Path(blob_dir) / MANIFEST_DIR / TABLE_FN, table)
+    LOGGER.info(f"phash: {np.count_nonzero(table['valid'])}/{len(table)} "
+                "blobs hashed")
+    return table
+
+
+def _page_hashes(page_dir, nostaff_path, boxes):
+    from skimage import io
+    image = io.imread(nostaff_path)
+    crops = [image[x0:x1, y0:y1] for x0, y0, x1, y1 in boxes]
+    _, n = cached_hashes(page_dir, boxes, crops)
+    return len(boxes), n
+
+
+def extract(input_dir, blob_dir, n_jobs=None):
+    """
+    Computes and caches the hashes of all the blobs in the manifest of
+    `blob_dir`, in parallel over the pages, and collects them with
+    `build_table`
+    """
+    from joblib import Parallel, delayed
+    from tqdm import tqdm
+
+    from .manifest import load
+
+    input_dir, blob_dir = Path(input_dir), Path(blob_dir)
+    manifest = load(blob_dir)
+    boxes = {}
+    fields = ['dir', 'x0', 'y0', 'x1', 'y1']
+    for d, *box in manifest.blobs[fields].tolist():
+        boxes.setdefault(d, []).append(box)
+    jobs = []
+    for d, page_boxes in boxes.items():
+        page_dir = Path(manifest.dir_paths[d])
+        nostaff_path = input_dir / page_dir.relative_to(blob_dir).with_suffix(
+            '.jpg')
+        jobs.append(delayed(_page_hashes)(page_dir, nostaff_path, page_boxes))
+    res = Parallel(n_jobs=n_jobs or os.cpu_count())(tqdm(jobs))
+    print(f"{sum(n for n, _ in res)} blobs, "
+          f"{sum(n for _, n in res)} hashes computed")
+    return build_table(blob_dir)
+
+
+def report(blob_dir, max_distance=3, control_json_fn='__control.json'):
+    """
+    Prints how many blobs of the annotation queue would not need to be
+    annotated if each annotation was copied to the near-duplicates of the
+    blob (as with `near_duplicates = "propagate"`), for each distance up to
+    `max_distance`: the queue (from `control_json_fn`, or the manifest) is
+    visited in order and the near-duplicates of each blob still in the queue
+    are removed from it. Also prints the time of a lookup.
+    """
+    import json
+
+    from .manifest import load
+
+    manifest = load(blob_dir)
+    table = load_table(blob_dir)
+    if table is None:
+        raise RuntimeError("no hashes, run `pdm phash` first")
+    paths = [os.path.normpath(p) for p in manifest]
+    if os.path.exists(control_json_fn):
+        positions = {p: i for i, p in enumerate(paths)}
+        queue = [
+            positions[os.path.normpath(p)]
+            for p in json.load(open(control_json_fn))['normal']
+            if os.path.normpath(p) in positions
+        ]
+    else:
+        queue = list(range(len(paths)))
+    queue = [i for i in queue if table['valid'][i]]
+    hashes = table['hash'][queue]
+    index = HashIndex(hashes, max_distance)
+    print(f"{len(queue)} blobs with a hash in the queue, "
+          f"{np.unique(hashes).size} distinct hashes")
+
+    for d in range(max_distance + 1):
+        removed = np.zeros(len(queue), dtype=bool)
+        times = []
+        for k in range(len(queue)):
+            if removed[k]:
+                continue
+            t0 = time.perf_counter()
+            found, _ = index.query(hashes[k], d)
+            times.append(time.perf_counter() - t0)
+            removed[found[found > k]] = True
+        n = int(np.count_nonzero(removed))
+        print(f"distance <= {d}: {n} blobs removed "
+              f"({100 * n / max(1, len(queue)):.1f}% of the queue), lookup "
+              f"{1e6 * np.mean(times):.0f} us on average, "
+              f"{1e6 * np.max(times):.0f} us at most")
+
+
+def main(toml_config: str):
+    import toml
+    conf = toml.load(open(toml_config))
+    s = conf['preprocessing']
+    extract(s['input_dir'], s['blob_dir'], s.get('cpu_workers'))
+    report(s['blob_dir'],
+           conf['data_entry'].get('near_duplicate_distance', 3))
+
+
+if __name__ == "__main__":
+
+    import sys
+    main(sys.argv[1])
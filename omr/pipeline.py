@@ -0,0 +1,112 @@
+"""
+A streaming pipeline of stages connected by bounded queues
+"""
+import logging
+import queue
+import threading
+from dataclasses import dataclass
+from typing import Callable
+
+LOGGER = logging.getLogger(__name__)
+
+_END = object()
+
+
+@dataclass
+class Stage:
+    """
+    A stage of the pipeline: `workers` threads apply `fn` to the items; items
+    for which `fn` returns None are dropped.
+
+    For CPU-bound work, `fn` should submit the work to a process pool and
+    wait for it, so that `workers` is the number of processes kept busy.
+    """
+    name: str
+    fn: Callable
+    workers: int = 1
+
+
+class Pipeline:
+    """
+    Runs `stages` on the items of `source` (any iterable, consumed lazily).
+    Each stage reads from a queue of at most `queue_size` items, so a slow
+    stage blocks the previous ones instead of letting items pile up in
+    memory.
+
+    Iterating over the pipeline yields the outputs of the last stage, in
+    completion order. Exceptions raised by a stage are logged and the item
+    is dropped; `errors` counts them for each stage. An exception raised by
+    `source` stops the pipeline and is raised again by the iteration, once
+    the items already read have gone through.
+    """
+
+    def __init__(self, source, stages, queue_size=8):
+        self.source = source
+        self.stages = stages
+        self.queues = [queue.Queue(queue_size) for _ in range(len(stages) + 1)]
+        self.errors = {s.name: 0 for s in stages}
+        self._lock = threading.Lock()
+        self._running = [s.workers for s in stages]
+        self._threads = []
+        self._source_error = None
+
+    def __feed(self):
+        try:
+            for item in self.source:
+                self.queues[0].put(item)
+        except Exception as e:
+            self._source_error = e
+        finally:
+            # the workers must stop in any case
+            for _ in range(self.stages[0].workers):
+                self.queues[0].put(_END)
+
+    def __work(self, i):
+        stage = self.stages[i]
+        q_in, q_out = self.queues[i], self.queues[i + 1]
+        while True:
+            item = q_in.get()
+            if item is _END:
+                break
+            try:
+                out = stage.fn(item)
+            except Exception:
+                LOGGER.exception(f"pipeline: {stage.name} failed")
+                with self._lock:
+                    self.errors[stage.name] += 1
+                continue
+            if out is not None:
+                q_out.put(out)
+        with self._lock:
+            self._running[i] -= 1
+            last = self._running[i] == 0
+        if last:
+            # the next stage stops when all the workers of this one are done
+            n_next = self.stages[i + 1].workers if i + 1 < len(
+                self.stages) else 1
+            for _ in range(n_next):
+                q_out.put(_END)
+
+    def __iter__(self):
+        self._threads = [
+            threading.Thread(target=self.__feed, name='pipeline-source',
+                             daemon=True)
+        ]
+        for i, stage in enumerate(self.stages):
+            self._threads += [
+                threading.Thread(target=self.__work,
+                                 args=(i, ),
+                                 name=f'pipeline-{stage.name}-{j}',
+                                 daemon=True) for j in range(stage.workers)
+            ]
+        for t in self._threads:
+            t.start()
+        while True:
+            item = self.queues[-1].get()
+            if item is _END:
+                break
+            yield item
+        for t in self._threads:
+            t.join()
+        if self._source_error is not None:
+            raise self._source_error
@@ -6,22 +6,36 @@ Usage:
 
 """
 from pathlib import Path
-import subprocess
 from typing import Optional
 import tempfile
 from dataclasses import dataclass
 import json
+import os
 
 from sklearn.decomposition import PCA
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import AgglomerativeClustering
-from skimage import io, feature, exposure, util, transform
+from skimage import io, feature, exposure, util
 import numpy as np
-from joblib import Parallel, delayed
 from tqdm import tqdm
 
-lbp_radius = 3
-lbp_n_points = 8 * lbp_radius
+from .blob_store import pack_page
+from .detection import DETECTORS, detect_tiled
+from .features import FeatureExtractor, cached_features
+from .phash import cached_hashes
+from .journal import atomic_json_dump
+from .page_manifest import PageManifest
+
+# parameters of `find_blobs`
+BLOB_PARAMS = dict(min_sigma=10, max_sigma=50, threshold=0.1)
+# fields written by `process` in the blob jsons; any other field is an
+# annotation
+BLOB_FIELDS = {
+    "x0", "y0", "x1", "y1", "path", "parent", "id", "cluster",
+    "archive_cluster"
+}
+# the name of the record of the processed pages in `blob_dir`
+PAGE_MANIFEST_FN = '__preprocess.jsonl'
 
 
 @dataclass
@@ -33,156 +47,408 @@ class Blob:
     y1: int
 
 
-def remove_staffs(self,
-                  fname: Optional[Path] = None,
+_WORKER = None
+
+
+def staff_removal_worker(page):
+    """
+    The `omr.staff_removal.StaffRemovalWorker` shared by the calls to
+    `remove_staffs`, started at the first call and checked against `demo.py`
+    on its `page`
+    """
+    global _WORKER
+    if _WORKER is None:
+        import atexit
+        from .staff_removal import StaffRemovalWorker
+        worker = StaffRemovalWorker()
+        atexit.register(worker.close)
+        worker.check(page)
+        _WORKER = worker
+    return _WORKER
+
+
+def remove_staffs(fname: Optional[Path] = None,
                   image: Optional[np.ndarray] = None):
     """ Run the staff-removal algorithm. If `fname` is None, `image` is used
     and an array is returned, otherise, `fname` is used and a filename is returned.
 
-    For some reason, it doesn't work
+    The model is loaded once, by the first call, and kept in a worker process,
+    which is first checked against `demo.py` on the page.
     """
-    import os
     assert fname is not None or image is not None, "Please, provide a file or an array"
 
     if image is not None:
-        _, fname = tempfile.mkstemp('.jpg')
-        io.imsave(fname, image)
-
+        with tempfile.TemporaryDirectory() as tmpdir:
+            fname = Path(tmpdir) / 'page.png'
+            outfname = Path(tmpdir) / 'page_nostaff.png'
+            io.imsave(fname, image, check_contrast=False)
+            staff_removal_worker(fname).remove(fname, outfname)
+            return io.imread(outfname)
+
+    fname = Path(fname)
     outfname = str(fname.with_suffix('')) + '_nostaff.jpg'
-    proj_dir = Path('__file__').parent.parent
-    subprocess.run(
-        ['bash', str(proj_dir / 'preprocess.sh'),
-         str(fname), outfname])
+    return Path(staff_removal_worker(fname).remove(fname, outfname))
 
-    if image is not None:
-        out = io.imread(outfname)
-        os.remove(outfname)
-    else:
-        out = outfname
 
+def detect_boxes(image,
+                 method=feature.blob_dog,
+                 tile_size=0,
+                 executor=None,
+                 min_ink=1,
+                 **options):
+    """
+    The bounding boxes `(x0, y0, x1, y1)` of the blobs in `image`; only the
+    boxes are returned, so that it can run in another process cheaply.
+
+    `method` is a callable or the name of one of `omr.detection.DETECTORS`;
+    `options` are passed to it. If `tile_size` is not 0, the page is split
+    in tiles processed in `executor` (see `omr.detection.detect_tiled`).
+    """
+    if isinstance(method, str):
+        method = DETECTORS[method]
+    if tile_size:
+        blobs = detect_tiled(image, method, tile_size, executor, min_ink,
+                             **BLOB_PARAMS, **options)
+    else:
+        blobs = method(image, **BLOB_PARAMS, **options)
+    if len(blobs) and len(blobs[0]) == 4:
+        # already boxes
+        return [tuple(int(v) for v in b) for b in blobs]
+    out = []
+    for x, y, r in blobs:
+        x, y, r = int(x), int(y), round(r)
+        x0 = max(0, x - r)
+        x1 = min(image.shape[0], x + r)
+        y0 = max(0, y - r)
+        y1 = min(image.shape[1], y + r)
+        out.append((x0, y0, x1, y1))
     return out
 
 
-def find_blobs(image, method=feature.blob_dog):
+def crop_blobs(image, boxes):
+    return [
+        Blob(image[x0:x1, y0:y1], x0, y0, x1, y1)
+        for x0, y0, x1, y1 in boxes
+    ]
+
+
+def find_blobs(image, method=feature.blob_dog, **options):
     """
     Arguments
     ---------
     `image` : np.ndarray
-    `method` : callable
+    `method` : callable or str
+        see `detect_boxes`
+    `options` :
+        keyword arguments of `method`
 
     Returns
     -------
     list of np.ndarray :
         a list of images, each containing one blob
     """
-    out = []
-    blobs = method(image, min_sigma=10, max_sigma=50, threshold=0.1)
-    for x, y, r in blobs:
-        x, y, r = int(x), int(y), round(r)
-        x0 = max(0, x - r)
-        x1 = min(image.shape[0], x + r)
-        y0 = max(0, y - r)
-        y1 = min(image.shape[1], y + r)
-        blob = image[x0:x1, y0:y1]
-        out.append(Blob(blob, x0, y0, x1, y1))
+    return crop_blobs(image, detect_boxes(image, method, **options))
 
-    return out
 
+def cluster_blobs(blobs, page_dir=None):
+    """
+    Clusters the blobs of a page according to their Hough peaks and
+    histograms; returns the cluster of each blob. If `page_dir` is given,
+    the features are cached there (see `omr.features.cached_features`).
+    """
+    boxes = [(b.x0, b.y0, b.x1, b.y1) for b in blobs]
+    crops = [b.image for b in blobs]
+    if page_dir is None:
+        data = FeatureExtractor()(crops)
+    else:
+        data, _ = cached_features(page_dir, boxes, crops)
+    data = StandardScaler().fit_transform(data)
+    data = PCA(n_components=min(10, min(data.shape[0],
+                                        data.shape[1]))).fit_transform(data)
+    return AgglomerativeClustering(distance_threshold=10,
+                                   n_clusters=None).fit_predict(data)
 
-def process(filename: Path,
-            from_path: Path,
-            to_path: Path,
-            staff_removal=False,
-            clustering=False):
-    original_filename = filename
+
+def load_page(filename: Path, staff_removal=False):
+    """
+    Returns the path of the page to process, i.e. `filename` or the page
+    without staff, and its image
+    """
     if staff_removal:
         filename = remove_staffs(fname=filename)
-
-    image = io.imread(filename)
-
-    blobs = find_blobs(image)
-
-    data = []
-    if clustering:
-        for blob_obj in blobs:
-            blob = blob_obj.image
-            # circular Hough peaks
-            radii = [3, 6, 12, 24, 48]
-            hspaces = transform.hough_circle(blob, radii)
-            peaks, _, _, _ = transform.hough_circle_peaks(hspaces,
-                                                          radii,
-                                                          threshold=0,
-                                                          num_peaks=2)
-            cpeaks = np.zeros(10)
-            cpeaks[:peaks.shape[0]] = peaks
-            # line Hough peaks
-            hspaces, angles, dist = transform.hough_line(blob)
-            peaks, _, _ = transform.hough_line_peaks(hspaces,
-                                                     angles,
-                                                     dist,
-                                                     threshold=0,
-                                                     num_peaks=10)
-            lpeaks = np.zeros(10)
-            lpeaks[:peaks.shape[0]] = peaks
-            # lbp histogram
-            lbp_hist, _ = exposure.histogram(feature.local_binary_pattern(
-                blob, lbp_n_points, lbp_radius, method='var'),
-                                             nbins=10,
-                                             source_range='dtype')
-            # histogram
-            hist, _ = exposure.histogram(util.img_as_float(blob),
-                                         nbins=10,
-                                         source_range='dtype')
-            # data.append(np.concatenate([lbp_hist, hist, [blob.size]]))
-            data.append(
-                np.concatenate([lbp_hist, hist, lpeaks, cpeaks, [blob.size]]))
-        data = StandardScaler().fit_transform(data)
-        data = PCA(n_components=min(10, min(
-            data.shape[0], data.shape[1]))).fit_transform(data)
-        clusters = AgglomerativeClustering(distance_threshold=10,
-                                           n_clusters=None).fit_predict(data)
-
+    return filename, io.imread(filename)
+
+
+def save_page(original_filename: Path,
+              filename: Path,
+              blobs,
+              from_path: Path,
+              to_path: Path,
+              clustering=False,
+              pack=False,
+              hashing=False,
+              keep=frozenset()):
+    """
+    Writes the blobs of a page and the page json; if `pack` is True, the
+    blobs are also packed in a `omr.blob_store` store and if `hashing` is
+    True their perceptual hashes are cached (see `omr.phash`); the blobs in
+    `keep` are kept as they are (see `write_blobs`)
+    """
     to_root = to_path / filename.relative_to(from_path).with_suffix('')
     to_root.mkdir(parents=True, exist_ok=True)
+    clusters = cluster_blobs(blobs, to_root) if clustering else None
+    if hashing:
+        cached_hashes(to_root, [(b.x0, b.y0, b.x1, b.y1) for b in blobs],
+                      [b.image for b in blobs])
 
     json_data = {
         "img_path": str(original_filename),
         "nostaff_path": str(filename),
-        "blobs": []
+        "blobs": write_blobs(blobs, to_root, filename.stem,
+                             original_filename, clusters, keep)
     }
+    if pack:
+        pack_page(to_root)
+    atomic_json_dump(json_data, original_filename.with_suffix('.json'))
+
+
+def process(filename: Path,
+            from_path: Path,
+            to_path: Path,
+            staff_removal=False,
+            clustering=False,
+            detector="dog",
+            detector_options={}):
+    original_filename = filename
+    filename, image = load_page(filename, staff_removal)
+    blobs = find_blobs(image, detector, **detector_options)
+    save_page(original_filename, filename, blobs, from_path, to_path,
+              clustering)
+
+
+def listed_blobs(control_json_fn='__control.json'):
+    """
+    The absolute paths of the blob jsons in the control and normal splits
+    written by the data-entry server (see `omr.allocator.BlobAllocator`), also
+    read from `<control_json_fn>.xz`; empty if there is no split
+    """
+    fname = Path(control_json_fn)
+    if fname.exists():
+        data = json.load(open(fname))
+    elif fname.with_name(fname.name + '.xz').exists():
+        import lzma
+        data = json.load(lzma.open(fname.with_name(fname.name + '.xz'), "rt"))
+    else:
+        return frozenset()
+    return frozenset(
+        os.path.abspath(p) for p in data['control'] + data['normal'])
+
+
+def annotated_blobs(to_root: Path, keep=frozenset()):
+    """
+    The blob jsons in `to_root` that contain annotations or whose absolute
+    path is in `keep`, as a dict from blob number to json content
+    """
+    out = {}
+    for fname in to_root.glob('*_blob*.json'):
+        data = json.load(open(fname))
+        if set(data) - BLOB_FIELDS or os.path.abspath(fname) in keep:
+            out[data["id"]] = data
+    return out
+
+
+def write_blobs(blobs,
+                to_root: Path,
+                stem: str,
+                parent: Path,
+                clusters=None,
+                keep=frozenset()):
+    """
+    Writes the png and the json of each blob in `to_root` and returns the
+    list of json paths.
+
+    Blob jsons already containing annotations or listed in `keep` (see
+    `listed_blobs`: the annotations of the control blobs are in
+    `__annotator.json` and the splits refer to the blobs by path) are never
+    overwritten: if the same box is found again, the old blob is kept in
+    place of the new one, otherwise the new blobs are numbered skipping the
+    old ones. The other blobs of a previous run are removed.
+    """
+    annotated = annotated_blobs(to_root, keep)
+    boxes = {(b["x0"], b["y0"], b["x1"], b["y1"]) for b in annotated.values()}
+    written = set()
+    num = 0
     for i, blob_obj in enumerate(blobs):
+        if (blob_obj.x0, blob_obj.y0, blob_obj.x1, blob_obj.y1) in boxes:
+            continue
+        while num in annotated:
+            num += 1
         blob = blob_obj.image
         blob = exposure.rescale_intensity(blob, out_range='float')
         blob = util.img_as_uint(blob)
         # blob = exposure.equalize_hist(blob)
-        blob_path = to_root / f"{filename.stem}_blob{i:03d}.png"
-        io.imsave(blob_path, blob)
+        blob_path = to_root / f"{stem}_blob{num:03d}.png"
+        io.imsave(blob_path, blob, check_contrast=False)
 
         # storing into the json structure
         blob_obj.path = str(blob_path)
-        blob_obj.parent = str(original_filename)
-        blob_obj.id = i
-        if clustering:
-            blob_obj.cluster = clusters[i]
+        blob_obj.parent = str(parent)
+        blob_obj.id = num
+        if clusters is not None:
+            blob_obj.cluster = int(clusters[i])
         del blob_obj.image
-        blob_json_path = str(blob_path.with_suffix('.json'))
-        json.dump(blob_obj.__dict__, open(blob_json_path, "w"))
-        json_data["blobs"].append(blob_json_path)
-
-    json.dump(json_data, open(original_filename.with_suffix('.json'), "w"))
+        atomic_json_dump(blob_obj.__dict__, blob_path.with_suffix('.json'))
+        written.add(num)
+        num += 1
+
+    # blobs of a previous run that were not found again
+    for fname in to_root.glob('*_blob*.json'):
+        data = json.load(open(fname))
+        if data["id"] not in written and data["id"] not in annotated:
+            fname.unlink()
+            fname.with_suffix('.png').unlink(missing_ok=True)
+
+    return [
+        str(to_root / f"{stem}_blob{n:03d}.json")
+        for n in sorted(written | set(annotated))
+    ]
+
+
+def preprocess_params(staff_removal=False,
+                      clustering=False,
+                      detector="dog",
+                      detector_options={},
+                      tile_size=0,
+                      min_ink=1):
+    """
+    The parameters that affect the output of `process` and of
+    `preprocess_pipeline`: pages processed with different parameters are
+    processed again. The tiling options are only included when tiles are
+    used, so that the pages processed without tiles stay valid.
+    """
+    params = {
+        "blobs": BLOB_PARAMS,
+        "staff_removal": staff_removal,
+        "clustering": clustering,
+        "detector": detector,
+        "detector_options": detector_options
+    }
+    if tile_size:
+        params["tile_size"] = tile_size
+        params["min_ink"] = min_ink
+    return params
+
+
+def preprocess_pipeline(pages,
+                        from_path: Path,
+                        to_path: Path,
+                        page_manifest: PageManifest,
+                        cpu_executor,
+                        io_workers=4,
+                        cpu_workers=4,
+                        queue_size=8,
+                        staff_removal=False,
+                        clustering=False,
+                        detector="dog",
+                        detector_options={},
+                        tile_size=0,
+                        min_ink=1,
+                        pack=False,
+                        hashing=False,
+                        keep=frozenset()):
+    """
+    A `omr.pipeline.Pipeline` that processes `pages` as `process` does, in
+    three stages:
+    * `io_workers` threads skip the pages in `page_manifest` and read the
+      others
+    * `cpu_workers` threads send the detection to `cpu_executor`, a process
+      pool; if `tile_size` is not 0, each page is split in tiles detected in
+      parallel, so that large pages don't keep a single process busy
+    * `io_workers` threads write the blobs (packing them if `pack` is True
+      and hashing them if `hashing` is True), keeping the blobs in `keep`
+      (see `write_blobs`), and record the pages in `page_manifest`
+
+    It yields the processed pages.
+    """
+    from .pipeline import Pipeline, Stage
+
+    def decode(page):
+        if page_manifest.is_done(page):
+            return None
+        return (page, ) + load_page(page, staff_removal)
+
+    def detect(item):
+        page, filename, image = item
+        if tile_size:
+            boxes = detect_boxes(image, detector, tile_size, cpu_executor,
+                                 min_ink, **detector_options)
+        else:
+            boxes = cpu_executor.submit(detect_boxes, image, detector,
+                                        **detector_options).result()
+        return page, filename, image, boxes
+
+    def write(item):
+        page, filename, image, boxes = item
+        save_page(page, filename, crop_blobs(image, boxes), from_path,
+                  to_path, clustering, pack, hashing, keep)
+        page_manifest.done(page)
+        return page
+
+    return Pipeline(pages, [
+        Stage('decode', decode, io_workers),
+        Stage('detect', detect, cpu_workers),
+        Stage('write', write, io_workers)
+    ], queue_size)
 
 
 def main(toml_config: str):
+    import os
     import toml
+    from concurrent.futures import ProcessPoolExecutor
     conf = toml.load(open(toml_config))
-    to_path = Path(conf['preprocessing']['blob_dir'])
-    in_path = Path(conf['preprocessing']['input_dir'])
+    s = conf['preprocessing']
+    to_path = Path(s['blob_dir'])
+    in_path = Path(s['input_dir'])
     in_pattern = in_path.glob('**/*_nostaff.jpg')
-
-    Parallel(n_jobs=10,
-             backend='multiprocessing')(delayed(process)(
-                 file, in_path, to_path, staff_removal=False, clustering=False)
-                                        for file in tqdm(list(in_pattern)))
+    cpu_workers = s.get('cpu_workers', 0) or os.cpu_count()
+
+    detector = s.get('detector', 'dog')
+    kwargs = dict(staff_removal=False,
+                  clustering=False,
+                  detector=detector,
+                  detector_options=s.get(detector, {}))
+    tile_size, min_ink = s.get('tile_size', 0), s.get('min_ink', 1)
+    page_manifest = PageManifest(
+        in_path, preprocess_params(tile_size=tile_size,
+                                   min_ink=min_ink,
+                                   **kwargs), to_path / PAGE_MANIFEST_FN)
+    # new pages, pages changed since the last run and pages not finished by
+    # an interrupted run are processed, the others are skipped
+    with ProcessPoolExecutor(cpu_workers) as executor:
+        pipeline = preprocess_pipeline(in_pattern,
+                                       in_path,
+                                       to_path,
+                                       page_manifest,
+                                       executor,
+                                       io_workers=s.get('io_workers', 4),
+                                       cpu_workers=cpu_workers,
+                                       queue_size=s.get('queue_size', 8),
+                                       tile_size=tile_size,
+                                       min_ink=min_ink,
+                                       pack=s.get('pack', False),
+                                       hashing=s.get('phash', False),
+                                       keep=listed_blobs(),
+                                       **kwargs)
+        n = sum(1 for _ in tqdm(pipeline, desc="pages processed"))
+    print(f"{n} pages processed, errors: {pipeline.errors}")
+    page_manifest.compact()
+
+    # the list of blobs read by the data-entry server
+    from .manifest import build
+    build(to_path)
+    if s.get('phash', False):
+        from .phash import build_table
+        build_table(to_path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,117 @@
+"""
+Functions to prepare the images shown to the annotators, encoded in memory
+"""
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+
+def draw_rectangle(image, x0, y0, x1, y1, color=(255, 0, 0)):
+    xmax = image.shape[0] - 1
+    ymax = image.shape[1] - 1
+    x0 = max(0, x0)
+    y0 = max(0, y0)
+    x1 = min(xmax, x1)
+    y1 = min(ymax, y1)
+    image[x0:x1, y0, :] = color
+    image[x0:x1, y1, :] = color
+    image[x0, y0:y1, :] = color
+    image[x1, y0:y1, :] = color
+    return image
+
+
+def as_rgb(image):
+    """
+    Returns a 3-channels version of `image`, so that a colored rectangle can
+    be drawn on it
+    """
+    if image.ndim == 2:
+        return np.stack([image] * 3, axis=-1)
+    if image.shape[2] == 4:
+        return image[..., :3]
+    return image
+
+
+def encode_jpeg(image, quality=85):
+    """
+    Encodes an RGB `np.ndarray` as JPEG and returns the bytes
+    """
+    buf = BytesIO()
+    Image.fromarray(image).save(buf, format='JPEG', quality=quality)
+    return buf.getvalue()
+
+
+def downscale(image, max_side):
+    """
+    Returns `image` resized so that its longest side is at most `max_side`
+    pixels, and the scale factor used
+    """
+    scale = min(1.0, max_side / max(image.shape[:2]))
+    if scale == 1.0:
+        return image.copy(), scale
+    pil = Image.fromarray(image).resize(
+        (round(image.shape[1] * scale), round(image.shape[0] * scale)),
+        Image.Resampling.BILINEAR,
+        reducing_gap=2.0)
+    return np.asarray(pil).copy(), scale
+
+
+def crop_blob(image, b, enlarge):
+    """
+    Cuts the region of blob `b` enlarged by `enlarge` pixels and draws the
+    blob rectangle in it
+    """
+    x_max = image.shape[0]
+    y_max = image.shape[1]
+    e = enlarge
+    x0 = max(0, b["x0"] - e)
+    x1 = min(x_max, b["x1"] + e)
+    y0 = max(0, b["y0"] - e)
+    y1 = min(y_max, b["y1"] + e)
+    # only the crop is converted, never the whole (cached) page
+    section = as_rgb(image[x0:x1, y0:y1])
+    if np.shares_memory(section, image):
+        section = section.copy()
+    return draw_rectangle(section, b["x0"] - x0, b["y0"] - y0,
+                          b["x1"] - x1 or x_max, b["y1"] - y1 or y_max)
+
+
+def page_preview(image, max_side):
+    """
+    A downscaled version of the whole page, in RGB; the blob rectangle is drawn over
+    it by the browser (see `box_overlay`), so the same image serves all the
+    blobs of the page
+    """
+    preview, _ = downscale(image, max_side)
+    return as_rgb(preview)
+
+
+def page_tile(image, row, col, tile_size):
+    """
+    The full-resolution tile at (`row`, `col`) of the page, in RGB
+    """
+    x0 = row * tile_size
+    y0 = col * tile_size
+    return as_rgb(image[x0:x0 + tile_size, y0:y0 + tile_size])
+
+
+def box_overlay(shape, b, color="red"):
+    """
+    An SVG drawing the rectangle of blob `b` over an image of the page of
+    `shape` (the full-resolution one or any scaled version of it): it must
+    be placed over the image, with the same size
+    """
+    h, w = shape[:2]
+    return (f'<svg class="overlay" viewBox="0 0 {w} {h}" '
+            'preserveAspectRatio="none">'
+            f'<rect x="{b["y0"]}" y="{b["x0"]}" width="{b["y1"] - b["y0"]}" '
+            f'height="{b["x1"] - b["x0"]}" fill="none" stroke="{color}" '
+            'stroke-width="2" vector-effect="non-scaling-stroke"/></svg>')
+
+
+def n_tiles(shape, tile_size):
+    """
+    The number of rows and columns of tiles covering an image of `shape`
+    """
+    return -(-shape[0] // tile_size), -(-shape[1] // tile_size)
@@ -1,27 +1,96 @@
+import json
 from pathlib import Path
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import toml
 import numpy as np
-from flask import Flask, request
+from flask import (Flask, Response, request, abort, url_for, make_response,
+                   jsonify)
 
-from .image_manager import ImageManager, EndedHistoryException, AskException
+from .image_manager import (ImageManager, EndedHistoryException, AskException,
+                            blob_uid)
+from .render import box_overlay
+from .allocator import BlobAllocator, Reconciler
+from .journal import Journal
+from . import page_cache, manifest, phash, metrics
 
 app = Flask(__name__, static_url_path='/static', root_path='.')
 
 config = toml.load(open('./config.toml'))
 # settings
 s = config['data_entry']
-BLOB_JSONS = list(
-    Path(config['preprocessing']['blob_dir']).glob("**/*_blob*.json"))
+# read from the manifest written by the preprocessing, if it is up to date
+BLOB_JSONS = manifest.load(config['preprocessing']['blob_dir'])
 
 ORIGINAL_IN = Path(config['preprocessing']['input_dir'])
 ORIGINAL_IN_PARTS = len(ORIGINAL_IN.parts)
-IMAGE_MANAGER = ImageManager(BLOB_JSONS,
-                             s["annotation_field"],
-                             s["annotator"],
-                             control_length=s["control_length"],
-                             control_freq=s["control_freq"],
-                             static_dir='./static')
+page_cache.configure(s["page_cache_mb"])
+# shared by all the annotators
+if s["journal"]:
+    JOURNAL = Journal('__annotator.json',
+                      s["control_length"],
+                      fsync_interval=s["journal_fsync_interval"],
+                      compact_interval=s["journal_compact_interval"])
+else:
+    JOURNAL = None
+# near-duplicate blobs, from the hashes computed by `pdm phash`
+DUPLICATES = None
+if s.get("near_duplicates", "off") != "off":
+    _table = phash.load_table(config['preprocessing']['blob_dir'])
+    if _table is not None:
+        DUPLICATES = phash.NearDuplicates(BLOB_JSONS, _table,
+                                          s["near_duplicate_distance"])
+ALLOCATOR = BlobAllocator(BLOB_JSONS,
+                          s["annotation_field"],
+                          control_length=s["control_length"],
+                          ordering=s["ordering"],
+                          run_length=s["run_length"],
+                          lease_timeout=s["lease_timeout"],
+                          journal=JOURNAL,
+                          duplicates=DUPLICATES,
+                          duplicates_mode=s.get("near_duplicates", "off"))
+# looks for skipped blobs in background
+RECONCILER = Reconciler(ALLOCATOR,
+                        batch=s["reconcile_batch"],
+                        pause=s["reconcile_pause"],
+                        interval=s["reconcile_interval"])
+RECONCILER.start()
+EXECUTOR = ThreadPoolExecutor(max_workers=s["prefetch_workers"],
+                              thread_name_prefix='prefetch')
+# one `ImageManager` for each annotator
+SESSIONS = {}
+SESSIONS_LOCK = threading.Lock()
+
+# statistics kept by the shared objects, read when `/metrics` is scraped
+metrics.Counter(
+    "omr_page_cache_total", "Lookups of the decoded pages", ["result"],
+    lambda: {
+        ("hit", ): page_cache.PAGE_CACHE.hits,
+        ("miss", ): page_cache.PAGE_CACHE.misses
+    })
+metrics.Counter("omr_page_cache_evictions_total",
+                "Decoded pages evicted from the cache",
+                fn=lambda: page_cache.PAGE_CACHE.evictions)
+metrics.Gauge("omr_page_cache_bytes",
+              "Memory used by the decoded pages",
+              fn=lambda: page_cache.PAGE_CACHE.nbytes)
+metrics.Gauge("omr_current_normal_idx",
+              "Position of the next normal blob to lease",
+              fn=lambda: ALLOCATOR.current_normal_idx)
+metrics.Gauge("omr_normal_blobs",
+              "Normal blobs, annotated or not", ["state"],
+              fn=lambda: {
+                  ("annotated", ): ALLOCATOR.index.n_annotated,
+                  ("total", ): len(ALLOCATOR.normal_jsons)
+              })
+metrics.Gauge("omr_leases", "Normal blobs leased to the annotators",
+              fn=lambda: len(ALLOCATOR.leases))
+metrics.Gauge("omr_skipped_blobs",
+              "Skipped blobs found by the reconciler, waiting to be leased",
+              fn=lambda: len(ALLOCATOR._gaps))
+metrics.Gauge("omr_sessions", "Annotators with a session",
+              fn=lambda: len(SESSIONS))
 RNG = np.random.default_rng(1995)
 
 
@@ -44,6 +113,59 @@ def get_spaced_colors(n):
     return colors
 
 
+def get_annotator():
+    """
+    The annotator of this request, from the `annotator` argument of the url
+    (e.g. `/?annotator=name`) or from the cookie set when it was given; it
+    defaults to the one in `config.toml`
+    """
+    return request.args.get("annotator") or request.cookies.get(
+        "annotator") or s["annotator"]
+
+
+def get_manager():
+    """
+    The `ImageManager` of the annotator of this request, created at the first
+    request
+    """
+    annotator = get_annotator()
+    with SESSIONS_LOCK:
+        if annotator not in SESSIONS:
+            SESSIONS[annotator] = ImageManager(
+                None,
+                s["annotation_field"],
+                annotator,
+                control_length=s["control_length"],
+                control_freq=s["control_freq"],
+                prefetch=s["prefetch"],
+                preview_size=s["preview_size"],
+                tile_size=s["tile_size"],
+                jpeg_quality=s["jpeg_quality"],
+                image_cache=s["image_cache"],
+                allocator=ALLOCATOR,
+                executor=EXECUTOR)
+        return SESSIONS[annotator]
+
+
+def page_response(idx):
+    """
+    The response with the page built by `make_page(idx)`, remembering the
+    annotator in a cookie if it was given in the url
+    """
+    return annotator_cookie(make_response(make_page(idx)))
+
+
+def annotator_cookie(response):
+    """
+    Remembers the annotator in a cookie, if it was given in the url
+    """
+    if "annotator" in request.args:
+        response.set_cookie("annotator",
+                            request.args["annotator"],
+                            max_age=365 * 24 * 3600)
+    return response
+
+
 def get_input_tags(name_val_pairs, sep=""):
     """
     Returns an html string containing `<input />` tags with equal-spaced
@@ -71,7 +193,7 @@ def home():
     if request.method == 'POST':
         # save annotation
         save_annotation()
-    return make_page(None)
+    return page_response(None)
 
 
 @app.route("/<int:idx>", methods=['GET'])
@@ -79,10 +201,292 @@ def hist(idx):
     """
     Looks for the next image and returns the web-page. If the request is a
     post, it also save the annotation
-    If `IMAGE_MANAGER` has a new rating, it also adds a screen to communicate
-    it.
+    If the `ImageManager` has a new rating, it also adds a screen to
+    communicate it.
+    """
+    return page_response(idx)
+
+
+def image_response(etag, render):
+    """
+    Returns the JPEG produced by `render()` with caching headers. The images of
+    a blob or of a page never change, so if the browser already has them,
+    `render` is not even called.
+    """
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(render(), mimetype='image/jpeg')
+    response.set_etag(etag)
+    response.cache_control.private = True
+    response.cache_control.max_age = s["image_max_age"]
+    return response
+
+
+@app.route("/image/<unique_id>/blob.jpg", methods=['GET'])
+def image(unique_id):
+    """
+    The blob with its surroundings
+    """
+    manager = get_manager()
+    if not manager.is_served(unique_id):
+        abort(404)
+    return image_response(f"{unique_id}-blob",
+                          lambda: manager.get_image(unique_id))
+
+
+@app.route("/page/<page_id>/preview.jpg", methods=['GET'])
+def page_image(page_id):
+    """
+    The downscaled page, shared by all its blobs
+    """
+    manager = get_manager()
+    if not manager.is_served_page(page_id):
+        abort(404)
+    return image_response(f"{page_id}-preview",
+                          lambda: manager.get_page(page_id))
+
+
+@app.route("/page/<page_id>/tile/<int:row>/<int:col>.jpg", methods=['GET'])
+def tile(page_id, row, col):
+    """
+    A full-resolution tile of the page, shared by all its blobs
+    """
+    manager = get_manager()
+    shape = manager.get_page_tiles_shape(page_id)
+    if shape is None or not (0 <= row < shape[0] and 0 <= col < shape[1]):
+        abort(404)
+    return image_response(f"{page_id}-tile-{row}-{col}",
+                          lambda: manager.get_tile(page_id, row, col))
+
+
+OVERLAY_STYLE = """
+    <style>
+        .page {
+            position: relative;
+            display: inline-block;
+            line-height: 0;
+        }
+        .overlay {
+            position: absolute;
+            top: 0;
+            left: 0;
+            width: 100%;
+            height: 100%;
+            pointer-events: none;
+        }
+    </style>
+"""
+
+
+@app.route("/image/<unique_id>/page", methods=['GET'])
+def page(unique_id):
+    """
+    The downscaled page with the rectangle of the blob drawn over it by the
+    browser
+    """
+    manager = get_manager()
+    if not manager.is_served(unique_id):
+        abort(404)
+    page_id, shape, box = manager.get_box(unique_id)
+    src = url_for('page_image', page_id=page_id)
+    return f"""
+        <div class="page">
+            <img src="{src}" style="max-width: 100%;"/>
+            {box_overlay(shape, box)}
+        </div>
+        {OVERLAY_STYLE}
     """
-    return make_page(idx)
+
+
+@app.route("/image/<unique_id>/zoom", methods=['GET'])
+def zoom(unique_id):
+    """
+    The page at full resolution, loaded one tile at a time while scrolling,
+    with the rectangle of the blob drawn over it by the browser
+    """
+    manager = get_manager()
+    if not manager.is_served(unique_id):
+        abort(404)
+    page_id, shape, box = manager.get_box(unique_id)
+    rows, cols = manager.get_tiles_shape(unique_id)
+    tiles = ""
+    for row in range(rows):
+        for col in range(cols):
+            src = url_for('tile', page_id=page_id, row=row, col=col)
+            h = min(manager.tile_size, shape[0] - row * manager.tile_size)
+            w = min(manager.tile_size, shape[1] - col * manager.tile_size)
+            tiles += f'<img src="{src}" width="{w}" height="{h}" loading="lazy"/>'
+    return f"""
+        <div class="page">
+            <div id="tiles">{tiles}</div>
+            {box_overlay(shape, box)}
+        </div>
+        {OVERLAY_STYLE}
+        <style>
+            #tiles {{
+                display: grid;
+                grid-template-columns: repeat({cols}, max-content);
+                line-height: 0;
+            }}
+        </style>
+    """
+
+
+@app.route("/metrics", methods=['GET'])
+def metrics_endpoint():
+    """
+    The metrics of the server, in the Prometheus text format
+    """
+    return Response(metrics.render(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route("/agreement", methods=['GET'])
+def agreement():
+    """
+    The agreement statistics of all the annotators, as json
+    """
+    with ALLOCATOR.annotator_lock:
+        return jsonify(ALLOCATOR.agreement.summary())
+
+
+def blob_info(served):
+    """
+    The json sent by the API for a blob returned by `ImageManager.ask`
+    """
+    json_fn, is_control, unique_id, in_parts = served
+    return {
+        "json_fn": str(Path(json_fn).relative_to(ORIGINAL_IN)),
+        "is_control": is_control,
+        "unique_id": unique_id,
+        "image": url_for('image', unique_id=unique_id),
+        "page": url_for('page', unique_id=unique_id),
+        "zoom": url_for('zoom', unique_id=unique_id),
+        "from": in_parts[ORIGINAL_IN_PARTS:ORIGINAL_IN_PARTS + 2]
+    }
+
+
+@app.route("/api/blobs", methods=['GET'])
+def api_blobs():
+    """
+    Leases `n` blobs (the `n` argument, at most `batch_size`) to the
+    annotator at once, control blobs included, as json: `blobs` is the list
+    of blobs and `ended` is True if the archive is finished
+    """
+    n = min(max(1, request.args.get("n", 1, type=int)), s["batch_size"])
+    try:
+        served = get_manager().ask_batch(n)
+    except StopIteration:
+        return jsonify({"blobs": [], "ended": True})
+    except AskException:
+        return jsonify({"blobs": [], "ended": False}), 503
+    return jsonify({"blobs": [blob_info(b) for b in served], "ended": False})
+
+
+@app.route("/api/annotations", methods=['POST'])
+def api_annotations():
+    """
+    Saves a batch of annotations, a json object whose `annotations` are a
+    list of objects with the `json_fn` and `unique_id` of a blob returned by
+    `/api/blobs` and the `label` (a key of `annotation_values`); whether the
+    blob is a control one is known by the server. Returns the number of
+    annotations saved and the rating of the annotator, with `new_rating`
+    True if it changed.
+
+    Annotations of blobs that were not served to the annotator or with
+    unknown labels are not saved and are returned in `rejected`.
+    """
+    manager = get_manager()
+    batch, rejected = [], []
+    for a in (request.get_json(silent=True) or {}).get("annotations", []):
+        try:
+            json_fn = ORIGINAL_IN / a["json_fn"]
+            value = s["annotation_values"][a["label"]]
+            valid = manager.is_served(a["unique_id"]) and blob_uid(
+                json_fn) == a["unique_id"]
+        except (KeyError, TypeError):
+            valid = False
+        if not valid:
+            rejected.append(a)
+            continue
+        is_control = ALLOCATOR.control_position(json_fn) is not None
+        batch.append((json_fn, is_control, value, a["unique_id"]))
+    manager.save_batch(batch)
+    return jsonify({
+        "saved": len(batch),
+        "rejected": rejected,
+        "new_rating": manager.new_annotator_rating,
+        "rating": manager.annotator_rating,
+        "annotated": ALLOCATOR.index.n_annotated,
+        "total": len(ALLOCATOR.normal_jsons)
+    })
+
+
+GRID_KEYS = "1234567890qwertyuiopasdfghjklzxcvbnm"
+
+
+@app.route("/grid", methods=['GET'])
+def grid():
+    """
+    Annotation of many blobs per submit, with the keyboard (see
+    `static/grid.js`): blobs are fetched with `/api/blobs` and saved with
+    `/api/annotations`
+    """
+    labels = [{
+        "name": name,
+        "key": key
+    } for name, key in zip(s["annotation_values"], GRID_KEYS)]
+    legend = "".join(f'<span class="label"><b>{l["key"]}</b> {l["name"]}</span>'
+                     for l in labels)
+    grid_config = json.dumps({
+        "labels": labels,
+        "size": s["batch_size"],
+        "columns": s["grid_columns"]
+    })
+    return annotator_cookie(
+        make_response(f"""
+        <h3>A quale categoria appartiene ciascuna immagine?</h3>
+        <p>
+            Frecce: scegli l'immagine; tasto della categoria: assegnala
+            all'immagine scelta; Maiuscolo + tasto: assegnala a tutte le
+            immagini senza categoria; Backspace: toglila; Invio: salva le
+            immagini con una categoria.
+        </p>
+        <div id="legend">{legend}</div>
+        <div id="status"></div>
+        <div id="grid"></div>
+        <script>const GRID = {grid_config};</script>
+        <script src="{url_for('static', filename='grid.js')}"></script>
+        <style>
+            #grid {{
+                display: grid;
+                grid-template-columns: repeat({s["grid_columns"]}, 1fr);
+                gap: 8px;
+            }}
+            .cell {{
+                border: 4px solid transparent;
+                text-align: center;
+            }}
+            .cell img {{
+                max-width: 100%;
+                max-height: 200px;
+            }}
+            .cell.focus {{
+                border-color: #0264fc;
+            }}
+            .cell.labelled {{
+                background-color: #c8f7d4;
+            }}
+            .cell.error {{
+                background-color: #f7c8c8;
+            }}
+            .label {{
+                margin-right: 1em;
+                white-space: nowrap;
+            }}
+        </style>
+    """))
 
 
 def save_annotation():
@@ -91,17 +495,18 @@ def save_annotation():
     json_fn = ORIGINAL_IN / request.form["json_fn"]
     is_control = request.form["is_control"] == "True"
     unique_id = request.form["unique_id"]
-    IMAGE_MANAGER.save_annotation(json_fn, is_control, annotation_value,
+    get_manager().save_annotation(json_fn, is_control, annotation_value,
                                   unique_id)
 
 
 def make_page(idx=None):
     """
-    Asks an image to `IMAGE_MANAGER`. If `idx` is `None`, it uses the next
-    available image, otherwise it serves the image in the history at the `-idx`
-    index.
+    Asks an image to the `ImageManager` of the annotator. If `idx` is `None`,
+    it uses the next available image, otherwise it serves the image in the
+    history at the `-idx` index.
 
-    If `IMAGE_MANAGER` has a new rating, it also add a screen to communicate it.
+    If the `ImageManager` has a new rating, it also add a screen to communicate
+    it.
 
     The served page has:
     * a title
@@ -110,6 +515,7 @@ def make_page(idx=None):
     * a link to the full page
     * an optional div with the user rating
     """
+    manager = get_manager()
     intro = "La seguente immagine nel rettangolo rosso a quale categoria può essere attribuita?"
     if idx is None or idx <= 1:
         arrow_left = '<a href="/2"><i class="arrow left"></i></a>'
@@ -118,15 +524,17 @@ def make_page(idx=None):
         arrow_left = f'<a href="/{idx+1}"><i class="arrow left"></i></a>'
         arrow_right = f'<a href="/{idx-1}"><i class="arrow right"></i></a>'
     try:
-        json_fn, is_control, unique_id, in_parts = IMAGE_MANAGER.ask(idx)
+        json_fn, is_control, unique_id, in_parts = manager.ask(idx)
         # the json_fn shouldn't be an absolute path, otherwise the client could
         # overwrite any file in the system
         json_fn = Path(json_fn).relative_to(ORIGINAL_IN)
         in_parts = in_parts[ORIGINAL_IN_PARTS:ORIGINAL_IN_PARTS + 2]
         from_ = f"Questa immagine proviene da <i><b>{in_parts[0]}</b>, {in_parts[1]}</i>"
-        big_blob_path, partiture_path = IMAGE_MANAGER.get_filenames(unique_id)
+        big_blob_path = url_for('image', unique_id=unique_id)
+        partiture_path = url_for('page', unique_id=unique_id)
+        zoom_path = url_for('zoom', unique_id=unique_id)
         big_blob = f'<img src="{big_blob_path}" height=400px/>'
-        partiture = f'<a href="{partiture_path}" target="_blank">Vedi la pagina originale</a>'
+        partiture = f'<a href="{partiture_path}" target="_blank">Vedi la pagina originale</a> (<a href="{zoom_path}" target="_blank">ingrandita</a>)'
 
         d = []
         for v in s["annotation_values"].keys():
@@ -155,10 +563,10 @@ def make_page(idx=None):
         unique_id = ""
         intro = ""
 
-    if IMAGE_MANAGER.new_annotator_rating:
-        annotated = IMAGE_MANAGER.current_normal_idx + 1
-        ratio = annotated / len(IMAGE_MANAGER.normal_jsons) * 100
-        new_rating = IMAGE_MANAGER.annotator_rating
+    if manager.new_annotator_rating:
+        annotated = ALLOCATOR.index.n_annotated
+        ratio = annotated / len(ALLOCATOR.normal_jsons) * 100
+        new_rating = manager.annotator_rating
         gif = RNG.choice(list(Path('./static').glob("*.gif")))
         rating_div = f"""
             <div class="rating" id="rating-background">
@@ -290,5 +698,8 @@ def make_page(idx=None):
 
 
 def run():
+    import atexit
     import waitress
+    if JOURNAL is not None:
+        atexit.register(JOURNAL.stop)
     waitress.serve(app, port=s["port"])
@@ -0,0 +1,112 @@
+"""
+Client of `staff_removal_worker.py`, which runs in the Python 2 environment
+of `staff-lines-removal` and keeps the model loaded between pages
+"""
+import os
+import subprocess
+import threading
+import logging
+from pathlib import Path
+
+LOGGER = logging.getLogger(__name__)
+
+PROJ_DIR = Path(__file__).resolve().parent.parent
+PYENV_VERSION = "miniconda2-4.7.12/envs/staff_line_removal"
+MODEL = "MODELS/model_weights_GR_256x256_s256_l3_f96_k5_se1_e200_b8_p25_esg.h5"
+
+
+class StaffRemovalWorker:
+    """
+    Starts the worker process, which loads the model once, and sends it the
+    pages one at a time; all the 256x256 windows of a page are predicted in
+    batches of `batch` windows. Theano runs on `device` (e.g. "cpu" or
+    "cuda0").
+
+    Thread-safe; can be used as a context manager.
+    """
+
+    def __init__(self,
+                 model=MODEL,
+                 layers=3,
+                 window=256,
+                 filters=96,
+                 ksize=5,
+                 th=0.3,
+                 batch=16,
+                 device="cpu",
+                 pyenv_version=PYENV_VERSION,
+                 proj_dir=PROJ_DIR):
+        proj_dir = Path(proj_dir)
+        env = dict(os.environ,
+                   PYENV_VERSION=pyenv_version,
+                   THEANO_FLAGS=f"device={device},floatX=float32",
+                   KERAS_BACKEND="theano")
+        self._lock = threading.Lock()
+        self._process = subprocess.Popen(
+            [
+                "python",
+                str(proj_dir / "staff_removal_worker.py"), "-modelpath",
+                model, "-layers",
+                str(layers), "-window",
+                str(window), "-filters",
+                str(filters), "-ksize",
+                str(ksize), "-th",
+                str(th), "-batch",
+                str(batch)
+            ],
+            cwd=proj_dir / "staff-lines-removal",
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True,
+            bufsize=1)
+        ready = self._process.stdout.readline().strip()
+        if ready != "ready":
+            self.close()
+            raise RuntimeError("the staff-removal worker could not start")
+        LOGGER.info("staff-removal worker ready")
+
+    def remove(self, in_path, out_path):
+        """
+        Removes the staff lines from the image `in_path` and writes the
+        result to `out_path`, which is returned
+        """
+        with self._lock:
+            self._process.stdin.write(f"{in_path}\t{out_path}\n")
+            self._process.stdin.flush()
+            reply = self._process.stdout.readline().rstrip("\n").split("\t")
+        if reply[0] != "done":
+            raise RuntimeError(f"staff removal failed: {reply}")
+        return out_path
+
+    def check(self, in_path, tolerance=0.):
+        """
+        Runs `demo.py` on the page `in_path` and raises a RuntimeError if its
+        output differs from the one of the worker in more than a fraction
+        `tolerance` of the pixels; the worker rebuilds the network of
+        `demo.py` and must not be used before this check passes
+        """
+        with self._lock:
+            self._process.stdin.write(f"check\t{in_path}\n")
+            self._process.stdin.flush()
+            reply = self._process.stdout.readline().rstrip("\n").split("\t")
+        if reply[0] != "checked":
+            raise RuntimeError(f"staff-removal check failed: {reply}")
+        diff = float(reply[1])
+        if diff > tolerance:
+            raise RuntimeError(
+                f"the staff-removal worker differs from demo.py on {in_path} "
+                f"({100 * diff:.2f}% of the pixels), use ./preprocess.sh")
+        LOGGER.info(f"staff-removal worker checked on {in_path}")
+        return diff
+
+    def close(self):
+        if self._process.poll() is None:
+            self._process.stdin.close()
+            self._process.wait()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
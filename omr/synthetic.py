@@ -0,0 +1,28 @@
+"""
+Synthetic test data for the benchmarks and the load test
+"""
+import numpy as np
+
+
+def synthetic_page(rng, shape=(3500, 2500), n_symbols=300):
+    """
+    A grayscale page (uint8, ink on white) with `n_symbols` dark ellipses of
+    10-60 px and short strokes, roughly like a page without staff, and the
+    bounding box of each symbol
+    """
+    from skimage import draw
+
+    page = np.full(shape, 255, dtype=np.uint8)
+    boxes = []
+    for _ in range(n_symbols):
+        r, c = rng.integers(60, shape[0] - 60), rng.integers(60, shape[1] - 60)
+        rr, cc = draw.ellipse(r, c, rng.integers(5, 30), rng.integers(5, 30),
+                              shape=shape,
+                              rotation=rng.uniform(0, np.pi))
+        page[rr, cc] = rng.integers(0, 80)
+        if rng.random() < 0.5:
+            lr, lc = draw.line(r, c, max(0, r - rng.integers(30, 120)), c)
+            page[lr, lc] = 0
+            rr, cc = np.concatenate([rr, lr]), np.concatenate([cc, lc])
+        boxes.append((rr.min(), cc.min(), rr.max() + 1, cc.max() + 1))
+    return page, boxes
@@ -2,18 +2,23 @@
 
 OLDIFS="$IFS"
 IFS=$'\n' # bash specific
-export THEANO_FLAGS="device=cuda0,force_device=True,floatX=float32"
+export THEANO_FLAGS="device=${DEVICE:-cuda0},force_device=True,floatX=float32"
 export KERAS_BACKEND=theano
 export LD_LIBRARY_PATH="/usr/local/lib/:$LD_LIBRARY_PATH"
+export PYENV_VERSION=miniconda2-4.7.12/envs/staff_line_removal
 
 # reading config
 data_path=$(grep input_dir config.toml | awk '{print $3}' | xargs)
 # adding final slash if needed
 data_path="${data_path%/}/"
 
+model_args=(-modelpath MODELS/model_weights_GR_256x256_s256_l3_f96_k5_se1_e200_b8_p25_esg.h5 -layers 3 -window 256 -filters 96 -ksize 5 -th 0.3)
+
 cd staff-lines-removal
 
-# for each jpg file in the dataset that is not in `altro` directory
+# each jpg file in the dataset that is not in `altro` directory and doesn't
+# have its `_nostaff.jpg` file yet
+queue=()
 for i in $(find $data_path -path ${data_path}/altro -prune -o -name "*.jpg")
 do
   if [[ "${i: -12}" != "_nostaff.jpg" ]]; then
@@ -21,16 +26,40 @@ do
     outfile=${i/.jpg/_nostaff.jpg}
     if [[ ! -f "$outfile" ]]; then
       # if $outfile does not exists
-      echo
-      echo
-      echo "====================================================="
-      echo "Processing $i"
-      echo "====================================================="
-      echo
-      echo
-      PYENV_VERSION=miniconda2-4.7.12/envs/staff_line_removal python demo.py -imgpath "$i" -modelpath MODELS/model_weights_GR_256x256_s256_l3_f96_k5_se1_e200_b8_p25_esg.h5 -layers 3 -window 256 -filters 96 -ksize 5 -th 0.3 -save "$outfile"
+      queue+=("$i")
     fi
   fi
 done
+
+# with `WORKER=1`, a single worker loads the model once and processes all
+# the pages, but only if it gives the same output as `demo.py` on the first
+# page
+use_worker=0
+if [[ "${WORKER:-0}" == 1 && ${#queue[@]} -gt 0 ]]; then
+  if python ../staff_removal_worker.py "${model_args[@]}" -check "${queue[0]}"; then
+    use_worker=1
+  else
+    echo "The staff-removal worker differs from demo.py, using demo.py"
+  fi
+fi
+
+if [[ $use_worker == 1 ]]; then
+  for i in "${queue[@]}"
+  do
+    printf '%s\t%s\n' "$i" "${i/.jpg/_nostaff.jpg}"
+  done | python ../staff_removal_worker.py "${model_args[@]}"
+else
+  for i in "${queue[@]}"
+  do
+    echo
+    echo
+    echo "====================================================="
+    echo "Processing $i"
+    echo "====================================================="
+    echo
+    echo
+    python demo.py -imgpath "$i" "${model_args[@]}" -save "${i/.jpg/_nostaff.jpg}"
+  done
+fi
 cd ..
 IFS="$OLDIFS"
@@ -0,0 +1,178 @@
+"""
+A long-lived staff-removal worker: it loads the selectional auto-encoder
+once and then removes the staff lines from every page it receives.
+
+It runs in the `staff_line_removal` conda environment (Python 2, Keras with
+Theano), from the `staff-lines-removal` directory, and takes the same model
+options as `demo.py`.
+
+Each line of the standard input is a page to process, as
+`<input path>\\t<output path>`; for each page, a line
+`done\\t<output path>` or `error\\t<input path>\\t<message>` is written to the
+standard output. A line `check\\t<input path>` compares the worker with
+`demo.py` on that page (see `check`) and is answered with
+`checked\\t<fraction of different pixels>`.
+
+The network is rebuilt here rather than imported from `demo.py`, which is a
+script, so it must not replace `demo.py` before `check` (or `-check <page>`,
+which exits with 1 if the outputs differ) shows that they agree on a real
+page.
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+import cv2
+import numpy as np
+
+
+def build_model(args):
+    """
+    The selectional auto-encoder used by `demo.py`: `layers` blocks of
+    convolution, batch normalization, ReLU and pooling, mirrored by the
+    decoder, and a final sigmoid convolution giving the probability of each
+    pixel of being kept
+    """
+    from keras.models import Sequential
+    from keras.layers import (Conv2D, MaxPooling2D, UpSampling2D,
+                              BatchNormalization, Activation)
+
+    model = Sequential()
+    for i in range(args.layers):
+        kwargs = {}
+        if i == 0:
+            kwargs['input_shape'] = (args.window, args.window, 1)
+        model.add(
+            Conv2D(args.filters, args.ksize, padding='same', **kwargs))
+        model.add(BatchNormalization())
+        model.add(Activation('relu'))
+        model.add(MaxPooling2D(pool_size=(2, 2)))
+    for i in range(args.layers):
+        model.add(UpSampling2D(size=(2, 2)))
+        model.add(Conv2D(args.filters, args.ksize, padding='same'))
+        model.add(BatchNormalization())
+        model.add(Activation('relu'))
+    model.add(
+        Conv2D(1, args.ksize, padding='same', activation='sigmoid'))
+    model.load_weights(args.modelpath)
+    return model
+
+
+def windows(img, window):
+    """
+    Pads `img` with background to a multiple of `window` and returns the
+    batch of all its windows and the padded shape
+    """
+    rows = -(-img.shape[0] // window) * window
+    cols = -(-img.shape[1] // window) * window
+    padded = np.zeros((rows, cols), dtype=np.float32)
+    padded[:img.shape[0], :img.shape[1]] = img
+    batch = padded.reshape(rows // window, window, cols // window, window)
+    batch = batch.transpose(0, 2, 1, 3).reshape(-1, window, window, 1)
+    return batch, padded.shape
+
+
+def remove_staffs(model, args, in_path, out_path):
+    img = cv2.imread(in_path, False)
+    if img is None:
+        raise IOError("cannot read " + in_path)
+    # ink is 1, background is 0
+    img = (255. - img.astype(np.float32)) / 255.
+    batch, shape = windows(img, args.window)
+    prediction = model.predict(batch, batch_size=args.batch) > args.th
+    rows, cols = shape[0] // args.window, shape[1] // args.window
+    out = prediction.reshape(rows, cols, args.window, args.window)
+    out = out.transpose(0, 2, 1, 3).reshape(shape)
+    out = out[:img.shape[0], :img.shape[1]]
+    out = ((1 - out) * 255).astype(np.uint8)
+    cv2.imwrite(out_path, out)
+
+
+def check(model, args, in_path):
+    """
+    Runs `demo.py` on `in_path` with the same options and returns the
+    fraction of pixels where its output differs from the one of
+    `remove_staffs`, in the part of the page covered by whole windows (the
+    worker also processes the borders)
+    """
+    tmp = tempfile.mkdtemp()
+    try:
+        ours = os.path.join(tmp, 'worker.png')
+        theirs = os.path.join(tmp, 'demo.png')
+        remove_staffs(model, args, in_path, ours)
+        # the output of demo.py must not mix with the replies of the worker
+        subprocess.check_call([
+            sys.executable, 'demo.py', '-imgpath', in_path, '-modelpath',
+            args.modelpath, '-layers',
+            str(args.layers), '-window',
+            str(args.window), '-filters',
+            str(args.filters), '-ksize',
+            str(args.ksize), '-th',
+            str(args.th), '-save', theirs
+        ],
+                              stdout=sys.stderr)
+        a = cv2.imread(ours, False)
+        b = cv2.imread(theirs, False)
+    finally:
+        shutil.rmtree(tmp)
+    if b is None or a.shape != b.shape:
+        return 1.
+    rows = a.shape[0] // args.window * args.window
+    cols = a.shape[1] // args.window * args.window
+    if rows == 0 or cols == 0:
+        return float(np.mean(a != b))
+    return float(np.mean(a[:rows, :cols] != b[:rows, :cols]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-modelpath', required=True)
+    parser.add_argument('-layers', type=int, default=3)
+    parser.add_argument('-window', type=int, default=256)
+    parser.add_argument('-filters', type=int, default=96)
+    parser.add_argument('-ksize', type=int, default=5)
+    parser.add_argument('-th', type=float, default=0.3)
+    parser.add_argument('-batch',
+                        type=int,
+                        default=16,
+                        help='number of windows predicted together')
+    parser.add_argument('-check',
+                        default=None,
+                        help='compare with demo.py on this page and exit')
+    parser.add_argument('-tolerance',
+                        type=float,
+                        default=0.,
+                        help='fraction of pixels that can differ in -check')
+    args = parser.parse_args()
+
+    model = build_model(args)
+    if args.check is not None:
+        diff = check(model, args, args.check)
+        print("checked\t" + str(diff))
+        sys.exit(0 if diff <= args.tolerance else 1)
+    print("ready")
+    sys.stdout.flush()
+
+    for line in iter(sys.stdin.readline, ''):
+        line = line.rstrip('\n')
+        if not line:
+            continue
+        in_path, out_path = line.split('\t')
+        try:
+            if in_path == 'check':
+                print("checked\t" + str(check(model, args, out_path)))
+            else:
+                remove_staffs(model, args, in_path, out_path)
+                print("done\t" + out_path)
+        except Exception as e:
+            print("error\t" + in_path + "\t" + str(e).replace('\n', ' '))
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+// Grid annotation: many blobs per submit, driven by the keyboard. `GRID` is
+// set by the `/grid` page: the labels with their keys, the number of blobs in
+// the grid and the number of columns.
+let cells = [];
+let focus = 0;
+let saving = false;
+let filling = false;
+// milliseconds before asking again for blobs while the server is busy
+const MIN_RETRY = 1000;
+const MAX_RETRY = 30000;
+let retryDelay = MIN_RETRY;
+let retryTimer = null;
+const byKey = {};
+for (const label of GRID.labels) {
+    byKey[label.key] = label.name;
+}
+
+function status(text) {
+    document.getElementById("status").innerHTML = text;
+}
+
+function render() {
+    const grid = document.getElementById("grid");
+    grid.innerHTML = "";
+    cells.forEach((cell, i) => {
+        const div = document.createElement("div");
+        div.className = "cell" + (i === focus ? " focus" : "") +
+            (cell.label ? " labelled" : "") + (cell.error ? " error" : "");
+        div.innerHTML = `<img src="${cell.image}"/><br/>` +
+            `<a href="${cell.page}" target="_blank">pagina</a> ` +
+            `<b>${cell.label || ""}</b>`;
+        div.onclick = () => {
+            focus = i;
+            render();
+        };
+        grid.appendChild(div);
+    });
+}
+
+async function fill() {
+    const n = GRID.size - cells.length;
+    if (n <= 0 || filling || retryTimer !== null) {
+        return;
+    }
+    filling = true;
+    let response = null;
+    try {
+        response = await fetch(`/api/blobs?n=${n}`);
+    } catch (error) {
+        response = null;
+    }
+    filling = false;
+    if (response === null || response.status === 503) {
+        // the server is still loading or busy: retry with a growing delay
+        status(`Caricamento in corso, nuovo tentativo tra ` +
+            `${Math.round(retryDelay / 1000)} s`);
+        retryTimer = setTimeout(() => {
+            retryTimer = null;
+            fill();
+        }, retryDelay);
+        retryDelay = Math.min(MAX_RETRY, 2 * retryDelay);
+        return;
+    }
+    if (retryDelay !== MIN_RETRY) {
+        retryDelay = MIN_RETRY;
+        status("");
+    }
+    const data = await response.json();
+    cells = cells.concat(data.blobs);
+    if (data.ended && cells.length === 0) {
+        status("<h2>L'archivio Ricordi è finito!</h2>");
+    }
+    render();
+}
+
+async function save() {
+    const done = cells.filter((c) => c.label);
+    if (saving || done.length === 0) {
+        return;
+    }
+    saving = true;
+    let data = null;
+    try {
+        const response = await fetch("/api/annotations", {
+            method: "POST",
+            headers: {"Content-Type": "application/json"},
+            body: JSON.stringify({
+                annotations: done.map((c) => ({
+                    json_fn: c.json_fn,
+                    unique_id: c.unique_id,
+                    label: c.label
+                }))
+            })
+        });
+        if (response.ok) {
+            data = await response.json();
+        }
+    } catch (error) {
+        data = null;
+    }
+    saving = false;
+    if (data === null) {
+        // nothing was saved: keep the labels so that they can be sent again
+        for (const cell of done) {
+            cell.error = true;
+        }
+        status("<b>Salvataggio non riuscito, premi Invio per riprovare</b>");
+        render();
+        return;
+    }
+    // the rejected blobs stay in the grid, marked, with their labels
+    const rejected = new Set(data.rejected.map((a) => a.unique_id));
+    cells = cells.filter((c) => !c.label || rejected.has(c.unique_id));
+    for (const cell of cells) {
+        cell.error = rejected.has(cell.unique_id);
+    }
+    focus = 0;
+    let text = `Salvate ${data.saved} immagini; annotate ${data.annotated}` +
+        ` su ${data.total}.`;
+    if (rejected.size) {
+        text += ` <b>${rejected.size} non salvate (in rosso): ` +
+            `correggile e premi Invio per riprovare</b>`;
+    }
+    if (data.new_rating) {
+        text += ` <b>Nuovo punteggio: ${data.rating}</b>`;
+    }
+    status(text);
+    render();
+    await fill();
+}
+
+document.addEventListener("keydown", (event) => {
+    if (cells.length === 0) {
+        return;
+    }
+    // the key without Shift, whatever the layout (Shift+1 is "!")
+    let key = event.key.toLowerCase();
+    if (event.code.startsWith("Digit")) {
+        key = event.code.slice(5);
+    } else if (event.code.startsWith("Key")) {
+        key = event.code.slice(3).toLowerCase();
+    }
+    if (event.key === "ArrowRight") {
+        focus = Math.min(cells.length - 1, focus + 1);
+    } else if (event.key === "ArrowLeft") {
+        focus = Math.max(0, focus - 1);
+    } else if (event.key === "ArrowDown") {
+        focus = Math.min(cells.length - 1, focus + GRID.columns);
+    } else if (event.key === "ArrowUp") {
+        focus = Math.max(0, focus - GRID.columns);
+    } else if (event.key === "Backspace") {
+        cells[focus].label = null;
+        cells[focus].error = false;
+    } else if (event.key === "Enter") {
+        save();
+    } else if (key in byKey && event.shiftKey) {
+        for (const cell of cells) {
+            cell.label = cell.label || byKey[key];
+        }
+    } else if (key in byKey) {
+        cells[focus].label = byKey[key];
+        // next blob without a label
+        const next = cells.findIndex((c, i) => i > focus && !c.label);
+        if (next >= 0) {
+            focus = next;
+        }
+    } else {
+        return;
+    }
+    event.preventDefault();
+    render();
+});
+
+fill();